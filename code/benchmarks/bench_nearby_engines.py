@@ -0,0 +1,95 @@
+"""A small script for benchmarking the nearby fires engines against each other. 
+
+This times the box (`GridIndex`, +/- `dist_measure` in lat/long space) and 
+haversine (`HaversineIndex`, a radius in kilometers) modes of 
+`gen_nearby_fires_count` on the same synthetic detections, and reports how 
+much their counts differ row by row (the mean absolute difference, the largest 
+absolute difference, and the share of rows whose counts differ). The radius defaults to the north-south width of the 
+box (`dist_measure` degrees of latitude), so the haversine mode covers a 
+circle inscribed in the box at the equator and a taller-than-wide slice of it 
+further north. 
+
+Usage (from the main folder of the repository): 
+
+    python code/benchmarks/bench_nearby_engines.py [n_rows] [dist_measure]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             '..', 'feature_engineering'))
+from geo_featurization import gen_nearby_fires_count
+from haversine_index import EARTH_RADIUS_KM
+from synthetic_detections import gen_detections
+
+TIME_MEASURES = [0, 1, 2, 3, 4, 5, 6, 7, 365, 730, 1095]
+
+def time_engine(df, kwargs): 
+    """Run `gen_nearby_fires_count` and return the output and its wall time. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame 
+        kwargs: dct
+
+    Return: 
+    ------
+        output_df: Pandas DataFrame 
+        elapsed: float
+    """
+
+    start = time.time()
+    output_df = gen_nearby_fires_count(df.copy(), kwargs)
+    elapsed = time.time() - start
+
+    return output_df, elapsed
+
+def get_count_diffs(box_counts, hav_counts): 
+    """Return how much the counts of the two engines differ row by row. 
+
+    Args: 
+    ----
+        box_counts: Pandas Series
+        hav_counts: Pandas Series
+            Holds the counts for the same rows (and index) as `box_counts`. 
+
+    Return: 
+    ------
+        mean_abs_diff: float
+        max_abs_diff: float
+        share_differ: float
+    """
+
+    diffs = np.abs(box_counts.values.astype(np.float64) - 
+            hav_counts.loc[box_counts.index].values)
+
+    return diffs.mean(), diffs.max(), (diffs > 0).mean()
+
+if __name__ == '__main__': 
+    n_rows = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    dist_measure = float(sys.argv[2]) if len(sys.argv) >= 3 else 0.1
+    radius_km = np.radians(dist_measure) * EARTH_RADIUS_KM
+
+    df = gen_detections(n_rows, all_columns=False)
+    box_df, box_time = time_engine(df, {'engine': 'grid', 
+            'dist_measure': dist_measure, 'time_measures': TIME_MEASURES})
+    hav_df, hav_time = time_engine(df, {'engine': 'haversine', 
+            'radius_km': radius_km, 'time_measures': TIME_MEASURES})
+
+    print 'Rows: {}, dist_measure: {}, radius_km: {:.2f}'.format(n_rows, 
+            dist_measure, radius_km)
+    print 'Box (grid) time: {:.2f}s ({:.0f} rows/s)'.format(box_time, 
+            n_rows / box_time)
+    print 'Haversine time: {:.2f}s ({:.0f} rows/s)'.format(hav_time, 
+            n_rows / hav_time)
+    for time_measure in TIME_MEASURES: 
+        col = 'all_nearby_count{}'.format(time_measure)
+        mean_abs_diff, max_abs_diff, share_differ = \
+                get_count_diffs(box_df[col], hav_df[col])
+        print ('{}: box mean {:.2f}, haversine mean {:.2f}, mean abs. diff. ' 
+               '{:.2f}, max abs. diff. {:.0f}, rows that differ {:.1%}').format(
+                col, box_df[col].mean(), hav_df[col].mean(), mean_abs_diff, 
+                max_abs_diff, share_differ)
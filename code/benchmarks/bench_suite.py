@@ -0,0 +1,295 @@
+"""A benchmark suite for the geo featurization code on synthetic detections.
+
+For each table size, this times `gen_nearby_fires_count` (with each of the
+engines in `ENGINE_KWARGS`), `_handle_date_percentiles`, `calc_perc_fires`, and
+`add_date_column` (with all of the temporal features) on synthetic detections (see `synthetic_detections.py`), and records the
+throughput (rows/s) and peak RSS of each. Every case is run in a fresh process,
+so that the peak RSS of one case doesn't carry over into the next (it does
+include the table itself, which is reported separately as `input_rss_mb`).
+Processes started by the case itself (e.g. the grid engine with `n_jobs`)
+aren't included in its peak RSS.
+
+It also checks that the engines agree - every engine that should give the same
+counts as the grid engine is run on a smaller table, and any rows that differ
+are reported. The 'query' engine isn't included, since it double counts the
+obs. in the row's own date percentile (and is too slow to run at any size).
+
+Results are written to `results/bench_results.json` (next to this file). If a
+baseline has been saved to `baseline.json`, every case is compared against it,
+and any case that is more than `REGRESSION_TOL` slower or heavier (and by more
+than `MIN_SECONDS_DIFF` seconds or `MIN_RSS_MB_DIFF` MB) is flagged as a
+regression. The script exits with a non-zero status if there are any
+regressions or engine mismatches.
+
+Usage (from the main folder of the repository):
+
+    python code/benchmarks/bench_suite.py [n_rows ...] [save_baseline]
+
+where the table sizes default to 10k, 100k, and 1M rows, and `save_baseline`
+saves the results as the new baseline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import traceback
+import multiprocessing
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'feature_engineering'))
+from geo_featurization import gen_nearby_fires_count, calc_perc_fires, \
+        _handle_date_percentiles
+from time_featurization import add_date_column, TEMPORAL_FEATURES
+from synthetic_detections import gen_detections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FP = os.path.join(BENCH_DIR, 'results', 'bench_results.json')
+BASELINE_FP = os.path.join(BENCH_DIR, 'baseline.json')
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+EQUIVALENCE_ROWS = 20000
+DIST_MEASURE = 0.1
+TIME_MEASURES = [0, 1, 2, 3, 4, 5, 6, 7, 365, 730, 1095]
+ENGINE_KWARGS = {'grid': {'engine': 'grid', 'n_jobs': 1},
+                 'grid_parallel': {'engine': 'grid', 'n_jobs': -1},
+                 'cube': {'engine': 'cube', 'n_jobs': 1}}
+REGRESSION_TOL = 0.2
+MIN_SECONDS_DIFF = 0.5
+MIN_RSS_MB_DIFF = 50.
+
+def run_case(stage, engine, n_rows):
+    """Time a single stage on a table of `n_rows` synthetic detections.
+
+    This is meant to be run in its own process (see `run_case_in_process`).
+
+    Args:
+    ----
+        stage: str
+            Holds the name of the function to time.
+        engine: str or None
+            Holds the key into `ENGINE_KWARGS` (for `gen_nearby_fires_count`).
+        n_rows: int
+
+    Return:
+    ------
+        result: dct
+    """
+
+    df = gen_detections(n_rows, all_columns=False)
+    if stage == 'calc_perc_fires':
+        df = _add_synthetic_counts(df)
+    elif stage == 'add_date_column':
+        df['date'] = df['date_fire'].values.astype('datetime64[D]') \
+                .astype(str).astype(object)
+        df = df.drop('date_fire', axis=1)
+    input_rss_mb = _get_peak_rss_mb()
+
+    start = time.time()
+    if stage == 'gen_nearby_fires_count':
+        kwargs = dict(ENGINE_KWARGS[engine], dist_measure=DIST_MEASURE,
+                      time_measures=TIME_MEASURES)
+        gen_nearby_fires_count(df, kwargs)
+    elif stage == '_handle_date_percentiles':
+        nearby_df = df[['lat', 'long', 'date_fire', 'fire_bool']] \
+                .drop_duplicates(['lat', 'long', 'date_fire'])
+        _handle_date_percentiles(nearby_df.reset_index(drop=True))
+    elif stage == 'calc_perc_fires':
+        calc_perc_fires(df, TIME_MEASURES)
+    else:
+        add_date_column(df, TEMPORAL_FEATURES)
+    seconds = time.time() - start
+
+    result = {'stage': stage, 'engine': engine, 'n_rows': n_rows,
+              'seconds': seconds, 'rows_per_sec': n_rows / max(seconds, 1e-9),
+              'peak_rss_mb': _get_peak_rss_mb(), 'input_rss_mb': input_rss_mb}
+
+    return result
+
+def run_case_in_process(stage, engine, n_rows):
+    """Run `run_case` in a fresh process, and return its result.
+
+    Args:
+    ----
+        stage: str
+        engine: str or None
+        n_rows: int
+
+    Return:
+    ------
+        result: dct
+    """
+
+    # Pool workers are daemonic, and so couldn't start processes of their own.
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_put_case_result,
+                                      args=(queue, stage, engine, n_rows))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError('{} ({}) failed on {} rows:\n{}'.format(stage,
+                           engine, n_rows, result['error']))
+
+    return result
+
+def check_engine_equivalence(n_rows):
+    """Check that each engine gives the same counts as the grid engine.
+
+    The 'cube' engine only counts exactly up to 7 days back, so only those
+    columns are compared for it. The grid engine with a 'table_dir' (i.e.
+    building a `NearbyFiresTable`) is checked as its own engine.
+
+    Args:
+    ----
+        n_rows: int
+
+    Return:
+    ------
+        checks: list of dcts
+            Holds the engine, the columns compared, the number of rows whose
+            counts differ from the grid engine's, and whether it passed.
+    """
+
+    df = gen_detections(n_rows, all_columns=False)
+    table_dir = tempfile.mkdtemp()
+    engine_kwargs = dict(ENGINE_KWARGS, grid_table={'engine': 'grid',
+                                                    'table_dir': table_dir})
+    counts_dfs = {}
+    try:
+        for engine, kwargs in engine_kwargs.iteritems():
+            kwargs = dict(kwargs, dist_measure=DIST_MEASURE,
+                          time_measures=TIME_MEASURES)
+            counts_dfs[engine] = gen_nearby_fires_count(df.copy(), kwargs)
+    finally:
+        shutil.rmtree(table_dir)
+
+    checks = []
+    for engine, counts_df in sorted(counts_dfs.iteritems()):
+        if engine == 'grid':
+            continue
+        time_measures = [time_measure for time_measure in TIME_MEASURES if
+                         engine != 'cube' or time_measure <= 7]
+        count_cols = ['all_nearby_{}{}'.format(count_type, time_measure) for
+                      count_type in ['count', 'fires'] for time_measure in
+                      time_measures]
+        mismatches = (counts_df[count_cols].values !=
+                      counts_dfs['grid'][count_cols].values).any(axis=1).sum()
+        checks.append({'engine': engine, 'n_rows': n_rows,
+                       'count_cols': count_cols,
+                       'mismatched_rows': int(mismatches),
+                       'passed': bool(mismatches == 0)})
+
+    return checks
+
+def find_regressions(results, baseline):
+    """Compare the results against the baseline, and return any regressions.
+
+    Args:
+    ----
+        results: list of dcts
+        baseline: list of dcts
+
+    Return:
+    ------
+        regressions: list of dcts
+            Holds the case, the metric that regressed, and the baseline and
+            current values of it.
+    """
+
+    baseline_lookup = {(base['stage'], base['engine'], base['n_rows']): base
+                       for base in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_lookup.get((result['stage'], result['engine'],
+                                    result['n_rows']))
+        if base is None:
+            continue
+        for metric, min_diff in [('seconds', MIN_SECONDS_DIFF),
+                                 ('peak_rss_mb', MIN_RSS_MB_DIFF)]:
+            diff = result[metric] - base[metric]
+            if diff > REGRESSION_TOL * base[metric] and diff > min_diff:
+                regressions.append({'stage': result['stage'],
+                                    'engine': result['engine'],
+                                    'n_rows': result['n_rows'],
+                                    'metric': metric,
+                                    'baseline': base[metric],
+                                    'current': result[metric]})
+
+    return regressions
+
+def _put_case_result(queue, stage, engine, n_rows):
+    """Put the result of `run_case` (or the traceback it raised) on the queue."""
+
+    try:
+        queue.put(run_case(stage, engine, n_rows))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+def _add_synthetic_counts(df):
+    """Add nearby count columns (with random counts) for `calc_perc_fires`."""
+
+    rng = np.random.RandomState(24)
+    for time_measure in TIME_MEASURES:
+        all_nearby_counts = rng.poisson(5 + time_measure, df.shape[0]) + 1
+        df['all_nearby_count{}'.format(time_measure)] = all_nearby_counts
+        df['all_nearby_fires{}'.format(time_measure)] = \
+                rng.binomial(all_nearby_counts, 0.2)
+
+    return df
+
+def _get_peak_rss_mb():
+    """Return the peak RSS of the current process in MB (Linux reports KB)."""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:] if arg.isdigit()] or DEFAULT_SIZES
+    save_baseline = 'save_baseline' in sys.argv
+
+    cases = [('gen_nearby_fires_count', engine) for engine in
+             sorted(ENGINE_KWARGS)]
+    cases += [('_handle_date_percentiles', None), ('calc_perc_fires', None),
+              ('add_date_column', None)]
+    results = []
+    for n_rows in sizes:
+        for stage, engine in cases:
+            result = run_case_in_process(stage, engine, n_rows)
+            results.append(result)
+            print '{:>26} {:>14} {:>9} rows: {:8.2f}s {:>11.0f} rows/s ' \
+                    '{:8.1f} MB peak RSS'.format(stage, engine or '', n_rows,
+                    result['seconds'], result['rows_per_sec'],
+                    result['peak_rss_mb'])
+
+    checks = check_engine_equivalence(min(EQUIVALENCE_ROWS, max(sizes)))
+    for check in checks:
+        print 'Engine {} vs. grid: {} mismatched rows'.format(check['engine'],
+                check['mismatched_rows'])
+
+    regressions = []
+    if os.path.exists(BASELINE_FP):
+        with open(BASELINE_FP) as f:
+            regressions = find_regressions(results, json.load(f))
+        for regression in regressions:
+            print 'REGRESSION - {stage} {engine} {n_rows} rows: {metric} ' \
+                    'went from {baseline:.2f} to {current:.2f}' \
+                    .format(**regression)
+    else:
+        print 'No baseline found at {} (run with save_baseline to save one)' \
+                .format(BASELINE_FP)
+
+    if not os.path.exists(os.path.dirname(RESULTS_FP)):
+        os.makedirs(os.path.dirname(RESULTS_FP))
+    with open(RESULTS_FP, 'w+') as f:
+        json.dump({'results': results, 'equivalence_checks': checks,
+                   'regressions': regressions}, f, indent=2)
+    if save_baseline:
+        with open(BASELINE_FP, 'w+') as f:
+            json.dump(results, f, indent=2)
+
+    if regressions or not all(check['passed'] for check in checks):
+        sys.exit(1)
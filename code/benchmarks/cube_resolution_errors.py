@@ -0,0 +1,37 @@
+"""A small script for picking the raster cube resolution against accuracy. 
+
+This builds a `RasterCube` at a range of lat/long cell sizes over synthetic 
+detections, and prints how far its counts are from the exact (grid index) box 
+counts for a sample of the detections, along with the memory held by each 
+cube and the time it took to build and query it. 
+
+Usage (from the main folder of the repository): 
+
+    python code/benchmarks/cube_resolution_errors.py [n_rows] [dist_measure] [time_bin_days]
+"""
+
+import os
+import sys
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             '..', 'feature_engineering'))
+from raster_cube import cube_error_report
+from synthetic_detections import gen_detections
+
+TIME_MEASURES = [365, 730, 1095]
+
+if __name__ == '__main__': 
+    n_rows = int(sys.argv[1]) if len(sys.argv) >= 2 else 100000
+    dist_measure = float(sys.argv[2]) if len(sys.argv) >= 3 else 0.1
+    time_bin_days = int(sys.argv[3]) if len(sys.argv) >= 4 else 7
+    cell_sizes = [dist_measure * 2, dist_measure, dist_measure / 2]
+
+    df = gen_detections(n_rows, all_columns=False).drop_duplicates(['lat', 'long', 'date_fire'])
+    report_df = cube_error_report(df, dist_measure, TIME_MEASURES, cell_sizes, 
+                                  time_bin_days)
+
+    pd.set_option('display.width', 200)
+    print 'Rows: {}, dist_measure: {}, time_bin_days: {}'.format(n_rows, 
+            dist_measure, time_bin_days)
+    print report_df.to_string(index=False)
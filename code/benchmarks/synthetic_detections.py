@@ -0,0 +1,225 @@
+"""A module for generating synthetic tables of MODIS fire detections.
+
+The feature engineering code is written against the detections CSVs output
+from Postgres (see `create_inputs.py`), which take a full `make data` to
+produce. This module generates tables with the same columns, so that the
+feature engineering code can be timed and checked at any size (10k to 10M+
+rows) without them. The tables try to mimic the structure of the real data
+that matters for performance and for the nearby fires counts:
+
+    * Detections are clustered in lat/long and time - each belongs to a
+      fire "event" that burns for some number of days in a small area, event
+      sizes are heavy tailed, and events are spread across a handful of
+      fire-prone regions of the continental US.
+    * Each region has a fire season, so the density of detections varies
+      through the year.
+    * Detections only happen when a satellite passes over (Terra at ~10:30 and
+      22:30 local time, and Aqua at ~13:30 and 01:30), so `gmt` follows a
+      diurnal pattern that shifts with longitude.
+    * `fire_bool` is decided per event (an event either falls within a fire
+      perimeter or it doesn't), with `fire_rate` of the detections being fires
+      in expectation.
+
+The only function meant to be called externally is `gen_detections`.
+"""
+
+import numpy as np
+import pandas as pd
+
+# Holds (state_name, lat center, long center, lat sd, long sd, share of events,
+# peak day of year of the fire season).
+REGIONS = [('California', 37.5, -120.5, 2.5, 1.5, 0.20, 220),
+           ('Oregon', 44.5, -121., 1.5, 2., 0.12, 225),
+           ('Arizona', 34., -110.5, 2., 2.5, 0.10, 170),
+           ('Georgia', 32., -85., 2.5, 4., 0.30, 80),
+           ('Kansas', 38.5, -96.5, 1.5, 2., 0.16, 100),
+           ('Montana', 46.5, -113.5, 1.5, 2., 0.12, 225)]
+# Holds the local overpass hours of each satellite, day then night.
+OVERPASS_HOURS = {'T': (10.5, 22.5), 'A': (13.5, 1.5)}
+SRC_NAMES = ['gsfc', 'gsfc_drl', 'rsac', 'ssec', 'uaf']
+SRC_WEIGHTS = [0.45, 0.25, 0.15, 0.1, 0.05]
+
+def gen_detections(n_rows, fire_rate=0.2, n_years=4, seed=24, all_columns=True):
+    """Return a DataFrame of synthetic detections.
+
+    Args:
+    ----
+        n_rows: int
+        fire_rate (optional): float
+            Holds the expected fraction of detections with `fire_bool` True.
+        n_years (optional): int
+            Holds how many years (starting in 2012) to spread detections over.
+        seed (optional): int
+        all_columns (optional): bool
+            Holds whether to return every column of the detections CSVs, or
+            only `lat`, `long`, `gmt`, `date_fire`, and `fire_bool` (which is
+            quicker and lighter at large sizes).
+
+    Return:
+    ------
+        df: Pandas DataFrame
+            Holds the columns of the detections CSVs, plus the `date_fire`
+            column that `add_date_column` would add.
+    """
+
+    rng = np.random.RandomState(seed)
+    events = _gen_events(rng, n_rows, fire_rate, n_years)
+    # Bigger events get more of the detections.
+    event_idx = rng.choice(events['size'].shape[0], n_rows,
+                           p=events['size'] / events['size'].sum())
+
+    lat = events['lat'][event_idx] + \
+            rng.normal(0, 1, n_rows) * events['spread'][event_idx]
+    lng = events['long'][event_idx] + \
+            rng.normal(0, 1, n_rows) * events['spread'][event_idx]
+    days = events['start_day'][event_idx] + \
+            np.floor(rng.exponential(events['duration'][event_idx])) \
+            .astype(np.int64)
+    sat_src, gmt_minutes, day_shift = _gen_overpasses(rng, lng)
+    days += day_shift
+
+    date_fire = np.datetime64('2012-01-01', 'm') + \
+            (days * 1440 + gmt_minutes).astype('timedelta64[m]')
+    # Like the CSVs, `gmt` is an unpadded integer (e.g. 45 for 00:45).
+    gmt = (gmt_minutes // 60) * 100 + gmt_minutes % 60
+    df = pd.DataFrame({'lat': lat, 'long': lng, 'gmt': gmt,
+                       'date_fire': date_fire,
+                       'fire_bool': events['fire_bool'][event_idx]},
+                      columns=['lat', 'long', 'gmt', 'date_fire', 'fire_bool'])
+
+    if all_columns:
+        df = _add_detection_cols(df, rng, events, event_idx, sat_src)
+
+    return df
+
+def _gen_events(rng, n_rows, fire_rate, n_years):
+    """Generate the fire events that detections are clustered around.
+
+    This is a helper function called from `gen_detections`.
+
+    Args:
+    ----
+        rng: np.random.RandomState
+        n_rows: int
+        fire_rate: float
+        n_years: int
+
+    Return:
+    ------
+        events: dct of 1d np.ndarrays
+            Holds the `size` (relative number of detections), `lat`, `long`,
+            `spread` (sd in degrees), `start_day` (days since 2012-01-01),
+            `duration` (mean days of burning), `region` index, and `fire_bool`
+            of each event.
+    """
+
+    n_events = max(n_rows // 40, 1)
+    region_shares = np.array([params[5] for params in REGIONS])
+    region_params = np.array([params[1:5] + params[6:] for params in REGIONS])
+    region = rng.choice(len(REGIONS), n_events,
+                        p=region_shares / region_shares.sum())
+    lat_center, long_center, lat_sd, long_sd, peak_day = region_params[region].T
+
+    size = rng.pareto(1.5, n_events) + 1.
+    # A fifth of events happen out of season (e.g. agricultural burns).
+    in_season = rng.rand(n_events) < 0.8
+    day_of_year = np.where(in_season, peak_day + rng.normal(0, 40, n_events),
+                           rng.uniform(0, 365, n_events))
+    start_day = rng.randint(0, n_years, n_events) * 365 + \
+            np.mod(day_of_year, 365).astype(np.int64)
+
+    events = {'size': size,
+              'lat': np.clip(lat_center + rng.normal(0, 1, n_events) * lat_sd,
+                             25., 49.),
+              'long': np.clip(long_center + rng.normal(0, 1, n_events) * long_sd,
+                              -124.5, -67.),
+              'spread': 0.01 * size ** 0.3,
+              'start_day': start_day,
+              'duration': 0.5 + np.sqrt(size),
+              'region': region,
+              'fire_bool': rng.rand(n_events) < fire_rate}
+
+    return events
+
+def _gen_overpasses(rng, lng):
+    """Generate the satellite and GMT time of each detection.
+
+    This is a helper function called from `gen_detections`.
+
+    Args:
+    ----
+        rng: np.random.RandomState
+        lng: 1d np.ndarray
+
+    Return:
+    ------
+        sat_src: 1d np.ndarray
+            Holds 'T' (Terra) or 'A' (Aqua) for each detection.
+        gmt_minutes: 1d np.ndarray
+            Holds the minutes past midnight GMT of each detection.
+        day_shift: 1d np.ndarray
+            Holds how many days the GMT date is ahead of the local date.
+    """
+
+    n_rows = lng.shape[0]
+    sat_src = np.where(rng.rand(n_rows) < 0.5, 'T', 'A')
+    # Fires are hotter (and so detected more often) during the day.
+    is_day = rng.rand(n_rows) < 0.75
+    local_hours = np.zeros(n_rows)
+    for sat, (day_hour, night_hour) in OVERPASS_HOURS.iteritems():
+        is_sat = sat_src == sat
+        local_hours[is_sat] = np.where(is_day[is_sat], day_hour, night_hour)
+    local_hours += rng.normal(0, 0.6, n_rows)
+
+    # Granules are 5 minutes long.
+    gmt_hours = local_hours - lng / 15.
+    gmt_minutes = (np.round(gmt_hours * 12) * 5).astype(np.int64)
+    day_shift = gmt_minutes // 1440
+
+    return sat_src, gmt_minutes % 1440, day_shift
+
+def _add_detection_cols(df, rng, events, event_idx, sat_src):
+    """Add the remaining columns of the detections CSVs to the df.
+
+    This is a helper function called from `gen_detections`.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        rng: np.random.RandomState
+        events: dct of 1d np.ndarrays
+        event_idx: 1d np.ndarray
+            Holds the event each detection belongs to.
+        sat_src: 1d np.ndarray
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    n_rows = df.shape[0]
+    fire_bool = df['fire_bool'].values
+    scan = rng.uniform(1., 4.8, n_rows)
+
+    df['date'] = df['date_fire'].values.astype('datetime64[D]').astype(str)
+    df['temp'] = 305. + rng.gamma(2., 8., n_rows) + 10. * fire_bool
+    df['spix'] = np.round(scan, 1)
+    df['tpix'] = np.round(0.8 + 0.25 * scan, 1)
+    df['src'] = np.array(SRC_NAMES)[rng.choice(len(SRC_NAMES), n_rows,
+                                               p=SRC_WEIGHTS)]
+    df['sat_src'] = sat_src
+    df['conf'] = np.clip(rng.normal(60, 20, n_rows) + 20 * fire_bool, 0, 100) \
+            .astype(np.int64)
+    df['frp'] = np.round(rng.lognormal(3. + fire_bool, 1., n_rows), 1)
+    df['urban_areas_bool'] = rng.rand(n_rows) < 0.05
+
+    # County land/water areas are per event, since events are so small.
+    event_aland = rng.lognormal(21., 1., events['size'].shape[0])
+    event_awater = event_aland * rng.lognormal(-4., 1.5,
+                                               events['size'].shape[0])
+    df['county_aland'] = event_aland[event_idx]
+    df['county_awater'] = event_awater[event_idx]
+    df['state_name'] = np.array([params[0] for params in REGIONS]) \
+            [events['region'][event_idx]]
+
+    return df
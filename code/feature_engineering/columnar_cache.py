@@ -0,0 +1,441 @@
+"""A module for caching CSVs in a typed, columnar format.
+
+Parsing the yearly detections CSVs with `pd.read_csv` is slow (and has to be
+redone on every run of `create_inputs.py`). The first time a CSV is read
+through `read_csv_cached`, it's parsed as usual and each of its columns is
+saved to its own `.npy` file in a cache folder. Later reads load the columns
+straight from those files (only the ones asked for), which is a small fraction
+of the cost of parsing the CSV. Several CSVs with the same columns (e.g. a
+number of years) can be read at once with `read_csvs_cached`, which builds any
+missing caches in parallel and then copies each CSV's columns straight into
+their place in a single, preallocated DataFrame.
+
+Numeric and boolean columns are saved as is. Object (string) columns are saved
+as integer codes into their unique values (-1 for missing values), with the
+unique values themselves pickled alongside the cache's metadata. The metadata
+also holds the size and modification time of the CSV the cache was built
+from, and the cache is rebuilt whenever either of those changes.
+"""
+
+import os
+import shutil
+import pickle
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+
+META_FILENAME = 'meta.pkl'
+
+def read_csv_cached(filepath, columns=None, cache_dir=None, csv_kwargs=None):
+    """Read a CSV into a DataFrame, through a columnar cache of it.
+
+    Args:
+    ----
+        filepath: str
+        columns (optional): list of strs
+            Holds the columns to load (all of them if None).
+        cache_dir (optional): str
+            Holds the folder to keep the cache in (a `cache` folder next to
+            the CSV if None).
+        csv_kwargs (optional): dct
+            Holds the keywords to pass to `pd.read_csv` when (re)building
+            the cache.
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    csv_kwargs = csv_kwargs or {}
+    cache_path = _get_cache_path(filepath, cache_dir)
+
+    meta = load_meta(cache_path)
+    if _is_stale(meta, filepath, csv_kwargs):
+        df = pd.read_csv(filepath, **csv_kwargs)
+        write_cache(df, cache_path, _get_csv_meta(filepath, csv_kwargs))
+        return df if columns is None else df[columns]
+
+    return load_cache(cache_path, meta, columns)
+
+def read_csvs_cached(filepaths, columns=None, cache_dir=None, csv_kwargs=None,
+                     n_jobs=1):
+    """Read a number of CSVs into one DataFrame, through columnar caches.
+
+    This gives the same DataFrame as reading each CSV with `read_csv_cached`
+    and concatenating them (with `ignore_index=True`), but without holding two
+    copies of the data. Any caches that need to be (re)built are built in
+    separate processes, and the columns are then copied into the combined
+    DataFrame by a pool of threads (numpy releases the GIL while copying).
+
+    Args:
+    ----
+        filepaths: list of strs
+        columns (optional): list of strs
+            Holds the columns to load (all of the first CSV's if None).
+        cache_dir (optional): str
+        csv_kwargs (optional): dct
+        n_jobs (optional): int
+            Holds how many processes/threads to use (-1 for all cores).
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    csv_kwargs = csv_kwargs or {}
+    n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+    cache_paths = [_get_cache_path(filepath, cache_dir) for filepath in
+                   filepaths]
+
+    stale_args = [(filepath, cache_path, csv_kwargs) for filepath, cache_path
+                  in zip(filepaths, cache_paths) if
+                  _is_stale(load_meta(cache_path), filepath, csv_kwargs)]
+    if n_jobs > 1 and len(stale_args) > 1:
+        pool = multiprocessing.Pool(min(n_jobs, len(stale_args)))
+        pool.map(_build_cache, stale_args)
+        pool.close()
+        pool.join()
+    else:
+        map(_build_cache, stale_args)
+
+    metas = [load_meta(cache_path) for cache_path in cache_paths]
+    columns = metas[0]['columns'] if columns is None else columns
+    for cache_path, meta in zip(cache_paths, metas):
+        _check_columns(meta, columns)
+
+    # Memory map the columns, which gives their dtypes and lengths without
+    # reading them in.
+    col_arrays = [{col: _load_col(cache_path, meta, col, mmap_mode='r')
+                   for col in columns}
+                  for cache_path, meta in zip(cache_paths, metas)]
+    n_rows = [col_arrays[file_idx][columns[0]].shape[0] if columns else 0
+              for file_idx in xrange(len(filepaths))]
+    row_begs = np.cumsum([0] + n_rows)
+
+    col_dtypes = {col: _get_combined_dtype([np.dtype(object) if col in
+                                            meta['categories'] else
+                                            arrays[col].dtype for meta, arrays
+                                            in zip(metas, col_arrays)])
+                  for col in columns}
+    df = pd.DataFrame({col: np.empty(row_begs[-1], dtype=col_dtypes[col])
+                       for col in columns}, columns=columns)
+    # After the DataFrame is built, the values of each column are views into
+    # its blocks, so filling them in fills in the DataFrame.
+    col_values = {col: df[col].values for col in columns}
+
+    copy_args = [(col_values[col][row_begs[file_idx]:row_begs[file_idx + 1]],
+                  col_arrays[file_idx][col],
+                  metas[file_idx]['categories'].get(col, None))
+                 for file_idx in xrange(len(filepaths)) for col in columns]
+    if n_jobs > 1:
+        pool = ThreadPool(n_jobs)
+        pool.map(_copy_col, copy_args)
+        pool.close()
+        pool.join()
+    else:
+        map(_copy_col, copy_args)
+
+    return df
+
+def write_cache(df, cache_path, extra_meta=None):
+    """Save each of the df's columns to its own file in `cache_path`.
+
+    The cache is written to a temporary folder and then moved into place, so
+    that a reader never sees a half written cache.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        cache_path: str
+        extra_meta (optional): dct
+            Holds anything else to save in the cache's metadata (e.g. the
+            size and modification time of the CSV the df was read from).
+    """
+
+    cache_writer = CacheWriter(cache_path, df.shape[0])
+    cache_writer.write_chunk(df, 0)
+    cache_writer.close(extra_meta)
+
+class CacheWriter(object):
+    """Write a cache chunk by chunk, without holding all of it in memory.
+
+    Each column is memory mapped to its `.npy` file up front (once the first
+    chunk gives the columns and their dtypes), and every chunk is written
+    straight into its rows. Object columns are coded as they come in, with the
+    codes given in order of first appearance (just as `pd.factorize` would on
+    the whole column). Categorical columns are saved as their codes, and need
+    the same categories in every chunk. The cache is only moved into place on
+    `close`.
+
+    Args:
+    ----
+        cache_path: str
+        n_rows: int
+            Holds the number of rows the cache will have in total.
+    """
+
+    def __init__(self, cache_path, n_rows):
+        self.cache_path = cache_path
+        self.n_rows = n_rows
+        parent_dir = os.path.dirname(cache_path)
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        self.tmp_path = tempfile.mkdtemp(dir=parent_dir)
+        self.columns = None
+        self.col_arrays = {}
+        # Holds the codes given to each value of each object column.
+        self.category_codes = {}
+        # Holds the categories of each categorical column.
+        self.categoricals = {}
+
+    def write_chunk(self, df, row_beg):
+        """Write the df into the rows of the cache starting at `row_beg`.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+                Holds the same columns (with the same dtypes) as every other
+                chunk.
+            row_beg: int
+        """
+
+        if self.columns is None:
+            self._open_columns(df)
+        elif list(df.columns) != self.columns:
+            raise RuntimeError('Every chunk written to a cache needs the same '
+                               'columns')
+
+        row_end = row_beg + df.shape[0]
+        for col in self.columns:
+            values = df[col].values
+            if col in self.category_codes:
+                values = self._encode_categories(col, values)
+            elif col in self.categoricals:
+                if list(values.categories) != self.categoricals[col]:
+                    raise RuntimeError('The column {} has different categories '
+                                       'than in earlier chunks'.format(col))
+                values = values.codes
+            elif values.dtype != self.col_arrays[col].dtype:
+                raise RuntimeError('The column {} has a different dtype than '
+                                   'in earlier chunks'.format(col))
+            self.col_arrays[col][row_beg:row_end] = values
+
+    def close(self, extra_meta=None):
+        """Flush the columns to disk, and move the cache into place.
+
+        Args:
+        ----
+            extra_meta (optional): dct
+                Holds anything else to save in the cache's metadata.
+        """
+
+        for col_idx, col in enumerate(self.columns or []):
+            col_array = self.col_arrays.pop(col)
+            if isinstance(col_array, np.memmap):
+                col_array.flush()
+            else:
+                np.save(self._get_col_fp(col_idx), col_array)
+            del col_array
+
+        categories = {col: sorted(codes, key=codes.get) for col, codes in
+                      self.category_codes.iteritems()}
+        meta = dict(extra_meta or {}, columns=self.columns or [],
+                    categories=categories, categoricals=self.categoricals)
+        with open(os.path.join(self.tmp_path, META_FILENAME), 'w+') as f:
+            pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if os.path.exists(self.cache_path):
+            shutil.rmtree(self.cache_path)
+        os.rename(self.tmp_path, self.cache_path)
+
+    def _open_columns(self, df):
+        """Create the file of each column, given the first chunk."""
+
+        self.columns = list(df.columns)
+        for col_idx, col in enumerate(self.columns):
+            dtype = df[col].dtype
+            if dtype == object:
+                self.category_codes[col] = {}
+                dtype = np.dtype(np.int32)
+            elif pd.api.types.is_categorical_dtype(dtype):
+                self.categoricals[col] = list(df[col].cat.categories)
+                dtype = df[col].cat.codes.dtype
+            # Empty files can't be memory mapped.
+            if self.n_rows:
+                self.col_arrays[col] = np.lib.format.open_memmap(
+                        self._get_col_fp(col_idx), mode='w+', dtype=dtype,
+                        shape=(self.n_rows,))
+            else:
+                self.col_arrays[col] = np.empty(0, dtype=dtype)
+
+    def _encode_categories(self, col, values):
+        """Return the codes of the values of an object column (-1 for NaN)."""
+
+        chunk_codes, uniques = pd.factorize(values)
+        codes = self.category_codes[col]
+        unique_codes = np.array([codes.setdefault(value, len(codes)) for value
+                                 in uniques] + [-1], dtype=np.int32)
+
+        return unique_codes[chunk_codes]
+
+    def _get_col_fp(self, col_idx):
+        """Return the filepath of a column's `.npy` file."""
+
+        return os.path.join(self.tmp_path, '{}.npy'.format(col_idx))
+
+def load_cache(cache_path, meta=None, columns=None, rows=None):
+    """Load the given columns (and rows) of a cache into a DataFrame.
+
+    Args:
+    ----
+        cache_path: str
+        meta (optional): dct
+            Holds the metadata of the cache (see `write_cache`), which is
+            loaded from the cache if not passed.
+        columns (optional): list of strs
+            Holds the columns to load (all of them if None).
+        rows (optional): slice
+            Holds the rows to load (all of them if None). Only these rows are
+            read from disk (through memory maps).
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    meta = load_meta(cache_path) if meta is None else meta
+    columns = meta['columns'] if columns is None else columns
+    _check_columns(meta, columns)
+
+    col_values = {}
+    for col in columns:
+        if rows is None:
+            values = _load_col(cache_path, meta, col)
+        else:
+            values = np.array(_load_col(cache_path, meta, col,
+                                        mmap_mode='r')[rows])
+        if col in meta['categories']:
+            values = _decode_categories(values, meta['categories'][col])
+        elif col in meta.get('categoricals', {}):
+            values = pd.Categorical.from_codes(values,
+                                               meta['categoricals'][col])
+        col_values[col] = values
+
+    return pd.DataFrame(col_values, columns=columns)
+
+def load_meta(cache_path):
+    """Load the metadata of the cache (None if there isn't a cache)."""
+
+    try:
+        with open(os.path.join(cache_path, META_FILENAME)) as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _build_cache(args):
+    """Read a CSV and write its cache.
+
+    This is the function multiprocessed from `read_csvs_cached`.
+
+    Args:
+    ----
+        args: tuple
+            Holds the filepath of the CSV, the cache path, and the keywords to
+            pass to `pd.read_csv`.
+    """
+
+    filepath, cache_path, csv_kwargs = args
+    write_cache(pd.read_csv(filepath, **csv_kwargs), cache_path,
+                _get_csv_meta(filepath, csv_kwargs))
+
+def _copy_col(args):
+    """Copy (and decode, if needed) a cached column into its place.
+
+    This is the function run in threads from `read_csvs_cached`.
+
+    Args:
+    ----
+        args: tuple
+            Holds the slice of the combined column to fill, the (memory
+            mapped) cached column, and its categories (None if it isn't an
+            object column).
+    """
+
+    out_values, values, categories = args
+    if categories is not None:
+        values = _decode_categories(values, categories)
+    out_values[:] = values
+
+def _decode_categories(codes, categories):
+    """Map integer codes back to their values (with NaN for -1)."""
+
+    values = np.empty(codes.shape[0], dtype=object)
+    values[:] = np.nan
+    is_present = codes >= 0
+    values[is_present] = np.asarray(categories, dtype=object)[codes[is_present]]
+
+    return values
+
+def _get_combined_dtype(dtypes):
+    """Return the dtype of a column that holds values of each of the dtypes.
+
+    This mimics `pd.concat`, which only upcasts numbers to other numbers
+    (e.g. bools and floats combine into objects, not floats).
+    """
+
+    if all(dtype == dtypes[0] for dtype in dtypes):
+        return dtypes[0]
+    if all(dtype.kind in 'iuf' for dtype in dtypes):
+        return np.result_type(*dtypes)
+
+    return np.dtype(object)
+
+def _load_col(cache_path, meta, col, mmap_mode=None):
+    """Load a single cached column (as codes, if it's an object column)."""
+
+    col_idx = meta['columns'].index(col)
+
+    return np.load(os.path.join(cache_path, '{}.npy'.format(col_idx)),
+                   mmap_mode=mmap_mode)
+
+def _check_columns(meta, columns):
+    """Raise an error if any of the columns aren't in the cache."""
+
+    missing_cols = set(columns) - set(meta['columns'])
+    if missing_cols:
+        raise RuntimeError('The columns {} are not in the cached CSV'
+                           .format(sorted(missing_cols)))
+
+def _get_cache_path(filepath, cache_dir=None):
+    """Return the folder that holds the cache of the CSV.
+
+    The caches are kept in a `cache` folder next to the CSV if no `cache_dir`
+    is given.
+    """
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(filepath), 'cache')
+
+    return os.path.join(cache_dir,
+                        os.path.splitext(os.path.basename(filepath))[0])
+
+def _is_stale(meta, filepath, csv_kwargs):
+    """Return whether the cache needs to be (re)built."""
+
+    return meta is None or meta['source_stat'] != _get_source_stat(filepath) \
+            or meta['csv_kwargs'] != csv_kwargs
+
+def _get_csv_meta(filepath, csv_kwargs):
+    """Return the metadata that tells whether a CSV's cache is stale."""
+
+    return {'source_stat': _get_source_stat(filepath),
+            'csv_kwargs': csv_kwargs}
+
+def _get_source_stat(filepath):
+    """Return the size and modification time of the file."""
+
+    stat = os.stat(filepath)
+
+    return stat.st_size, stat.st_mtime
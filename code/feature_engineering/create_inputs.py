@@ -1,35 +1,264 @@
 """A module used to drive the feature engineering/data processing process. 
 
 This module drives the feature engineering/data processing process by calling 
-other functions from other modules. It's only function is one that is simply 
+other functions from other modules. Its only functions are ones that are simply 
 used to load in all the data before performing feature engineering/data 
-processing. 
+processing, and to tell the featurization graph (see `featurization_dag.py`) 
+what each transformation reads. 
+
+When a new day of detections comes in, it can be added to the featurized 
+output without rerunning everything, by passing `update` and the filepath of a 
+CSV of the new detections (e.g. `python create_inputs.py geo time update 
+new_day.csv`). The nearby fires counts are updated through the table saved by 
+the last full run (see `nearby_table.py`), which only counts for the new rows 
+and for any earlier rows that count a new row as nearby. Only those rows are 
+featurized - the new rows are appended to the output, and the counts (and 
+percent of fires) of the earlier rows are replaced in place. The output is the 
+same as a full run over all of the rows (with the new rows last), as long as 
+the new detections are later than those already featurized, and don't bring 
+any new dummy categories (e.g. a new year). The new detections should also be 
+added to their year's CSV, so that a later full run includes them. 
 """
 
+import numpy as np
 import pandas as pd
+import os
+import re
 import sys
+import time
 import pickle
-from general_featurization import return_all_dummies, create_new_col
-from time_featurization import add_date_column
-from geo_featurization import gen_nearby_fires_count, calc_perc_fires
+import shutil
+import tempfile
+from StringIO import StringIO
+from general_featurization import return_all_dummies, create_new_col, \
+        create_new_cols, get_dummies_categories
+from time_featurization import add_date_column, TEMPORAL_FEATURES
+from geo_featurization import gen_nearby_fires_count, add_perc_fires, \
+        update_nearby_fires_count
+from spatial_tiles import gen_nearby_fires_count_tiled
+from columnar_cache import read_csv_cached, read_csvs_cached
+from featurization_dag import FeaturizationGraph
+from dtype_compaction import compact_dtypes
+from stage_report import StageReport, set_active_report
+from one_hot import OneHotVocab
+
+# Give the dtypes of the columns we know up front, rather than have pandas infer 
+# them from the CSVs. 
+DETECTION_DTYPES = {'lat': np.float64, 'long': np.float64, 'fire_bool': bool, 
+        'urban_areas_bool': bool}
+CSV_KWARGS = {'true_values': ['t'], 'false_values': ['f'], 'index_col': False, 
+        'dtype': DETECTION_DTYPES}
+NEARBY_FIRES_INPUT_COLS = ['lat', 'long', 'date_fire', 'fire_bool']
+# The columns that identify a row whose nearby fires counts were updated. 
+NEARBY_FIRES_KEY_COLS = ['lat', 'long', 'date_fire']
+# The float columns kept as float64 when compacting (the nearby fires counts 
+# compare distances between them, which float32 could shift across the edge 
+# of a box). 
+EXACT_FLOAT_COLS = ['lat', 'long']
+FEATURIZATION_CACHE_DIR = 'code/modeling/model_input/featurization_cache'
+# The transformations that only look at one row at a time, which are run chunk by 
+# chunk using at most (roughly) MAX_CHUNK_MB of memory at once. 
+ROW_LOCAL_TRANSFORMATIONS = ['all_dummies', 'create_new_col', 'create_new_cols']
+MAX_CHUNK_MB = 512
+# The categories dummied for each column, which are kept from run to run (and 
+# read by the modeling code) so that the dummy columns never change. 
+DUMMIES_VOCAB_FP = 'code/modeling/model_input/dummies_vocab.pkl'
+# The timing and memory of each stage of a run is reported in a JSON file here 
+# (named by when the run started), so that runs can be compared over time. 
+STAGE_REPORT_DIR = 'code/modeling/model_input/stage_reports'
+# The number of rows of the featurized output read at once when updating it. 
+UPDATE_CHUNK_ROWS = 100000
 
-def get_df(year): 
+def get_df(year, columns=None): 
     """Read a year of data into a Dataframe and return it. 
 
+    The CSV is only parsed the first time it's read (or after it changes) - 
+    after that, the columns are loaded from a columnar cache of it (see 
+    `columnar_cache.py`). 
+
     Args: 
     ----
         year: int
+        columns (optional): list of strs
+            Holds the columns to load (all of them if None). 
     
     Return: 
     ------
         df: Pandas Dataframe
     """
 
-    filepath = 'data/csvs/detected_fires_MODIS_' + str(year) + '.csv'
-    df = pd.read_csv(filepath, true_values = ['t'], false_values=['f'], index_col=False)
+    df = read_csv_cached(get_filepath(year), columns, csv_kwargs=CSV_KWARGS)
+
+    return df
+
+def get_years_df(year_list, columns=None, n_jobs=-1): 
+    """Read all the years of data into a single Dataframe and return it. 
+
+    The years are read in parallel, and straight into the combined Dataframe 
+    (see `columnar_cache.read_csvs_cached`), rather than read one by one and 
+    then concatenated. 
+
+    Args: 
+    ----
+        year_list: list of ints
+        columns (optional): list of strs
+            Holds the columns to load (all of them if None). 
+        n_jobs (optional): int
+            Holds how many processes/threads to read with (-1 for all cores). 
+
+    Return: 
+    ------
+        df: Pandas Dataframe
+    """
+
+    df = read_csvs_cached([get_filepath(year) for year in year_list], columns, 
+            csv_kwargs=CSV_KWARGS, n_jobs=n_jobs)
 
     return df
 
+def get_filepath(year): 
+    """Return the filepath of a year of data. 
+
+    Args: 
+    ----
+        year: int
+
+    Return: 
+    ------
+        filepath: str
+    """
+
+    filepath = 'data/csvs/detected_fires_MODIS_' + str(year) + '.csv'
+
+    return filepath
+
+def get_input_cols(transform_kwargs): 
+    """Return the columns that a transformation reads. 
+
+    Args: 
+    ----
+        transform_kwargs: dct
+            Holds the entry for the transformation in one of the transforms 
+            dictionaries (see `make_columns_dict.py`). 
+
+    Return: 
+    ------
+        input_cols: list of strs or function
+            Holds the columns, or a function that picks them out of the list 
+            of available columns (see `FeaturizationGraph.add_node`). 
+    """
+
+    transformation = transform_kwargs['transformation']
+    if transformation == 'all_dummies': 
+        col = transform_kwargs['col']
+        # The year and month are pulled out of the `date_fire` column, unless 
+        # they were already added along with it (see `add_date_column`). 
+        if col in ['year', 'month']: 
+            return lambda cols: [col] if col in cols else ['date_fire']
+        return [col]
+    if transformation in ['create_new_col', 'create_new_cols']: 
+        new_cols = transform_kwargs.get('new_cols', [transform_kwargs])
+        names = set()
+        for new_col in new_cols: 
+            names.update(re.findall(r'[A-Za-z_]\w*', new_col['eval_string']))
+            names.update(new_col.get('delete_columns') or [])
+        return lambda cols: [col for col in cols if col in names]
+    if transformation in ['add_nearby_fires', 'add_nearby_fires_tiled']: 
+        return NEARBY_FIRES_INPUT_COLS
+    if transformation == 'perc_fires': 
+        return lambda cols: [col for col in cols if col.startswith('all_nearby_')]
+
+    raise RuntimeError('No input columns are known for the transformation {}'
+            .format(transformation))
+
+def batch_new_cols(transforms_dict): 
+    """Combine all of the `create_new_col` transformations into one. 
+
+    The combined transformation (`create_new_cols`) evaluates every expression 
+    in a single pass, and drops all of their `delete_columns` once at the end. 
+    The expressions are evaluated in the order of their keys in the 
+    transforms dictionary. 
+
+    Args: 
+    ----
+        transforms_dict: dct
+            Holds the transformations (see `make_columns_dict.py`). 
+
+    Return: 
+    ------
+        transforms_dict: dct
+            Holds the other transformations as they were, along with the 
+            combined one (under the `create_new_cols` key). 
+    """
+
+    new_col_keys = sorted(k for k, v in transforms_dict.iteritems() if 
+            v['transformation'] == 'create_new_col')
+    if not new_col_keys: 
+        return transforms_dict
+
+    new_cols = [{key: val for key, val in transforms_dict[k].iteritems() 
+        if key != 'transformation'} for k in new_col_keys]
+    transforms_dict = {k: v for k, v in transforms_dict.iteritems() if k not in 
+            new_col_keys}
+    transforms_dict['create_new_cols'] = {'transformation': 'create_new_cols', 
+            'new_cols': new_cols}
+
+    return transforms_dict
+
+def update_output_csv(output_fp, new_df, updated_df): 
+    """Replace the updated rows of the featurized output, and add the new rows. 
+
+    The rows of the output are matched to their updates by their lat/long/
+    date_fire. It's read chunk by chunk as text, so that every value that 
+    isn't replaced is written back exactly as it was, and the replaced values 
+    are written just as `to_csv` would write them in a full run. If no earlier 
+    rows were updated, the new rows are simply appended to the output. 
+
+    Args: 
+    ----
+        output_fp: str
+            Holds the filepath of the featurized output of the last full run. 
+        new_df: Pandas DataFrame
+            Holds the featurized new rows. 
+        updated_df: Pandas DataFrame
+            Holds the lat/long/date_fire of each earlier row to update, along 
+            with the columns to replace (and their values). 
+    """
+
+    columns = list(pd.read_csv(output_fp, nrows=0).columns)
+    if sorted(new_df.columns) != sorted(columns): 
+        raise RuntimeError('The new rows have different columns than {} - rerun '
+                'without update'.format(output_fp))
+    new_df = new_df[columns]
+    if updated_df.shape[0] == 0: 
+        new_df.to_csv(output_fp, index=False, header=False, mode='a')
+        return
+
+    value_cols = [col for col in updated_df.columns if col not in 
+            NEARBY_FIRES_KEY_COLS]
+    # Round trip the values through a CSV, so they're the text `to_csv` writes. 
+    values_df = pd.read_csv(StringIO(updated_df[value_cols].to_csv(index=False)), 
+            dtype=str, keep_default_na=False)
+    updated_index = pd.MultiIndex.from_arrays([updated_df[col].values for col 
+        in NEARBY_FIRES_KEY_COLS])
+
+    tmp_fp = '{}.tmp{}'.format(output_fp, os.getpid())
+    chunks = pd.read_csv(output_fp, dtype=str, keep_default_na=False, 
+            chunksize=UPDATE_CHUNK_ROWS)
+    for chunk_num, chunk_df in enumerate(chunks): 
+        positions = updated_index.get_indexer(pd.MultiIndex.from_arrays([
+            chunk_df['lat'].values.astype(np.float64), 
+            chunk_df['long'].values.astype(np.float64), 
+            pd.to_datetime(chunk_df['date_fire'].values)]))
+        is_updated = positions >= 0
+        for col in value_cols: 
+            chunk_df.loc[is_updated, col] = \
+                    values_df[col].values[positions[is_updated]]
+        chunk_df.to_csv(tmp_fp, index=False, header=chunk_num == 0, 
+                mode='w' if chunk_num == 0 else 'a')
+    new_df.to_csv(tmp_fp, index=False, header=False, mode='a')
+    os.rename(tmp_fp, output_fp)
+
 if __name__ == '__main__': 
     try: 
 	with open('code/makefiles/year_list.pkl') as f: 
@@ -40,58 +269,158 @@ if __name__ == '__main__':
     
     # Assume that we haven't done any of the transformations unless we explicity tell it. 
     # geo = True will lead to geo. transformations being done, and time_bool = True will 
-    # lead to time transformations being done 
+    # lead to time transformations being done (along with the geo. ones, whose 
+    # outputs they're saved with). profile = True will attach a sampling profile 
+    # to each stage in the stage report. update = True will add the detections 
+    # in the CSV passed after `update` to the output of the last full run. 
     if len(sys.argv) >= 1: 
         geo = True if 'geo' in sys.argv else False
         time_bool = True if 'time' in sys.argv else False
+        profile = True if 'profile' in sys.argv else False
+        update = True if 'update' in sys.argv else False
+        if update and sys.argv.index('update') + 1 >= len(sys.argv): 
+            raise RuntimeError('Pass the filepath of the new detections after update')
+        new_detections_fp = sys.argv[sys.argv.index('update') + 1] if update \
+                else None
 
     # Create a dictionary that will hold all the transformations we'll peform on 
     # our data (key is the transformation and value is the function to apply). 
+    # The nearby fires counts can be calculated over the whole map at once, or 
+    # split up into spatial tiles that are each calculated in their own process. 
     featurization_dict = {'all_dummies': return_all_dummies, 
                             'create_new_col': create_new_col, 
-                            'add_nearby_fires': gen_nearby_fires_count
+                            'create_new_cols': create_new_cols, 
+                            'add_nearby_fires': gen_nearby_fires_count, 
+                            'add_nearby_fires_tiled': gen_nearby_fires_count_tiled, 
+                            'perc_fires': add_perc_fires
                          }
 
-    if geo: 
+    if geo or time_bool: 
         try: 
             with open('code/makefiles/geo_transforms_dict.pkl') as f: 
                 geo_transforms_dict = pickle.load(f)
-        except IOError: 
-            print "Make sure that you have run make_columns_dict.py in \
-                    code/makefiles in order to create the \
-                    geo_transforms_dict.pkl".format('\t', '')
-        
-        dfs_list = [get_df(year) for year in year_list] 
-        df = pd.concat(dfs_list, ignore_index=True)
-        df = add_date_column(df)
-        # Drop all observations that are in Canada (denoted by having a missing 
-        # value for any of the state/county info.)
-        df.dropna(axis=0, subset=['state_name'], inplace=True)
-        # Grab this before popping it in the function calls below. 
-        time_measures = geo_transforms_dict['add_nearby_fires']['time_measures']
-        for k, v in geo_transforms_dict.iteritems(): 
-            df = featurization_dict[v['transformation']](df, v)
-        df = calc_perc_fires(df, time_measures) 
-        df.to_csv('code/modeling/model_input/geo_done.csv', index=False)
-
-    if time_bool: 
-        try:
-            df = pd.read_csv('code/modeling/model_input/geo_done.csv', 
-                    parse_dates=['date_fire'], index_col=False)
-        except FileNotFoundError: 
-            print "You need to run create_inputs with the geo flag either \
-                    before or in conjuction with the time flag".format('\t', '')
-        try: 
             with open('code/makefiles/time_transforms_dict.pkl') as f:
                 time_transforms_dict = pickle.load(f)
         except IOError: 
             print "Make sure that you have run make_columns_dict.py in \
                     code/makefiles in order to create the \
-                    time_transforms_dict.pkl".format('\t', '')
+                    geo_transforms_dict.pkl and time_transforms_dict.pkl" \
+                    .format('\t', '')
+
+        # Each transformation is a node in a graph, whose output is cached (under 
+        # a hash of its inputs, keywords, and code), so that only the nodes that 
+        # changed since the last run are rerun. 
+        transforms_dict = dict(geo_transforms_dict)
+        transforms_dict['perc_fires'] = {'transformation': 'perc_fires', 
+                'time_measures': geo_transforms_dict['add_nearby_fires']['time_measures']}
+        if time_bool: 
+            transforms_dict.update(time_transforms_dict)
+        transforms_dict = batch_new_cols(transforms_dict)
+
+        stage_report = StageReport(profile)
+        set_active_report(stage_report)
+        report_fp = '{}/{}.json'.format(STAGE_REPORT_DIR, 
+                time.strftime('%Y%m%d_%H%M%S'))
+
+        output_fp = 'code/modeling/model_input/geo_time_done.csv' if time_bool \
+                else 'code/modeling/model_input/geo_done.csv'
+        if update and not os.path.exists(output_fp): 
+            raise RuntimeError('There is no {} to update - run without update '
+                    'first'.format(output_fp))
+
+        with stage_report.stage('load_csvs') as stage_entry: 
+            if update: 
+                df = pd.read_csv(new_detections_fp, **CSV_KWARGS)
+            else: 
+                df = get_years_df(year_list)
+            stage_entry['n_rows_out'] = df.shape[0]
+        with stage_report.stage('add_date_column', df.shape[0]) as stage_entry: 
+            # The temporal features are made in the same pass as `date_fire`. 
+            df = add_date_column(df, TEMPORAL_FEATURES if time_bool else None)
+            # Drop all observations that are in Canada (denoted by having a 
+            # missing value for any of the state/county info.)
+            df.dropna(axis=0, subset=['state_name'], inplace=True)
+            # The index isn't written out, so a RangeIndex (which takes no 
+            # memory per row) is all that's needed. 
+            df.reset_index(drop=True, inplace=True)
+            stage_entry['n_rows_out'] = df.shape[0]
 
-        for k, v in time_transforms_dict.iteritems(): 
-            df = featurization_dict[v['transformation']](df, v)
+        dummies_vocab = OneHotVocab.load(DUMMIES_VOCAB_FP)
+        if update: 
+            # A new dummy category would add a column to every row of the 
+            # output, so it needs a full run. This is checked before the table 
+            # of nearby fires counts is updated, so that it's left as it was. 
+            for k, v in transforms_dict.iteritems(): 
+                if v['transformation'] != 'all_dummies': 
+                    continue
+                new_categories = set(get_dummies_categories(df, v['col'])) - \
+                        set(dummies_vocab.get_categories(v['col']))
+                if new_categories: 
+                    raise RuntimeError('The new detections have new categories '
+                            '{} for {} - rerun without update'.format(
+                            sorted(new_categories), v['col']))
+            # The counts of the new rows are added to them here (rather than 
+            # in the graph), and the rows before them that count a new row as 
+            # nearby come back with their new counts. 
+            with stage_report.stage('update_nearby_fires', df.shape[0]) as \
+                    stage_entry: 
+                df, updated_df = update_nearby_fires_count(df, 
+                        {'table_dir': transforms_dict['add_nearby_fires'].get('table_dir')})
+                stage_entry['n_rows_out'] = df.shape[0]
+                stage_entry['n_rows_updated'] = updated_df.shape[0]
+        # Store each column (and each node's output below) in the most compact 
+        # dtype that holds its values. How much memory that saved is shown for 
+        # the featurized output once it's written. 
+        with stage_report.stage('compact_dtypes', df.shape[0]) as stage_entry: 
+            df = compact_dtypes(df, exact_cols=EXACT_FLOAT_COLS)
+            stage_entry['n_rows_out'] = df.shape[0]
 
-        df.to_csv('code/modeling/model_input/geo_time_done.csv', index=False)
+        # The new rows of an update are run through a graph of their own, 
+        # cached in a scratch folder (so they don't replace the caches of the 
+        # full run). 
+        cache_dir = tempfile.mkdtemp(prefix='featurization_update_') if update \
+                else FEATURIZATION_CACHE_DIR
+        graph = FeaturizationGraph(cache_dir, MAX_CHUNK_MB, compact=True)
+        for k, v in transforms_dict.iteritems(): 
+            if update and k == 'add_nearby_fires': 
+                continue
+            # Fix the categories to dummy up front (adding any new ones to the 
+            # saved vocabulary), so every chunk and every run gets the same 
+            # dummy columns. 
+            if v['transformation'] == 'all_dummies': 
+                dummies_vocab.update(v['col'], 
+                        get_dummies_categories(df, v['col']))
+                v = dict(v, categories=dummies_vocab.get_categories(v['col']))
+            depends_on = ['add_nearby_fires'] if k == 'perc_fires' and not \
+                    update else None
+            graph.add_node(k, featurization_dict[v['transformation']], v, 
+                    get_input_cols(v), depends_on, 
+                    v['transformation'] in ROW_LOCAL_TRANSFORMATIONS)
 
+        if update: 
+            try: 
+                df = graph.run(df)
+            finally: 
+                shutil.rmtree(cache_dir)
+            with stage_report.stage('update_output', df.shape[0]) as stage_entry: 
+                # The percent of fires of the updated rows is made (and 
+                # compacted) just as it is in the graph. 
+                perc_kwargs = transforms_dict['perc_fires']
+                updated_df = featurization_dict[perc_kwargs['transformation']](
+                        updated_df, dict(perc_kwargs))
+                value_cols = [col for col in updated_df.columns if col not in 
+                        NEARBY_FIRES_KEY_COLS]
+                updated_df = pd.concat([updated_df[NEARBY_FIRES_KEY_COLS], 
+                    compact_dtypes(updated_df[value_cols])], axis=1)
+                update_output_csv(output_fp, df, updated_df)
+                stage_entry['n_rows_out'] = df.shape[0] + updated_df.shape[0]
+        else: 
+            memory_report = graph.run_to_csv(df, output_fp, report_memory=True)
+            print memory_report.to_string()
+            dummies_vocab.save(DUMMIES_VOCAB_FP)
+        for name in graph.get_run_order(): 
+            print '{}: {}'.format(name, graph.run_statuses[name])
 
+        set_active_report(None)
+        stage_report.write(report_fp)
+        print 'Wrote the stage report to {}'.format(report_fp)
@@ -0,0 +1,237 @@
+"""A module for shrinking the memory a DataFrame takes.
+
+The detections data is read in with the dtypes pandas infers, which waste a
+lot of memory - strings (e.g. `state_name` or `src`) are stored as Python
+objects, and every integer is an int64. `compact_dtypes` converts each
+column to a more compact dtype that holds the same values:
+
+    * Strings with few unique values (relative to the number of rows) are
+      converted to categoricals.
+    * Python datetimes are converted to datetime64.
+    * Integers (counts, dummies, etc.) are downcast to the smallest integer
+      type that holds them (so 0/1 dummies end up as uint8).
+    * Floats are downcast to float32, which holds about 7 significant digits -
+      plenty for the features (and the models are fit on float32 anyway, see
+      `code/modeling/model_matrix.py`). Any columns whose exact values matter
+      (e.g. the lat/long that the nearby fires counts compare distances with)
+      can be kept as float64.
+
+Bools are left as is. The first two depend on the values of a column, so when
+a df is compacted chunk by chunk (e.g. the outputs of row-local nodes, see
+`featurization_dag.py`), only the changes that don't are made, so that every
+chunk gets the same dtypes.
+
+The memory saved can be seen column by column with `get_memory_report`. For a
+df that's never held in memory at once (e.g. the featurized output, which is
+written chunk by chunk), it can be tallied chunk by chunk instead, comparing
+each compacted chunk against the memory its values would take in the dtypes
+pandas gives them (`get_default_memory_usage` and `get_memory_usage`, see
+`build_memory_report`).
+"""
+
+import sys
+import numpy as np
+import pandas as pd
+
+def compact_dtypes(df, max_category_ratio=0.5, exact_cols=(), by_value=True):
+    """Convert each column of the df to the most compact dtype for its values.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        max_category_ratio (optional): float
+            Holds the most unique values (as a fraction of the number of rows)
+            a string column can have and still be converted to a categorical.
+        exact_cols (optional): iterable of strs
+            Holds the float columns to keep as float64.
+        by_value (optional): bool
+            Holds whether to make the changes that depend on the values of a
+            column (downcasting integers, and converting strings). Without
+            them, every chunk of a df gets the same dtypes.
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    exact_cols = set(exact_cols)
+    col_values = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object and by_value:
+            values = _compact_object_col(values, max_category_ratio)
+        elif values.dtype.kind in 'iu' and values.shape[0] and by_value:
+            downcast = 'unsigned' if values.min() >= 0 else 'integer'
+            values = pd.to_numeric(values, downcast=downcast)
+        elif values.dtype == np.float64 and col not in exact_cols:
+            values = values.astype(np.float32)
+        col_values[col] = values
+
+    df = pd.DataFrame(col_values, index=df.index, columns=df.columns)
+
+    return df
+
+def get_memory_report(before_df, after_df):
+    """Compare the memory each column takes before and after compacting.
+
+    Args:
+    ----
+        before_df: Pandas DataFrame
+        after_df: Pandas DataFrame
+
+    Return:
+    ------
+        memory_report: Pandas DataFrame
+            Holds the dtype and memory (in MB) of each column before and
+            after, along with how many times smaller it got. The last row
+            (`total`) holds the totals (including the index).
+    """
+
+    return build_memory_report(before_df.dtypes, after_df.dtypes,
+                               before_df.memory_usage(deep=True),
+                               after_df.memory_usage(deep=True))
+
+def build_memory_report(before_dtypes, after_dtypes, before_bytes, after_bytes):
+    """Compare the memory each column takes before and after compacting.
+
+    This is `get_memory_report` for the memory of a df tallied some other way
+    (e.g. chunk by chunk).
+
+    Args:
+    ----
+        before_dtypes: Pandas Series
+        after_dtypes: Pandas Series
+        before_bytes: Pandas Series
+            Holds the bytes of each column (and of the `Index`), as returned
+            by `df.memory_usage(deep=True)`.
+        after_bytes: Pandas Series
+
+    Return:
+    ------
+        memory_report: Pandas DataFrame
+    """
+
+    before_mb = before_bytes / 2. ** 20
+    after_mb = after_bytes.reindex(before_mb.index) / 2. ** 20
+    memory_report = pd.DataFrame({'before_dtype': before_dtypes.astype(str),
+                                  'after_dtype': after_dtypes.astype(str),
+                                  'before_mb': before_mb,
+                                  'after_mb': after_mb},
+                                 index=before_mb.index,
+                                 columns=['before_dtype', 'after_dtype',
+                                          'before_mb', 'after_mb'])
+    # The index has no dtype to report.
+    memory_report[['before_dtype', 'after_dtype']] = \
+            memory_report[['before_dtype', 'after_dtype']].fillna('')
+    memory_report.loc['total'] = ['', '', before_mb.sum(), after_mb.sum()]
+    memory_report['times_smaller'] = memory_report['before_mb'] / \
+            memory_report['after_mb'].replace(0, np.nan)
+
+    return memory_report
+
+def get_default_dtypes(df):
+    """Return the dtype pandas would give each column of the df by default.
+
+    That's int64 for integers, float64 for floats, and object for strings
+    (including categoricals) - the dtypes the columns had before compacting.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+
+    Return:
+    ------
+        dtypes: Pandas Series
+    """
+
+    dtypes = {}
+    for col in df.columns:
+        dtype = df[col].dtype
+        if dtype.kind in 'iu':
+            dtype = np.dtype(np.int64)
+        elif dtype.kind == 'f':
+            dtype = np.dtype(np.float64)
+        elif pd.api.types.is_categorical_dtype(dtype):
+            dtype = np.dtype(object)
+        dtypes[col] = dtype
+
+    return pd.Series(dtypes, index=df.columns)
+
+def get_default_memory_usage(df):
+    """Return the memory each column of the df would take in its default dtype
+    (see `get_default_dtypes`), without converting it.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+
+    Return:
+    ------
+        memory_usage: Pandas Series
+            Holds the bytes of each column (and of the `Index`), as
+            `df.memory_usage(deep=True)` would for the converted df.
+    """
+
+    memory_usage = df.memory_usage(deep=True)
+    for col in df.columns:
+        values = df[col]
+        if values.dtype.kind in 'iuf':
+            memory_usage[col] = values.shape[0] * 8
+        elif pd.api.types.is_categorical_dtype(values.dtype):
+            # Each row holds a pointer to a string (or a NaN for a missing
+            # value), as in `memory_usage(deep=True)` of an object column.
+            codes = values.cat.codes.values
+            str_sizes = np.array([sys.getsizeof(category) for category in
+                                  values.cat.categories] +
+                                 [sys.getsizeof(np.nan)], dtype=np.int64)
+            memory_usage[col] = values.shape[0] * 8 + str_sizes[codes].sum()
+
+    return memory_usage
+
+def get_memory_usage(df, count_categories=True):
+    """Return the memory each column of the df takes.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        count_categories (optional): bool
+            Holds whether to count the categories of the categoricals, along
+            with their codes. Every chunk of a df holds all of its
+            categories, so they should only be counted for one of them.
+
+    Return:
+    ------
+        memory_usage: Pandas Series
+            Holds the bytes of each column (and of the `Index`), as
+            `df.memory_usage(deep=True)`.
+    """
+
+    memory_usage = df.memory_usage(deep=True)
+    if not count_categories:
+        for col in df.columns:
+            if pd.api.types.is_categorical_dtype(df[col].dtype):
+                memory_usage[col] = df[col].cat.codes.values.nbytes
+
+    return memory_usage
+
+def _compact_object_col(values, max_category_ratio):
+    """Convert an object column to datetime64 or a categorical, if it can be.
+
+    Args:
+    ----
+        values: Pandas Series
+        max_category_ratio: float
+
+    Return:
+    ------
+        values: Pandas Series
+    """
+
+    inferred_type = pd.api.types.infer_dtype(values, skipna=True)
+    if inferred_type == 'datetime':
+        return pd.to_datetime(values)
+    if inferred_type in ['string', 'unicode'] and \
+            values.nunique() <= max_category_ratio * values.shape[0]:
+        return values.astype('category')
+
+    return values
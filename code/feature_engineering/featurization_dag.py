@@ -0,0 +1,544 @@
+"""A module for running the featurization steps as a graph of cached nodes.
+
+Each transformation (e.g. an entry in `geo_transforms_dict.pkl`) is added to
+a `FeaturizationGraph` as a node, along with the columns it reads and the
+nodes it depends on (those that output any of the columns it reads). Running
+the graph runs the nodes in dependency order, each on a DataFrame of only its
+input columns, and keeps only what each node changes - the columns it adds
+and the input columns it drops.
+
+The output of every node is cached (see `columnar_cache.py`) under a hash of
+its input columns (their names, dtypes, and values), its keywords, and the
+version of its code (the source of its module, and of any modules in the same
+folder that it uses). When the graph is rerun, any node whose hash hasn't
+changed loads its output from the cache rather than running again, so that
+changing one transformation only reruns it (and any nodes that depend on its
+output).
+
+Nodes whose transformations are row-local (the output for a row only depends
+on that row) can be run chunk by chunk, with each chunk's output written
+straight into the node's cache, so that the memory a node needs is bounded by
+`max_chunk_mb` rather than by the size of the data. Any categories the
+transformation dummies need to be fixed up front (see
+`general_featurization.get_dummies_categories`), so that every chunk gets the
+same columns. The outputs of the nodes can be shrunk (see
+`dtype_compaction.py`) before they're cached, with `compact` - for the nodes
+run chunk by chunk, only by the changes that don't depend on the values of a
+chunk (so every chunk gets the same dtypes).
+"""
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import inspect
+import pandas as pd
+from columnar_cache import write_cache, load_cache, load_meta, CacheWriter
+from dtype_compaction import compact_dtypes, get_default_dtypes, \
+        get_default_memory_usage, get_memory_usage, build_memory_report
+from stage_report import report_stage
+
+# Hold the keywords that only change how a transformation runs, and not what
+# it outputs (so they're left out of the hash of a node).
+RUN_ONLY_KWARGS = ('n_jobs',)
+# Hold the number of rows in the first chunk of a row-local node, which is used
+# to estimate the memory needed per row.
+FIRST_CHUNK_ROWS = 1000
+
+class FeaturizationGraph(object):
+    """A graph of featurization steps whose outputs are cached.
+
+    Args:
+    ----
+        cache_dir: str
+            Holds the folder to cache the outputs of the nodes in.
+        max_chunk_mb (optional): float
+            Holds roughly how much memory a row-local node can use at once
+            (None to run them on the whole df at once).
+        compact (optional): bool
+            Holds whether to compact the dtypes of the outputs of the nodes
+            (see `compact_dtypes`).
+    """
+
+    def __init__(self, cache_dir, max_chunk_mb=None, compact=False):
+        self.cache_dir = cache_dir
+        self.max_chunk_mb = max_chunk_mb
+        self.compact = compact
+        self.nodes = {}
+        # Holds whether each node was 'run' or 'cached' in the last run.
+        self.run_statuses = {}
+
+    def add_node(self, name, func, kwargs, input_cols, depends_on=None,
+                 row_local=False):
+        """Add a featurization step to the graph.
+
+        Args:
+        ----
+            name: str
+            func: function
+                Holds the transformation, which is called as `func(df, kwargs)`
+                (on a copy of the `kwargs`) and returns the df. It can add
+                columns, and drop any of its input columns, but can't add or
+                drop rows.
+            kwargs: dct
+            input_cols: list of strs or function
+                Holds the columns the node reads, or a function that returns
+                them when passed the list of columns available to the node
+                (the input columns plus those output by its ancestors).
+            depends_on (optional): list of strs
+                Holds the names of the nodes that output columns this node
+                reads.
+            row_local (optional): bool
+                Holds whether the output for each row only depends on that
+                row (and so the node can be run chunk by chunk).
+        """
+
+        self.nodes[name] = {'func': func, 'kwargs': kwargs,
+                            'input_cols': input_cols,
+                            'depends_on': list(depends_on or []),
+                            'row_local': row_local}
+
+    def get_run_order(self, names=None):
+        """Return the order to run the given nodes (and their ancestors) in.
+
+        Nodes are run after all of the nodes they depend on, and otherwise in
+        order of their names (so that the order is the same from run to run).
+
+        Args:
+        ----
+            names (optional): list of strs
+                Holds the nodes to run (all of them if None).
+
+        Return:
+        ------
+            run_order: list of strs
+        """
+
+        names = sorted(self.nodes) if names is None else names
+        run_order, visiting = [], set()
+
+        def visit(name):
+            if name in run_order:
+                return
+            if name not in self.nodes:
+                raise RuntimeError('The node {} is not in the graph'
+                                   .format(name))
+            if name in visiting:
+                raise RuntimeError('The graph has a cycle through the node {}'
+                                   .format(name))
+            visiting.add(name)
+            for dep_name in sorted(self.nodes[name]['depends_on']):
+                visit(dep_name)
+            visiting.remove(name)
+            run_order.append(name)
+
+        for name in sorted(names):
+            visit(name)
+
+        return run_order
+
+    def run(self, df, names=None):
+        """Run the given nodes (and their ancestors) on the df.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+            names (optional): list of strs
+                Holds the nodes to run (all of them if None).
+
+        Return:
+        ------
+            df: Pandas DataFrame
+                Holds the columns of the inputted df that no node dropped,
+                followed by the columns output by each node (in run order).
+        """
+
+        node_outputs = self._run_nodes(df, names)
+        df = self._assemble(df, node_outputs)
+
+        return df
+
+    def run_to_csv(self, df, filepath, names=None, report_memory=False):
+        """Run the given nodes on the df, and write the output to a CSV.
+
+        This writes the same CSV as `run(df, names).to_csv(filepath,
+        index=False)`, but if `max_chunk_mb` is set, it writes it chunk by
+        chunk, and the outputs of row-local (and cached) nodes are read from
+        their caches one chunk at a time, rather than all held in memory.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+            filepath: str
+            names (optional): list of strs
+            report_memory (optional): bool
+                Holds whether to tally the memory the output takes (chunk by
+                chunk), compared with what it would take in the default
+                dtypes (see `dtype_compaction.get_memory_report`).
+
+        Return:
+        ------
+            memory_report: Pandas DataFrame or None
+                Holds the memory report of the output, if `report_memory`.
+        """
+
+        node_outputs = self._run_nodes(df, names)
+        memory_report = None
+        before_bytes, after_bytes, dtypes = 0, 0, None
+        chunk_beg, chunk_rows = 0, FIRST_CHUNK_ROWS
+        if self.max_chunk_mb is None:
+            chunk_rows = max(df.shape[0], 1)
+        with report_stage('write_csv', df.shape[0]) as stage_entry:
+            while chunk_beg == 0 or chunk_beg < df.shape[0]:
+                rows = slice(chunk_beg, chunk_beg + chunk_rows)
+                chunk_df = self._assemble(df, node_outputs, rows)
+                chunk_df.to_csv(filepath, index=False, header=chunk_beg == 0,
+                                mode='w' if chunk_beg == 0 else 'a')
+                if report_memory:
+                    if dtypes is None:
+                        dtypes = chunk_df.dtypes
+                        default_dtypes = get_default_dtypes(chunk_df)
+                    before_bytes = before_bytes + \
+                            get_default_memory_usage(chunk_df)
+                    after_bytes = after_bytes + get_memory_usage(chunk_df,
+                            count_categories=chunk_beg == 0)
+                if chunk_beg == 0 and self.max_chunk_mb is not None:
+                    row_bytes = chunk_df.memory_usage(deep=True).sum() / \
+                            max(chunk_df.shape[0], 1)
+                    chunk_rows = max(int(self.max_chunk_mb * 2 ** 20 /
+                                         (2 * max(row_bytes, 1))), 1)
+                chunk_beg = rows.stop
+            stage_entry['n_rows_out'] = df.shape[0]
+        if report_memory:
+            memory_report = build_memory_report(default_dtypes, dtypes,
+                                                before_bytes, after_bytes)
+
+        return memory_report
+
+    def _run_nodes(self, df, names=None):
+        """Run the given nodes (and their ancestors) on the df.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+            names (optional): list of strs
+
+        Return:
+        ------
+            node_outputs: list of dcts
+                Holds the output of each node, in run order (see `_run_node`).
+        """
+
+        run_order = self.get_run_order(names)
+        outputs = {}
+        self.run_statuses = {}
+        for name in run_order:
+            ancestors = self._get_ancestors(name)
+            anc_outputs = [outputs[anc_name] for anc_name in run_order if
+                           anc_name in ancestors]
+            avail_cols = _apply_outputs(list(df.columns), anc_outputs)
+
+            input_cols = self.nodes[name]['input_cols']
+            if callable(input_cols):
+                input_cols = input_cols(avail_cols)
+            missing_cols = set(input_cols) - set(avail_cols)
+            if missing_cols:
+                raise RuntimeError('The columns {} needed by the node {} are '
+                                   'not available to it'.format(
+                                   sorted(missing_cols), name))
+            input_df = self._assemble(df, anc_outputs, columns=input_cols)
+
+            with report_stage(name, input_df.shape[0]) as stage_entry:
+                outputs[name] = self._run_node(name, input_df)
+                stage_entry['status'] = self.run_statuses[name]
+                stage_entry['n_rows_out'] = input_df.shape[0]
+
+        node_outputs = [outputs[name] for name in run_order]
+
+        return node_outputs
+
+    def _assemble(self, df, node_outputs, rows=None, columns=None):
+        """Put together the df with the outputs of the nodes applied to it.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+            node_outputs: list of dcts
+                Holds the output of each node, in run order.
+            rows (optional): slice
+                Holds the (positional) rows to put together (all if None).
+            columns (optional): list of strs
+                Holds the columns to put together (all that are left after
+                applying the outputs if None).
+
+        Return:
+        ------
+            df: Pandas DataFrame
+        """
+
+        rows = slice(None) if rows is None else rows
+        kept_cols = _apply_outputs(list(df.columns), node_outputs)
+        columns = kept_cols if columns is None else columns
+
+        # Each column comes from the last node that output it (or the df).
+        col_sources = {col: None for col in df.columns}
+        for node_output in node_outputs:
+            for col in node_output['columns']:
+                col_sources[col] = node_output
+
+        index = df.index[rows]
+        col_values = {}
+        for node_output in [None] + node_outputs:
+            source_cols = [col for col in columns if
+                           col_sources[col] is node_output]
+            if not source_cols:
+                continue
+            if node_output is None:
+                source_df = df[source_cols].iloc[rows]
+            elif node_output['df'] is not None:
+                source_df = node_output['df'][source_cols].iloc[rows]
+            else:
+                source_df = load_cache(node_output['cache_path'],
+                                       columns=source_cols, rows=rows)
+            for col in source_cols:
+                col_values[col] = source_df[col].values
+
+        df = pd.DataFrame(col_values, index=index, columns=columns)
+
+        return df
+
+    def get_node_key(self, name, input_df):
+        """Return the hash that a node's output is cached under.
+
+        Args:
+        ----
+            name: str
+            input_df: Pandas DataFrame
+                Holds the input columns of the node.
+
+        Return:
+        ------
+            node_key: str
+        """
+
+        node = self.nodes[name]
+        kwargs = {key: value for key, value in node['kwargs'].iteritems() if
+                  key not in RUN_ONLY_KWARGS}
+
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps(kwargs, sort_keys=True, default=repr))
+        hasher.update(json.dumps([(col, str(input_df[col].dtype)) for col in
+                                  input_df.columns]))
+        if input_df.shape[1]:
+            hasher.update(pd.util.hash_pandas_object(input_df, index=False)
+                          .values.tobytes())
+        else:
+            hasher.update(str(input_df.shape[0]))
+        hasher.update(get_code_version(node['func']))
+
+        return hasher.hexdigest()
+
+    def _run_node(self, name, input_df):
+        """Run a single node (or load its output from the cache).
+
+        Args:
+        ----
+            name: str
+            input_df: Pandas DataFrame
+
+        Return:
+        ------
+            node_output: dct
+                Holds the `columns` the node added, the input columns it
+                dropped (`dropped_cols`), the `cache_path` of its output, and
+                the output itself (`df`) if it's in memory. The outputs of
+                cached nodes and row-local nodes that were run chunk by chunk
+                are instead read from the cache when needed.
+        """
+
+        node_key = self.get_node_key(name, input_df)
+        cache_path = os.path.join(self.cache_dir,
+                                  '{}-{}'.format(name, node_key))
+
+        out_df = None
+        if load_meta(cache_path) is not None:
+            self.run_statuses[name] = 'cached'
+        else:
+            if self.nodes[name]['row_local'] and \
+                    self.max_chunk_mb is not None:
+                self._run_node_chunked(name, input_df, cache_path)
+            else:
+                out_df, dropped_cols = self._run_func(name, input_df)
+                if self.compact:
+                    out_df = compact_dtypes(out_df)
+                write_cache(out_df.reset_index(drop=True), cache_path,
+                            {'dropped_cols': dropped_cols})
+            self._remove_stale_caches(name, node_key)
+            self.run_statuses[name] = 'run'
+
+        meta = load_meta(cache_path)
+        node_output = {'columns': meta['columns'],
+                       'dropped_cols': meta['dropped_cols'],
+                       'cache_path': cache_path, 'df': out_df}
+
+        return node_output
+
+    def _run_node_chunked(self, name, input_df, cache_path):
+        """Run a row-local node chunk by chunk, writing each chunk to the cache.
+
+        The first chunk is `FIRST_CHUNK_ROWS` rows, and the memory its input
+        and output take is used to size the rest of the chunks to fit in
+        `max_chunk_mb` (leaving room for a copy of both while the
+        transformation runs).
+
+        Args:
+        ----
+            name: str
+            input_df: Pandas DataFrame
+            cache_path: str
+        """
+
+        n_rows = input_df.shape[0]
+        cache_writer = CacheWriter(cache_path, n_rows)
+        chunk_beg, chunk_rows, dropped_cols = 0, FIRST_CHUNK_ROWS, None
+        while chunk_beg < n_rows or dropped_cols is None:
+            chunk_end = min(chunk_beg + chunk_rows, n_rows)
+            chunk_df = input_df.iloc[chunk_beg:chunk_end]
+            out_df, chunk_dropped_cols = self._run_func(name, chunk_df)
+            if self.compact:
+                out_df = compact_dtypes(out_df, by_value=False)
+            if dropped_cols is None:
+                dropped_cols = chunk_dropped_cols
+                row_bytes = (chunk_df.memory_usage(deep=True).sum() +
+                             out_df.memory_usage(deep=True).sum()) / \
+                        max(chunk_df.shape[0], 1)
+                chunk_rows = max(int(self.max_chunk_mb * 2 ** 20 /
+                                     (2 * max(row_bytes, 1))), 1)
+            elif chunk_dropped_cols != dropped_cols:
+                raise RuntimeError('The node {} dropped different columns in '
+                                   'different chunks'.format(name))
+            cache_writer.write_chunk(out_df, chunk_beg)
+            chunk_beg = chunk_end
+
+        cache_writer.close({'dropped_cols': dropped_cols})
+
+    def _run_func(self, name, input_df):
+        """Run a node's transformation on the input, and return what changed.
+
+        Args:
+        ----
+            name: str
+            input_df: Pandas DataFrame
+
+        Return:
+        ------
+            out_df: Pandas DataFrame
+                Holds the columns the transformation added.
+            dropped_cols: list of strs
+                Holds the input columns the transformation dropped.
+        """
+
+        node = self.nodes[name]
+        result_df = node['func'](input_df.copy(), dict(node['kwargs']))
+        if not result_df.index.equals(input_df.index):
+            raise RuntimeError('The node {} added or dropped rows'.format(name))
+
+        out_df = result_df[[col for col in result_df.columns if col not in
+                            input_df.columns]]
+        dropped_cols = [col for col in input_df.columns if col not in
+                        result_df.columns]
+
+        return out_df, dropped_cols
+
+    def _get_ancestors(self, name):
+        """Return the names of all the nodes a node depends on (indirectly or
+        directly)."""
+
+        ancestors, to_visit = set(), list(self.nodes[name]['depends_on'])
+        while to_visit:
+            dep_name = to_visit.pop()
+            if dep_name not in ancestors:
+                ancestors.add(dep_name)
+                to_visit.extend(self.nodes[dep_name]['depends_on'])
+
+        return ancestors
+
+    def _remove_stale_caches(self, name, node_key):
+        """Remove the caches of any older outputs of the node."""
+
+        stale_re = re.compile(r'^{}-[0-9a-f]{{40}}$'.format(re.escape(name)))
+        for dirname in os.listdir(self.cache_dir):
+            if stale_re.match(dirname) and \
+                    dirname != '{}-{}'.format(name, node_key):
+                shutil.rmtree(os.path.join(self.cache_dir, dirname))
+
+def get_code_version(func):
+    """Return a hash of the source code a function depends on.
+
+    This hashes the source of the function's module, plus that of every module
+    in the same folder that it uses (directly or through other modules in the
+    same folder).
+
+    Args:
+    ----
+        func: function
+
+    Return:
+    ------
+        code_version: str
+    """
+
+    module = sys.modules[func.__module__]
+    code_dir = os.path.dirname(os.path.abspath(_get_source_fp(module)))
+
+    filepaths, to_visit = set(), [module]
+    while to_visit:
+        module = to_visit.pop()
+        source_fp = _get_source_fp(module)
+        if source_fp is None or source_fp in filepaths or \
+                os.path.dirname(os.path.abspath(source_fp)) != code_dir:
+            continue
+        filepaths.add(source_fp)
+        for value in vars(module).values():
+            if inspect.ismodule(value):
+                to_visit.append(value)
+            elif getattr(value, '__module__', None) in sys.modules:
+                to_visit.append(sys.modules[value.__module__])
+
+    hasher = hashlib.sha1()
+    for source_fp in sorted(filepaths, key=os.path.basename):
+        with open(source_fp) as f:
+            hasher.update(f.read())
+
+    return hasher.hexdigest()
+
+def _get_source_fp(module):
+    """Return the filepath of the module's source (None for builtins)."""
+
+    filepath = getattr(module, '__file__', None)
+    if filepath is not None and filepath.endswith('.pyc'):
+        filepath = filepath[:-1]
+
+    return filepath
+
+def _apply_outputs(cols, node_outputs):
+    """Return the columns left after applying each node's output in turn.
+
+    Args:
+    ----
+        cols: list of strs
+        node_outputs: list of dcts
+            Holds the columns added and the columns dropped by each node.
+
+    Return:
+    ------
+        cols: list of strs
+    """
+
+    for node_output in node_outputs:
+        cols = [col for col in cols if col not in node_output['dropped_cols']]
+        cols += [col for col in node_output['columns'] if col not in cols]
+
+    return cols
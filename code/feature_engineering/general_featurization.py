@@ -2,9 +2,12 @@
 
 This module contains general, fairly standard functions that can be run in data 
 processing tasks. This includes one for creating dummy variables 
-(`return_all_dummies`) and one for creating a new column based on an `eval` 
-string (`create_new_col`). These are the only two meant to be called externally 
-from the module (`_add_date_col` is simply a helper function). 
+(`return_all_dummies`), one for fixing the categories to create dummies for 
+up front (`get_dummies_categories`), one for creating a new column based on 
+an `eval` string (`create_new_col`), and one for creating any number of them 
+in a single pass (`create_new_cols`). These are the only four meant to be 
+called externally from the module (the functions starting with an underscore 
+are simply helper functions). 
 
 In the first two functions mentioned above, there is a use of a kwargs argument 
 in a somewhat non-traditional way. This has to do with how the `create_inputs.py` 
@@ -12,22 +15,33 @@ module calls the functions. To allow for flexibility in the function calls in th
 `create_inputs.py` module, a somewhat non-traditional use of kwargs helped. 
 """
 
+import re
 import pandas as pd
 import numpy as np
+try: 
+    import numexpr
+except ImportError: 
+    numexpr = None
+from time_featurization import get_temporal_features
+from one_hot import encode_one_hot, get_feature_names
 
 def return_all_dummies(df, kwargs): 
     """Create dummy variables for an inputted column. 
 
     Grab the column to dummy from the `col` key in **kwargs, create dummies for 
     every value in that column, and concat those onto the inputted DataFrame. 
+    If the `categories` keyword is passed, create dummies for exactly those 
+    values instead (see `one_hot.py`), so that every chunk of a DataFrame gets 
+    the same columns no matter which values are in it. 
 
     Args: 
     ----
         df: Pandas DataFrame 
         kwargs: dct
             Holds arguments to use in the function. Here we expect the `col` 
-            keyword to be passed in. See the module docstring for an explanation 
-            of the use of kwargs here. 
+            keyword to be passed in, and optionally the `categories` keyword 
+            (see `get_dummies_categories`). See the module docstring for an 
+            explanation of the use of kwargs here. 
 
     Return: 
     ------
@@ -35,21 +49,58 @@ def return_all_dummies(df, kwargs):
     """
 
     col = kwargs.pop('col', None)
+    categories = kwargs.pop('categories', None)
     if col is None: 
         raise RuntimeError('Need to pass a column name to dummy for \
                 return_all_dummies')
 
     # For both year and month, these are only implicitly in the df via the date 
-    # column. We need to explicity add them to dummy them. 
-    if col in ['year', 'month']: 
+    # column (unless `add_date_column` already added them). We need to 
+    # explicity add them to dummy them. 
+    if col in ['year', 'month'] and col not in df.columns: 
         df = _add_date_col(df, col)	
 
-    dummies = pd.get_dummies(df[col], prefix=col)
+    if categories is not None: 
+        dummies = pd.DataFrame(encode_one_hot(df[col].values, categories), 
+                index=df.index, columns=get_feature_names(col, categories))
+    else: 
+        dummies = pd.get_dummies(df[col], prefix=col)
     df = pd.concat([df, dummies], axis=1)
     df = df.drop(col, axis=1)
 
     return df
 
+def get_dummies_categories(df, col): 
+    """Return the values to create dummies for in `return_all_dummies`. 
+
+    These are the (sorted) values in the column, which are the ones that 
+    `return_all_dummies` would create dummies for without the `categories` 
+    keyword. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame
+        col: str
+            Holds the column to dummy (`year` and `month` are pulled out of 
+            the `date_fire` column). 
+
+    Return: 
+    ------
+        categories: list
+    """
+
+    if col in df.columns: 
+        values = df[col]
+    elif col in ['year', 'month']: 
+        values = getattr(df['date_fire'].dt, col)
+    else: 
+        raise RuntimeError('The column {} is not in the df to get the dummies '
+                'categories from'.format(col))
+
+    categories = sorted(values.dropna().unique().tolist())
+
+    return categories
+
 def create_new_col(df, kwargs): 
     """Create a new column in the df based off the inputted specifications. 
 
@@ -83,6 +134,116 @@ def create_new_col(df, kwargs):
 
     return df
 
+def create_new_cols(df, kwargs): 
+    """Create a number of new columns in the df, each from an `eval` string. 
+
+    This does the same as calling `create_new_col` for each of the new columns, 
+    but evaluates all of the expressions in one pass over the arrays of just 
+    the columns they use (with `numexpr`, which compiles each expression once and 
+    runs it across all cores, if it's installed), and drops all of the 
+    `delete_columns` once at the end. An expression can use the columns 
+    created by the expressions before it. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame 
+        kwargs: dct
+            Holds arguments to use in the function. Here we expect the 
+            `new_cols` keyword to be passed in, holding a list of dcts that 
+            each hold the keywords of `create_new_col` (`eval_string`, 
+            `new_col_name`, and optionally `delete_columns`). See the module 
+            docstring for an explanation of the use of kwargs here. 
+
+    Return: 
+    ------
+        df: Pandas DataFrame
+    """
+
+    new_cols = kwargs.pop('new_cols', None)
+    if not new_cols or any(new_col.get('eval_string') is None or 
+            new_col.get('new_col_name') is None for new_col in new_cols): 
+        raise RuntimeError('Need an eval string and column name for each \
+                column to create in create_new_cols.')
+
+    arrays = {}
+    new_col_names, delete_columns = [], []
+    for new_col in new_cols: 
+        eval_string = new_col['eval_string']
+        for name in _get_eval_names(eval_string): 
+            if name not in arrays and name in df.columns: 
+                arrays[name] = _get_eval_array(df[name])
+        arrays[new_col['new_col_name']] = _evaluate(eval_string, arrays)
+        new_col_names.append(new_col['new_col_name'])
+        delete_columns.extend(new_col.get('delete_columns') or [])
+
+    new_cols_df = pd.DataFrame({name: arrays[name] for name in new_col_names}, 
+            index=df.index, columns=new_col_names)
+    delete_columns = [col for col in df.columns if col in set(delete_columns) 
+            and col not in new_col_names]
+    df = pd.concat([df.drop(delete_columns + [col for col in new_col_names 
+        if col in df.columns], axis=1), new_cols_df], axis=1)
+
+    return df
+
+def _get_eval_names(eval_string): 
+    """Return the names (e.g. of columns) used in an `eval` string. 
+
+    Args: 
+    ----
+        eval_string: str
+
+    Return: 
+    ------
+        names: set of strs
+    """
+
+    return set(re.findall(r'[A-Za-z_]\w*', eval_string))
+
+def _get_eval_array(values): 
+    """Return the array of a column to evaluate expressions on. 
+
+    `numexpr` only handles bools, 32 and 64 bit ints, and floats, so smaller 
+    ints (e.g. from `dtype_compaction.compact_dtypes`) are widened to int64. 
+
+    Args: 
+    ----
+        values: Pandas Series
+
+    Return: 
+    ------
+        array: 1d np.ndarray
+    """
+
+    array = values.values
+    if array.dtype.kind in 'iu' and array.dtype.itemsize < 8: 
+        array = array.astype(np.int64)
+
+    return array
+
+def _evaluate(eval_string, arrays): 
+    """Evaluate an expression over the arrays, as `df.eval` would. 
+
+    Args: 
+    ----
+        eval_string: str
+        arrays: dct of 1d np.ndarrays
+
+    Return: 
+    ------
+        result: 1d np.ndarray
+    """
+
+    local_dict = {name: arrays[name] for name in _get_eval_names(eval_string) 
+            if name in arrays}
+    if numexpr is not None and all(array.dtype.kind in 'bif' for array in 
+            local_dict.itervalues()): 
+        # Division is true division, just as in `df.eval`. 
+        return numexpr.evaluate(eval_string, local_dict=local_dict, 
+                truediv=True)
+
+    return np.asarray(pd.eval(eval_string, engine='python', 
+            local_dict=local_dict))
+
 def _add_date_col(df, col_name): 
     """Create a new date-based column in the inputted DataFrame. 
 
@@ -101,10 +262,9 @@ def _add_date_col(df, col_name):
         df: Pandas DataFrame
     """
 
-    if col_name == 'year': 
-        df[col_name] = [dt.year for dt in df['date_fire']]
-    if col_name == 'month': 
-        df[col_name] = [dt.month for dt in df['date_fire']]
+    if col_name in ['year', 'month']: 
+        df[col_name] = get_temporal_features(df['date_fire'].values, 
+                [col_name])[col_name]
 
     return df
 
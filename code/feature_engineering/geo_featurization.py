@@ -22,6 +22,11 @@ import time
 from itertools import izip
 from datetime import timedelta, datetime
 from functools import partial 
+from grid_index import GridIndex
+from haversine_index import HaversineIndex
+from nearby_table import NearbyFiresTable
+from raster_cube import RasterCube
+from stage_report import report_stage
 
 def gen_nearby_fires_count(df, kwargs):
     """Count nearby fires/non-fires in lat/long and time space. 
@@ -42,14 +47,48 @@ def gen_nearby_fires_count(df, kwargs):
     drive by calling all of the other helper functions in this module. It will 
     also multiprocess this across all available cores be default. 
 
+    The counts can be calculated by one of four engines, chosen through the 
+    optional 'engine' keyword: 
+
+        * 'query' (default) - Query a DataFrame for every row, multiprocessed 
+          across all available cores. 
+        * 'grid' - Build a single spatial grid index (see `grid_index.py`) and 
+          calculate the counts for every row in batch. This is orders of 
+          magnitude faster. It is multiprocessed when the optional 'n_jobs' 
+          keyword is passed (-1 for all cores), with workers sharing the index 
+          through memory-mapped files. If the optional 'table_dir' keyword is 
+          passed, the index and the per-row counts are saved there, so that 
+          they can be kept up to date with `update_nearby_fires_count` as new 
+          obs. come in. 
+        * 'haversine' - Instead of +/- some distance in lat/long space, nearby 
+          is denoted by a great-circle distance in kilometers, passed through 
+          the 'radius_km' keyword (in place of 'dist_measure'). The counts are 
+          calculated in batch with radius queries on a ball tree (see 
+          `haversine_index.py`). 
+        * 'cube' - Count exactly with the grid index for time measures up to 
+          the optional 'exact_max_time_measure' keyword (7 by default). For 
+          longer time measures, the last `exact_max_time_measure` days are 
+          counted exactly and the rest of the window is approximated using a 
+          dense raster cube of obs. (see `raster_cube.py`), with the lat/long 
+          cell size and the days per time bin given by the optional 
+          'cube_cell_size' (`dist_measure` by default) and 'cube_time_bin_days' 
+          (7 by default) keywords. 
+
+    With the 'grid' engine, 'dist_measure' can also be a list of distances, in 
+    which case the counts for every distance are made in the same pass over a 
+    single index (built for the largest distance), and the columns are named 
+    `all_nearby_count{dist_measure}_{time_measure}` and 
+    `all_nearby_fires{dist_measure}_{time_measure}`. 
+
     Args: 
     ----
         df: Pandas DataFrame 
         kwargs: dct
             Holds arguments to use in the function. Here we expect the 
-            'time_measures' and 'dist_measure' to keywords to be passed in. See 
-            the module docstring for an explanation of the use of kwargs variable 
-            here. 
+            'time_measures' and 'dist_measure' (or 'radius_km') keywords to 
+            be passed in, and optionally the 'engine' keyword along with any 
+            keywords specific to that engine. See the module docstring for an 
+            explanation of the use of kwargs variable here. 
         
     Return: 
     ------
@@ -58,38 +97,250 @@ def gen_nearby_fires_count(df, kwargs):
 
     time_measures = kwargs.pop('time_measures', None)
     dist_measure = kwargs.pop('dist_measure', None)
+    radius_km = kwargs.pop('radius_km', None)
+    engine = kwargs.pop('engine', 'query')
 
-    if time_measures is None or dist_measure is None: 
+    spatial_measure = radius_km if engine == 'haversine' else dist_measure
+    if time_measures is None or spatial_measure is None: 
         raise RuntimeError('Inappropriate arguments passed to gen_nearby_fires_count')
 
+    radii = None
+    if isinstance(spatial_measure, (list, tuple)): 
+        if engine != 'grid' or 'table_dir' in kwargs: 
+            raise RuntimeError('A list of dist_measures is only supported by '
+                               'the grid engine (without a table_dir)')
+        radii, spatial_measure = list(spatial_measure), max(spatial_measure)
+
+    if engine in ('grid', 'haversine', 'cube'): 
+        return _gen_nearby_fires_count_batch(df, engine, spatial_measure, 
+                                             time_measures, kwargs, radii)
+    elif engine != 'query': 
+        raise RuntimeError('Invalid engine passed to gen_nearby_fires_count')
+
     keep_cols = ['lat', 'long', 'date_fire', 'fire_bool']
-    multiprocessing_df = df[keep_cols] 
-    multiprocessing_df, dt_percentiles_df_dict = \
-            _prep_multiprocessing(multiprocessing_df)
+    with report_stage('unique_obs', df.shape[0]) as stage_entry: 
+        first_positions, inverse_idx = _get_unique_obs_index(df)
+        multiprocessing_df = df[keep_cols] 
+        multiprocessing_df, dt_percentiles_df_dict = \
+                _prep_multiprocessing(multiprocessing_df, first_positions)
+        stage_entry['n_rows_out'] = first_positions.shape[0]
     col_lst = ['lat', 'long', 'date_fire', 'date_fire_percentiles']
     lat_idx, long_idx, date_idx, date_pctile_idx = \
             _grab_col_indices(multiprocessing_df, col_lst)
+    # Rows come back from the pool in the (date sorted) order they went in. 
+    unique_positions = multiprocessing_df['unique_position'].values
+
+    all_nearby_counts = np.zeros((first_positions.shape[0], 
+                                  len(time_measures)), dtype=np.int64)
+    nearby_fires_counts = np.zeros_like(all_nearby_counts)
+    for col_idx, time_measure in enumerate(time_measures): 
+        with report_stage('time_measure_{}'.format(time_measure), 
+                          multiprocessing_df.shape[0]) as stage_entry: 
+            pool = multiprocessing.Pool(multiprocessing.cpu_count())
+            execute_query = partial(query_for_nearby_fires, 
+                                    dt_percentiles_df_dict, dist_measure, 
+                                    time_measure, lat_idx, long_idx, date_idx, 
+                                    date_pctile_idx)
+            nearby_count_dicts = pool.map(execute_query, 
+                    multiprocessing_df.values) 
+            pool.close()
+            # Join the pool, so its CPU time is counted in this stage. 
+            pool.join()
+            all_nearby_counts[unique_positions, col_idx] = \
+                    [count_dict['all_nearby_count' + str(time_measure)] 
+                     for count_dict in nearby_count_dicts]
+            nearby_fires_counts[unique_positions, col_idx] = \
+                    [count_dict['all_nearby_fires' + str(time_measure)] 
+                     for count_dict in nearby_count_dicts]
+            stage_entry['n_rows_out'] = len(nearby_count_dicts)
+
+    with report_stage('broadcast_counts', first_positions.shape[0]) as stage_entry: 
+        df = _broadcast_counts(df, _get_count_suffixes(time_measures), 
+                               all_nearby_counts, nearby_fires_counts, inverse_idx)
+        stage_entry['n_rows_out'] = df.shape[0]
+
+    return df
+
+def _gen_nearby_fires_count_batch(df, engine, spatial_measure, time_measures, 
+                                  kwargs, radii=None): 
+    """Count nearby fires/non-fires for every row at once using an index. 
+
+    Duplicate observations in terms of lat/long coordinates and date are 
+    dropped (just as in `_prep_multiprocessing`), a `GridIndex`, 
+    `HaversineIndex`, or `RasterCube` is built over what's left, and the counts 
+    for every time measure are calculated in batch and broadcast back onto the 
+    rows of the DataFrame. 
+
+    This is a helper function called from `gen_nearby_fires_count`. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame 
+        engine: str
+            Holds which index to use ('grid', 'haversine', or 'cube'). 
+        spatial_measure: float
+            Holds the `dist_measure` for the grid index and raster cube, and 
+            the `radius_km` for the haversine index. 
+        time_measures: list of ints
+        kwargs: dct
+            Holds any engine specific keywords (see `gen_nearby_fires_count`). 
+        radii (optional): list of floats
+            Holds the distances to count over with the grid index, if more than 
+            the one `spatial_measure` (the largest of them). 
+
+    Return: 
+    ------
+        df: Pandas DataFrame 
+    """
+
+    keep_cols = ['lat', 'long', 'date_fire', 'fire_bool']
+    with report_stage('unique_obs', df.shape[0]) as stage_entry: 
+        first_positions, inverse_idx = _get_unique_obs_index(df)
+        nearby_df = df[keep_cols].iloc[first_positions]
+        stage_entry['n_rows_out'] = nearby_df.shape[0]
+    index_args = (nearby_df['lat'].values, nearby_df['long'].values, 
+                  nearby_df['date_fire'].values, nearby_df['fire_bool'].values, 
+                  spatial_measure)
+    n_jobs = kwargs.pop('n_jobs', 1)
+    table_dir = kwargs.pop('table_dir', None)
+
+    # All of the time measures are counted in a single pass over the index, so 
+    # they're reported as a single stage. 
+    with report_stage('count_time_measures', nearby_df.shape[0]) as stage_entry: 
+        stage_entry['engine'] = engine
+        stage_entry['time_measures'] = list(time_measures)
+        if engine == 'grid' and table_dir is not None: 
+            table = NearbyFiresTable.build(nearby_df, spatial_measure, 
+                                           time_measures, n_jobs)
+            table.save(table_dir)
+            all_nearby_counts, nearby_fires_counts = table.get_counts()
+        elif engine == 'grid': 
+            all_nearby_counts, nearby_fires_counts = GridIndex(*index_args) \
+                    .count_all_nearby_windows(time_measures, n_jobs, radii)
+        elif engine == 'haversine': 
+            all_nearby_counts, nearby_fires_counts = HaversineIndex(*index_args) \
+                    .count_all_nearby_windows(time_measures)
+        else: 
+            all_nearby_counts, nearby_fires_counts = _count_with_cube(index_args, 
+                    time_measures, n_jobs, kwargs)
+        stage_entry['n_rows_out'] = all_nearby_counts.shape[0]
 
-    for time_measure in time_measures: 
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        execute_query = partial(query_for_nearby_fires, dt_percentiles_df_dict, 
-                                dist_measure, time_measure, lat_idx, long_idx, 
-                                date_idx, date_pctile_idx)
-        nearby_count_dicts = pool.map(execute_query, 
-                multiprocessing_df.values) 
-        pool.close()
-        df = _merge_results(df, nearby_count_dicts)
+    with report_stage('broadcast_counts', nearby_df.shape[0]) as stage_entry: 
+        df = _broadcast_counts(df, _get_count_suffixes(time_measures, radii), 
+                               all_nearby_counts, nearby_fires_counts, inverse_idx)
+        stage_entry['n_rows_out'] = df.shape[0]
 
     return df
 
-def _prep_multiprocessing(df): 
+def _count_with_cube(index_args, time_measures, n_jobs, kwargs): 
+    """Count exactly for short time measures and approximately for long ones. 
+
+    This is a helper function called from `_gen_nearby_fires_count_batch`. 
+
+    Args: 
+    ----
+        index_args: tuple
+            Holds the lat, long, date, and fire_bool arrays, and the 
+            `dist_measure`. 
+        time_measures: list of ints
+        n_jobs: int
+        kwargs: dct
+            Holds the optional 'exact_max_time_measure', 'cube_cell_size', and 
+            'cube_time_bin_days' keywords. 
+
+    Return: 
+    ------
+        all_nearby_counts: 2d np.ndarray
+        nearby_fires_counts: 2d np.ndarray
+    """
+
+    exact_max_time_measure = kwargs.pop('exact_max_time_measure', 7)
+    cube_cell_size = kwargs.pop('cube_cell_size', None)
+    cube_time_bin_days = kwargs.pop('cube_time_bin_days', 7)
+
+    time_measures = np.asarray(time_measures)
+    is_exact = time_measures <= exact_max_time_measure
+    all_nearby_counts = np.zeros((index_args[0].shape[0], 
+                                  time_measures.shape[0]), dtype=np.int64)
+    nearby_fires_counts = np.zeros_like(all_nearby_counts)
+
+    # The last column holds the recent (exactly counted) part of long windows. 
+    exact_all_counts, exact_fires_counts = GridIndex(*index_args) \
+            .count_all_nearby_windows(list(time_measures[is_exact]) + 
+                                      [exact_max_time_measure], n_jobs)
+    all_nearby_counts[:, is_exact] = exact_all_counts[:, :-1]
+    nearby_fires_counts[:, is_exact] = exact_fires_counts[:, :-1]
+
+    if not is_exact.all(): 
+        lat, lng, dates = index_args[:3]
+        raster_cube = RasterCube(*index_args, cell_size=cube_cell_size, 
+                                 time_bin_days=cube_time_bin_days)
+        cube_all_counts, cube_fires_counts = raster_cube.count_nearby_windows(
+                lat, lng, dates, list(time_measures[~is_exact]), 
+                exact_max_time_measure)
+        all_nearby_counts[:, ~is_exact] = cube_all_counts + \
+                exact_all_counts[:, -1:]
+        nearby_fires_counts[:, ~is_exact] = cube_fires_counts + \
+                exact_fires_counts[:, -1:]
+
+    return all_nearby_counts, nearby_fires_counts
+
+def update_nearby_fires_count(df, kwargs): 
+    """Count nearby fires/non-fires for new rows, using a saved table. 
+
+    Load the `NearbyFiresTable` saved by `gen_nearby_fires_count` (with the 
+    grid engine and the 'table_dir' keyword) or by 
+    `spatial_tiles.gen_nearby_fires_count_tiled`, add the rows of `df` to it, 
+    and only recount for the rows this affects (see `nearby_table.py`). The 
+    counts are exactly what `gen_nearby_fires_count` would give if it were 
+    rerun over all of the rows. The updated table is saved back in place. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame 
+            Holds the new rows (e.g. a new day of detections), with the same 
+            columns passed to `gen_nearby_fires_count`. 
+        kwargs: dct
+            Holds arguments to use in the function. Here we expect the 
+            'table_dir' keyword to be passed in. 
+
+    Return: 
+    ------
+        df: Pandas DataFrame 
+            Holds the new rows with their count columns added. 
+        updated_counts_df: Pandas DataFrame 
+            Holds the lat/long/date_fire and counts of every previously added 
+            row whose counts changed, for updating stored features. 
+    """
+
+    table_dir = kwargs.pop('table_dir', None)
+    if table_dir is None: 
+        raise RuntimeError('Need a table_dir to pass to update_nearby_fires_count')
+
+    table = NearbyFiresTable.load(table_dir)
+    first_new_id = table.n_rows
+    row_ids = table.update(df)
+    table.save(table_dir)
+
+    all_nearby_counts, nearby_fires_counts = \
+            table.get_counts(table.get_row_ids(df))
+    df = _broadcast_counts(df, _get_count_suffixes(table.time_measures), 
+                           all_nearby_counts, nearby_fires_counts, 
+                           np.arange(df.shape[0]))
+    updated_counts_df = table.get_counts_df(row_ids[row_ids < first_new_id])
+
+    return df, updated_counts_df
+
+def _prep_multiprocessing(df, first_positions): 
     """Clean up the inputted df and prepare everything for multiprocessing. 
     
     For multiprocessing, the df needs to be as lightweight as possible. This 
     means dropping any duplicate observations in terms of lat/long coordinates 
     and date. We also don't want to count any duplicate observations like this 
     towards the overall count of nearby fires/obs. This is the first step in 
-    this function. 
+    this function, and each remaining row is tagged with its position among 
+    the unique obs. (`unique_position`) so that its counts can be put back in 
+    place after the rows are sorted by date. 
 
     The second step involves prepping everything for multiprocessing. The
     quickest/most efficient method found to multiprocess this was the following: 
@@ -105,20 +356,23 @@ def _prep_multiprocessing(df):
     Args: 
     ----
         df: Pandas DataFrame
+        first_positions: 1d np.ndarray
+            Holds the position of the first row of each unique ob. (see 
+            `_get_unique_obs_index`). 
 
     Return: 
     ------
         multiprocessing_df: Pandas DataFrame
-            Holds the modified DataFrame, with duplicates dropped and the date 
-            percentile column added. 
+            Holds the modified DataFrame, with duplicates dropped and the unique 
+            position and date percentile columns added. 
         dt_percentiles_df_dict: dct of DataFrames 
             Holds the dictionary lookup for all rows in a corresponding date 
             percentile. The key corresponds to the date percentile, and the 
             value corresponds to a DataFrame of all rows in that date percentile. 
     """
 
-    multiprocessing_df = df.drop_duplicates(['lat', 'long', 'date_fire'])
-    multiprocessing_df = multiprocessing_df.reset_index(drop=True)
+    multiprocessing_df = df.iloc[first_positions].reset_index(drop=True)
+    multiprocessing_df['unique_position'] = np.arange(first_positions.shape[0])
     multiprocessing_df, dt_percentiles_df_dict = \
             _handle_date_percentiles(multiprocessing_df)
 
@@ -389,51 +643,156 @@ def _get_date_range(time_measure, dt):
 
     return date_min, date_max
 
-def _merge_results(df, nearby_count_dicts): 
-    """Merge the inputted dictionary of data onto the DataFrame. 
+def _get_unique_obs_index(df): 
+    """Find the unique obs. of the DataFrame in terms of lat/long and date. 
+
+    Each of the `lat`, `long`, and `date_fire` columns is factorized into 
+    integer codes, and the codes are combined into a single code per unique 
+    lat/long/date_fire combination. Unique obs. are numbered in the order they 
+    first appear, so `df.iloc[first_positions]` is what `drop_duplicates` 
+    would keep. 
+
+    This is a helper function called from `gen_nearby_fires_count` and 
+    `_gen_nearby_fires_count_batch`. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame
+
+    Return: 
+    ------
+        first_positions: 1d np.ndarray
+            Holds the position (in `df`) of the first row of each unique ob. 
+        inverse_idx: 1d np.ndarray
+            Holds, for each row of `df`, the number of the unique ob. it is. 
+    """
+
+    obs_codes = np.zeros(df.shape[0], dtype=np.int64)
+    for col in ['lat', 'long', 'date_fire']: 
+        col_codes, col_uniques = pd.factorize(df[col].values)
+        # Missing values all get a code of -1, so give them their own code. 
+        n_col_codes = len(col_uniques) + 1
+        col_codes[col_codes == -1] = len(col_uniques)
+        obs_codes, _ = pd.factorize(obs_codes * n_col_codes + col_codes)
+
+    _, first_positions, inverse_idx = np.unique(obs_codes, return_index=True, 
+                                                return_inverse=True)
+
+    return first_positions, inverse_idx
+
+def _get_count_suffixes(time_measures, radii=None): 
+    """Return the suffix of the count columns for each column of counts. 
+
+    With a single distance, the count columns are suffixed by the time measure 
+    alone (e.g. `all_nearby_count7`). With a list of distances, they're 
+    suffixed by the distance and time measure (e.g. `all_nearby_count0.05_7`), 
+    with the time measures of the first distance first. 
+
+    Args: 
+    ----
+        time_measures: list of ints
+        radii (optional): list of floats
+
+    Return: 
+    ------
+        count_suffixes: list of strs
+    """
+
+    if radii is None: 
+        return [str(time_measure) for time_measure in time_measures]
+
+    return ['{}_{}'.format(radius, time_measure) for radius in radii 
+            for time_measure in time_measures]
 
-    Take in the nearby_count_dict, and merge it into the current df. The 
-    nearby_count_dict holds the information calcalated in the 
-    query_for_nearby_fires function for each latitude, longitude, and date combo. 
+def _broadcast_counts(df, count_suffixes, all_nearby_counts, nearby_fires_counts, 
+                      inverse_idx): 
+    """Add the count columns for the unique obs. onto every row of the df. 
+
+    This replaces merging the counts back onto the df by lat/long/date_fire - 
+    every row gets the counts of the unique ob. it is by position, so no rows 
+    can be dropped or duplicated by a join on float keys. 
 
     This is a helper function called from `gen_nearby_fires_count`. 
 
     Args: 
     ----
         df: Pandas DataFrame
-        nearby_count_dicts: list of dcts
+        count_suffixes: list of strs
+            Holds the suffix of the count columns for each column of counts 
+            (see `_get_count_suffixes`). 
+        all_nearby_counts: 2d np.ndarray
+            Holds one row per unique ob. and one column per count suffix. 
+        nearby_fires_counts: 2d np.ndarray
+        inverse_idx: 1d np.ndarray
+            Holds, for each row of `df`, its row in the count arrays. 
     
     Return: 
     ------
         df: Pandas DataFrame
     """
 
-    nearby_fires_df = pd.DataFrame(nearby_count_dicts)
-    nearby_fires_df = nearby_fires_df.drop_duplicates()
-    df = pd.merge(df, nearby_fires_df, how='inner', on=['lat', 'long', 'date_fire'])
+    for col_idx, count_suffix in enumerate(count_suffixes): 
+        all_nearby_count_label = 'all_nearby_count' + count_suffix
+        nearby_fires_count_label = 'all_nearby_fires' + count_suffix
+        df[all_nearby_count_label] = all_nearby_counts[inverse_idx, col_idx]
+        df[nearby_fires_count_label] = nearby_fires_counts[inverse_idx, col_idx]
 
     return df
 
-def calc_perc_fires(df, time_measures):
+def calc_perc_fires(df, time_measures=None):
     """Calculate the percentage of nearby observations that are actually forest-fires
 
+    A `perc_fires` column is added for every `all_nearby_count` column in the 
+    df (e.g. `perc_fires7` for `all_nearby_count7`, or `perc_fires0.05_7` for 
+    `all_nearby_count0.05_7`), so that counts made over several distances are 
+    picked up automatically. 
+
     Args: 
     ----
         df: pandas DataFrame
-        time_measures: list of ints 
+        time_measures (optional): list of ints 
             Holds the list of days back that were used to create columns of 
-            the counts of nearby observations and nearby forest-fires 
+            the counts of nearby observations and nearby forest-fires. If 
+            passed, only columns for these time measures are used. 
 
     Return: 
     ------
         df: Pandas DataFrame 
     """
 
-    for time_measure in time_measures: 
-        new_col_name = 'perc_fires{}'.format(time_measure)
-        nearby_count_col = 'all_nearby_count{}'.format(time_measure)
-        nearby_fires_count_col = 'all_nearby_fires{}'.format(time_measure)
+    count_prefix = 'all_nearby_count'
+    count_suffixes = [col[len(count_prefix):] for col in df.columns 
+                      if col.startswith(count_prefix)]
+    if time_measures is not None: 
+        time_measures = [str(time_measure) for time_measure in time_measures]
+        count_suffixes = [count_suffix for count_suffix in count_suffixes 
+                          if count_suffix.split('_')[-1] in time_measures]
+
+    for count_suffix in count_suffixes: 
+        new_col_name = 'perc_fires{}'.format(count_suffix)
+        nearby_count_col = 'all_nearby_count{}'.format(count_suffix)
+        nearby_fires_count_col = 'all_nearby_fires{}'.format(count_suffix)
         df[new_col_name] = df[nearby_fires_count_col] / df[nearby_count_col]
 
     return df
 
+def add_perc_fires(df, kwargs): 
+    """Add the percent of nearby obs. that are fires (see `calc_perc_fires`). 
+
+    This just passes the `time_measures` keyword on to `calc_perc_fires`, so 
+    that it can be called like the other transformations in `create_inputs.py`. 
+
+    Args: 
+    ----
+        df: Pandas DataFrame
+        kwargs: dct
+            Holds the (optional) `time_measures` keyword. 
+
+    Return: 
+    ------
+        df: Pandas DataFrame
+    """
+
+    df = calc_perc_fires(df, kwargs.get('time_measures', None))
+
+    return df
@@ -0,0 +1,529 @@
+"""A module for counting nearby obs. using a spatial grid index.
+
+This module provides a batch alternative to the per-row `DataFrame.query` calls
+made in `geo_featurization.query_for_nearby_fires`. Rather than querying a
+DataFrame once per row (and once per date percentile), a single spatial grid
+index is built over NumPy arrays. Each cell of the grid is `dist_measure` wide
+in lat/long space, and the obs. within a cell are sorted by date. Any ob. that
+is "nearby" a given ob. then lies in the 3x3 block of cells around it, and the
+obs. in a cell that fall within a date range are a contiguous slice of the
+index that can be found with a binary search.
+
+The index can also be saved to disk as a set of `.npy` files and loaded back as
+read-only memory-maps. This is what allows the counts to be multiprocessed -
+worker processes attach to the same memory-mapped arrays (which the OS shares
+between them through its page cache) rather than each receiving a pickled copy,
+and are handed nothing more than the bounds of a contiguous chunk of rows.
+
+Counts can also be made over several radii (each no bigger than 
+`dist_measure`) in the same pass over the index - every candidate ob. found 
+for the largest radius is tagged with the smallest radius it falls within.
+
+Nearby is defined exactly as it is in `query_for_nearby_fires` - within +/-
+`dist_measure` (or each radius) in lat/long space, and with a `date_fire` between the start of
+the time window and the date of the ob. (inclusive). Nearby fires also need to
+have `fire_bool = True` and a `date_fire` strictly before the day of the ob.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from window_counts import WindowCounter, to_seconds, SECONDS_PER_DAY
+
+ARRAY_ATTRS = ['order', 'lat', 'lng', 'secs', 'fire_bool', 'cell_keys', 
+               'composite']
+SCALAR_ATTRS = ['dist_measure', 'max_pairs', 'cell_size', 'lat_cell_min', 
+                'long_cell_min', 'n_long_cells', 'min_secs', 'secs_span']
+
+# Holds the index loaded by a worker process, keyed by its directory, so that 
+# it is only attached to once per worker. 
+_worker_index = {}
+
+class GridIndex(object):
+    """Spatial grid index over lat/long coordinates, sorted by date within cells.
+
+    Args:
+    ----
+        lat: 1d np.ndarray
+        lng: 1d np.ndarray
+        dates: 1d np.ndarray
+            Holds `datetime64` values (or anything castable to them).
+        fire_bool: 1d np.ndarray
+        dist_measure: float
+            Holds how far to look in lat/long space for "nearby" obs. This is
+            also used as the width of each cell in the grid, and so is the 
+            largest radius that counts can be made over.
+        max_pairs (optional): int
+            Holds the max number of candidate (ob., nearby ob.) pairs to hold
+            in memory at once while counting.
+    """
+
+    def __init__(self, lat, lng, dates, fire_bool, dist_measure,
+                 max_pairs=2 ** 24):
+
+        self.dist_measure = dist_measure
+        self.max_pairs = max_pairs
+        # Cells are a hair wider than `dist_measure` so that float rounding can
+        # never push a nearby ob. two cells over.
+        self.cell_size = dist_measure * (1 + 1e-9)
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        secs = to_seconds(dates)
+        fire_bool = np.asarray(fire_bool, dtype=bool)
+
+        lat_cells, long_cells = self._get_cells(lat, lng)
+        self.lat_cell_min = lat_cells.min() - 1 if lat.shape[0] else 0
+        self.long_cell_min = long_cells.min() - 1 if lng.shape[0] else 0
+        self.n_long_cells = (long_cells.max() - self.long_cell_min + 2) \
+                if lng.shape[0] else 1
+        cell_keys = self._get_cell_keys(lat_cells, long_cells)
+
+        # Sort by cell, and then by date within each cell.
+        self.order = np.lexsort((secs, cell_keys))
+        self.lat, self.lng = lat[self.order], lng[self.order]
+        self.secs, self.fire_bool = secs[self.order], fire_bool[self.order]
+        cell_keys = cell_keys[self.order]
+
+        self.cell_keys, cell_starts, cell_counts = \
+                np.unique(cell_keys, return_index=True, return_counts=True)
+        self.min_secs = self.secs.min() if self.secs.shape[0] else 0
+        self.secs_span = (self.secs.max() - self.min_secs + 2) \
+                if self.secs.shape[0] else 2
+        # A (cell, date) composite key allows a single `np.searchsorted` call
+        # to find the date range within any number of cells at once.
+        cell_ranks = np.repeat(np.arange(self.cell_keys.shape[0]), cell_counts)
+        self.composite = cell_ranks * self.secs_span + \
+                (self.secs - self.min_secs)
+
+    def count_nearby(self, lat, lng, dates, time_measure):
+        """Count the nearby obs. and nearby fires for each inputted ob.
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+            time_measure: int
+                Holds how many days to go back in time to look for nearby obs.
+                A `time_measure` of 0 means going back to the start of the day.
+
+        Return:
+        ------
+            all_nearby_count: 1d np.ndarray
+            nearby_fires_count: 1d np.ndarray
+        """
+
+        all_nearby_counts, nearby_fires_counts = \
+                self.count_nearby_windows(lat, lng, dates, [time_measure])
+
+        return all_nearby_counts[:, 0], nearby_fires_counts[:, 0]
+
+    def count_nearby_windows(self, lat, lng, dates, time_measures, radii=None):
+        """Count the nearby obs. and fires for each ob. over many time windows.
+
+        The spatial neighbors of each ob. are only searched for once, over the
+        widest time window (and largest radius), and then split into the 
+        windows (and radii) by a `WindowCounter` (see `window_counts.py`).
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+            time_measures: list of ints
+                Holds how many days to go back in time for each window. A
+                `time_measure` of 0 means going back to the start of the day.
+            radii (optional): list of floats
+                Holds the radii to count over (each no bigger than 
+                `dist_measure`). Defaults to just `dist_measure`.
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per inputted ob. and one column per time measure
+                (in the order they were passed in), or per radius and time 
+                measure if `radii` are passed (see `WindowCounter.get_counts`).
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        window_counter = WindowCounter(dates, time_measures, radii)
+        self.add_nearby_pairs(lat, lng, window_counter)
+
+        return window_counter.get_counts()
+
+    def add_nearby_pairs(self, lat, lng, window_counter):
+        """Add the obs. in the index that are nearby each inputted ob. to a counter.
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            window_counter: WindowCounter
+                Holds the dates of the inputted obs. and the time windows (and 
+                radii) to count nearby obs. over. 
+        """
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        radii = window_counter.radii
+        if radii is not None and radii[-1] > self.dist_measure: 
+            raise RuntimeError('Radii can be no bigger than the dist_measure '
+                               'of the grid index')
+
+        query_idx, range_begs, range_ends = self._get_candidate_ranges(lat, 
+                lng, window_counter.min_secs, window_counter.secs)
+        for pair_query_idx, pair_idx in \
+                self._iter_candidate_pairs(query_idx, range_begs, range_ends):
+            if radii is None: 
+                nearby = self._in_box(lat[pair_query_idx], 
+                                      lng[pair_query_idx], pair_idx)
+                pair_radius_idx = None
+            else: 
+                # Boxes are nested, so the number of radii an ob. is within 
+                # gives the smallest of them. 
+                n_within = np.zeros(pair_idx.shape[0], dtype=np.int64)
+                for radius in radii: 
+                    n_within += self._in_box(lat[pair_query_idx], 
+                            lng[pair_query_idx], pair_idx, radius)
+                nearby = n_within > 0
+                pair_radius_idx = radii.shape[0] - n_within[nearby]
+            pair_query_idx, pair_idx = pair_query_idx[nearby], pair_idx[nearby]
+            window_counter.add_pairs(pair_query_idx, self.secs[pair_idx], 
+                                     self.fire_bool[pair_idx], pair_radius_idx)
+
+    def find_obs(self, lat, lng, dates): 
+        """Return the index position of each inputted ob. (-1 if it isn't in it).
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+
+        Return:
+        ------
+            positions: 1d np.ndarray
+        """
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        secs = to_seconds(dates)
+
+        positions = np.zeros(lat.shape[0], dtype=np.int64) - 1
+        query_idx, range_begs, range_ends = \
+                self._get_candidate_ranges(lat, lng, secs, secs)
+        for pair_query_idx, pair_idx in \
+                self._iter_candidate_pairs(query_idx, range_begs, range_ends):
+            same_ob = (self.lat[pair_idx] == lat[pair_query_idx]) & \
+                    (self.lng[pair_idx] == lng[pair_query_idx])
+            positions[pair_query_idx[same_ob]] = pair_idx[same_ob]
+
+        return positions
+
+    def find_later_obs(self, lat, lng, dates, max_days): 
+        """Return the index positions of obs. that may count the inputted obs.
+
+        An ob. in the index can only count one of the inputted obs. as nearby 
+        if it is in one of the cells around it, and is no more than `max_days` 
+        after it. This returns every such ob., which may include a few that 
+        aren't actually nearby. 
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+            max_days: int
+
+        Return:
+        ------
+            positions: 1d np.ndarray
+        """
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        secs = to_seconds(dates)
+
+        query_idx, range_begs, range_ends = self._get_candidate_ranges(lat, 
+                lng, secs, secs + max_days * SECONDS_PER_DAY)
+        positions = [pair_idx for _, pair_idx in 
+                self._iter_candidate_pairs(query_idx, range_begs, range_ends)]
+
+        if positions: 
+            return np.unique(np.concatenate(positions))
+        return np.zeros(0, dtype=np.int64)
+
+    def count_all_nearby_windows(self, time_measures, n_jobs=1, radii=None):
+        """Count the nearby obs. and fires over many windows for every indexed ob.
+
+        With `n_jobs` > 1, the index is saved to a temporary directory and the 
+        indexed obs. are split into large contiguous chunks (in index order, so 
+        that each chunk covers a compact area), which are counted by a pool of 
+        worker processes that memory-map the saved index. 
+
+        Args:
+        ----
+            time_measures: list of ints
+            n_jobs (optional): int
+                Holds the number of processes to use. -1 means use all cores.
+            radii (optional): list of floats
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per indexed ob. (in the order the obs. were 
+                originally passed in) and one column per time measure (or per 
+                radius and time measure, as in `count_nearby_windows`).
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        n_obs = self.lat.shape[0]
+        n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+        if n_jobs <= 1 or n_obs == 0: 
+            all_nearby_counts, nearby_fires_counts = self.count_nearby_windows(
+                    self.lat, self.lng, self.secs.astype('datetime64[s]'),
+                    time_measures, radii)
+        else: 
+            # A few chunks per process keeps them busy if some areas are denser.
+            n_chunks = min(n_jobs * 4, n_obs)
+            chunk_bounds = np.linspace(0, n_obs, n_chunks + 1).astype(int)
+            chunk_bounds = zip(chunk_bounds[:-1], chunk_bounds[1:])
+
+            index_dir = tempfile.mkdtemp(prefix='grid_index_')
+            try: 
+                self.save(index_dir)
+                pool = multiprocessing.Pool(n_jobs)
+                try: 
+                    chunk_counts = pool.map(_count_chunk_worker, 
+                            [(index_dir, time_measures, radii, beg, end) 
+                             for beg, end in chunk_bounds])
+                finally: 
+                    pool.close()
+                    pool.join()
+            finally: 
+                shutil.rmtree(index_dir)
+
+            all_nearby_counts = np.concatenate([counts[0] for counts in 
+                                                chunk_counts])
+            nearby_fires_counts = np.concatenate([counts[1] for counts in 
+                                                  chunk_counts])
+
+        # Put the counts back in the order the obs. were passed in. 
+        input_order_counts = np.empty_like(all_nearby_counts)
+        input_order_counts[self.order] = all_nearby_counts
+        input_order_fires = np.empty_like(nearby_fires_counts)
+        input_order_fires[self.order] = nearby_fires_counts
+
+        return input_order_counts, input_order_fires
+
+    def save(self, dir_path):
+        """Save the index to `dir_path` as `.npy` files (plus a small pickle).
+
+        Args:
+        ----
+            dir_path: str
+        """
+
+        for attr in ARRAY_ATTRS: 
+            np.save(os.path.join(dir_path, attr + '.npy'), getattr(self, attr))
+        scalars = dict((attr, getattr(self, attr)) for attr in SCALAR_ATTRS)
+        with open(os.path.join(dir_path, 'scalars.pkl'), 'w+') as f: 
+            pickle.dump(scalars, f)
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        """Load an index saved with `save`, memory-mapping its arrays. 
+
+        Args:
+        ----
+            dir_path: str
+            mmap_mode (optional): str or None
+                Passed to `np.load`. None reads the arrays fully into memory.
+
+        Return:
+        ------
+            grid_index: GridIndex
+        """
+
+        grid_index = cls.__new__(cls)
+        for attr in ARRAY_ATTRS: 
+            setattr(grid_index, attr, np.load(os.path.join(dir_path, 
+                attr + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(dir_path, 'scalars.pkl')) as f: 
+            scalars = pickle.load(f)
+        for attr, val in scalars.iteritems(): 
+            setattr(grid_index, attr, val)
+
+        return grid_index
+
+    def _get_cells(self, lat, lng):
+        """Return the integer lat/long grid cell coordinates of each ob."""
+
+        lat_cells = np.floor(lat / self.cell_size).astype(np.int64)
+        long_cells = np.floor(lng / self.cell_size).astype(np.int64)
+
+        return lat_cells, long_cells
+
+    def _get_cell_keys(self, lat_cells, long_cells):
+        """Return a single integer key for each lat/long grid cell."""
+
+        return (lat_cells - self.lat_cell_min) * self.n_long_cells + \
+                (long_cells - self.long_cell_min)
+
+    def _get_candidate_ranges(self, lat, lng, min_secs, max_secs):
+        """Find the index ranges holding candidate nearby obs. for each query.
+
+        For each query ob., look at the 3x3 block of cells around it, and find
+        the contiguous range of each cell whose obs. have a date between
+        `min_secs` and `max_secs` (inclusive).
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            min_secs: 1d np.ndarray
+            max_secs: 1d np.ndarray
+
+        Return:
+        ------
+            query_idx: 1d np.ndarray
+                Holds which query ob. each range belongs to.
+            range_begs: 1d np.ndarray
+            range_ends: 1d np.ndarray
+        """
+
+        lat_cells, long_cells = self._get_cells(lat, lng)
+        n_cells = self.cell_keys.shape[0]
+        rel_min_secs = np.clip(min_secs - self.min_secs, 0,
+                               self.secs_span - 1)
+        rel_max_secs = np.clip(max_secs - self.min_secs, -1,
+                               self.secs_span - 1)
+
+        query_idx_lst, range_begs_lst, range_ends_lst = [], [], []
+        for lat_offset in (-1, 0, 1):
+            for long_offset in (-1, 0, 1):
+                nbr_long_cells = long_cells + long_offset
+                nbr_keys = self._get_cell_keys(lat_cells + lat_offset,
+                                               nbr_long_cells)
+                nbr_ranks = np.searchsorted(self.cell_keys, nbr_keys)
+                nbr_ranks = np.minimum(nbr_ranks, max(n_cells - 1, 0))
+                rel_long_cells = nbr_long_cells - self.long_cell_min
+                valid = (rel_long_cells >= 0) & \
+                        (rel_long_cells < self.n_long_cells)
+                if n_cells:
+                    valid &= self.cell_keys[nbr_ranks] == nbr_keys
+                else:
+                    valid[:] = False
+
+                valid_idx = np.where(valid)[0]
+                nbr_ranks = nbr_ranks[valid_idx]
+                range_begs = np.searchsorted(self.composite,
+                        nbr_ranks * self.secs_span + rel_min_secs[valid_idx],
+                        side='left')
+                range_ends = np.searchsorted(self.composite,
+                        nbr_ranks * self.secs_span + rel_max_secs[valid_idx],
+                        side='right')
+                query_idx_lst.append(valid_idx)
+                range_begs_lst.append(range_begs)
+                range_ends_lst.append(range_ends)
+
+        query_idx = np.concatenate(query_idx_lst)
+        range_begs = np.concatenate(range_begs_lst)
+        range_ends = np.maximum(np.concatenate(range_ends_lst), range_begs)
+
+        return query_idx, range_begs, range_ends
+
+    def _iter_candidate_pairs(self, query_idx, range_begs, range_ends):
+        """Yield (query ob., candidate ob.) index pairs in bounded batches.
+
+        Expand each range into the individual index positions that it holds,
+        yielding no more than `self.max_pairs` pairs at a time (unless a single
+        range holds more than that).
+
+        Args:
+        ----
+            query_idx: 1d np.ndarray
+            range_begs: 1d np.ndarray
+            range_ends: 1d np.ndarray
+
+        Yields:
+        ------
+            pair_query_idx: 1d np.ndarray
+            pair_idx: 1d np.ndarray
+        """
+
+        range_lens = range_ends - range_begs
+        cum_lens = np.cumsum(range_lens)
+        n_ranges = range_lens.shape[0]
+
+        batch_beg = 0
+        while batch_beg < n_ranges:
+            pairs_before = cum_lens[batch_beg] - range_lens[batch_beg]
+            batch_end = np.searchsorted(cum_lens, pairs_before + self.max_pairs,
+                                        side='right')
+            batch_end = max(batch_end, batch_beg + 1)
+
+            lens = range_lens[batch_beg:batch_end]
+            n_pairs = lens.sum()
+            if n_pairs:
+                pair_query_idx = np.repeat(query_idx[batch_beg:batch_end], lens)
+                lens_before = np.cumsum(lens) - lens
+                pair_idx = np.repeat(range_begs[batch_beg:batch_end] -
+                                     lens_before, lens) + np.arange(n_pairs)
+                yield pair_query_idx, pair_idx
+            batch_beg = batch_end
+
+    def _in_box(self, lat, lng, pair_idx, dist_measure=None):
+        """Return whether each candidate ob. is within the box around the query.
+
+        The comparisons are written the same way as in `query_for_nearby_fires`
+        so that obs. sitting right on the edge of the box are treated identically.
+        The box is +/- `dist_measure` (defaulting to that of the index).
+        """
+
+        if dist_measure is None: 
+            dist_measure = self.dist_measure
+        lat_min, lat_max = lat - dist_measure, lat + dist_measure
+        long_min, long_max = lng - dist_measure, lng + dist_measure
+        cand_lat, cand_lng = self.lat[pair_idx], self.lng[pair_idx]
+
+        return (cand_lat >= lat_min) & (cand_lat <= lat_max) & \
+                (cand_lng >= long_min) & (cand_lng <= long_max)
+
+def _count_chunk_worker(args):
+    """Count nearby obs./fires for a contiguous chunk of the indexed obs.
+
+    This is the function multiprocessed from `count_all_nearby_windows`. Only 
+    the index directory and the chunk bounds are sent to the worker, and only 
+    compact count arrays are sent back. 
+
+    Args:
+    ----
+        args: tuple
+            Holds the index directory, the time measures, the radii (or None), 
+            and the beginning and end (exclusive) of the chunk of indexed obs. 
+            to count for.
+
+    Return:
+    ------
+        all_nearby_counts: 2d np.ndarray
+        nearby_fires_counts: 2d np.ndarray
+    """
+
+    index_dir, time_measures, radii, beg, end = args
+    if index_dir not in _worker_index: 
+        _worker_index.clear()
+        _worker_index[index_dir] = GridIndex.load(index_dir)
+    grid_index = _worker_index[index_dir]
+
+    all_nearby_counts, nearby_fires_counts = grid_index.count_nearby_windows(
+            grid_index.lat[beg:end], grid_index.lng[beg:end], 
+            grid_index.secs[beg:end].astype('datetime64[s]'), time_measures, 
+            radii)
+
+    return all_nearby_counts.astype(np.int32), \
+            nearby_fires_counts.astype(np.int32)
@@ -0,0 +1,106 @@
+"""A module for counting nearby obs. within a radius (in kilometers).
+
+The grid index in `grid_index.py` defines "nearby" as +/- `dist_measure` in
+lat/long space, which covers a smaller and smaller ground area the further
+north an ob. is (a degree of longitude shrinks with the cosine of latitude).
+This module instead defines "nearby" as within some great-circle distance
+(in kilometers), found with a haversine radius query on a `BallTree`.
+
+The radius queries are made in batch over chunks of obs., and the time windows
+are counted with the same `WindowCounter` (see `window_counts.py`) that the
+grid index uses, so the two only differ in what they consider nearby in space.
+"""
+
+import numpy as np
+from sklearn.neighbors import BallTree
+from window_counts import WindowCounter, to_seconds
+
+EARTH_RADIUS_KM = 6371.0088
+
+class HaversineIndex(object):
+    """Ball tree index over lat/long coordinates using the haversine metric.
+
+    Args:
+    ----
+        lat: 1d np.ndarray
+        lng: 1d np.ndarray
+        dates: 1d np.ndarray
+            Holds `datetime64` values (or anything castable to them).
+        fire_bool: 1d np.ndarray
+        radius_km: float
+            Holds how far (in kilometers) to look for "nearby" obs.
+        chunk_size (optional): int
+            Holds the number of obs. to run radius queries for at once.
+    """
+
+    def __init__(self, lat, lng, dates, fire_bool, radius_km,
+                 chunk_size=2 ** 14):
+
+        self.radius_km = radius_km
+        self.chunk_size = chunk_size
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.secs = to_seconds(dates)
+        self.fire_bool = np.asarray(fire_bool, dtype=bool)
+
+        self.tree = BallTree(_to_radians(self.lat, self.lng),
+                             metric='haversine')
+
+    def count_nearby_windows(self, lat, lng, dates, time_measures):
+        """Count the nearby obs. and fires for each ob. over many time windows.
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+            time_measures: list of ints
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per inputted ob. and one column per time measure
+                (in the order they were passed in).
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        coords = _to_radians(np.asarray(lat, dtype=np.float64),
+                             np.asarray(lng, dtype=np.float64))
+        window_counter = WindowCounter(dates, time_measures)
+        radius = self.radius_km / EARTH_RADIUS_KM
+
+        for beg in xrange(0, coords.shape[0], self.chunk_size):
+            end = min(beg + self.chunk_size, coords.shape[0])
+            nbrs_lst = self.tree.query_radius(coords[beg:end], r=radius)
+            nbrs_lens = np.array([nbrs.shape[0] for nbrs in nbrs_lst])
+            if not nbrs_lens.sum():
+                continue
+            pair_query_idx = np.repeat(np.arange(beg, end), nbrs_lens)
+            pair_idx = np.concatenate(nbrs_lst)
+            window_counter.add_pairs(pair_query_idx, self.secs[pair_idx],
+                                     self.fire_bool[pair_idx])
+
+        return window_counter.get_counts()
+
+    def count_all_nearby_windows(self, time_measures):
+        """Count the nearby obs. and fires over many windows for every indexed ob.
+
+        Args:
+        ----
+            time_measures: list of ints
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per indexed ob. (in the order the obs. were
+                passed in) and one column per time measure.
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        return self.count_nearby_windows(self.lat, self.lng,
+                self.secs.astype('datetime64[s]'), time_measures)
+
+def _to_radians(lat, lng):
+    """Return a 2d array of (lat, long) in radians, as `BallTree` expects."""
+
+    return np.radians(np.column_stack([lat, lng]))
@@ -0,0 +1,448 @@
+"""A module for keeping nearby fires counts up to date as new obs. come in.
+
+Calculating the nearby fires counts from scratch means building an index over
+every ob. and counting for every ob. When a new day of detections comes in,
+though, very few of the counts actually change - only those for the new obs.,
+and for any later obs. that count a new ob. as nearby. The `NearbyFiresTable`
+class holds the per-row counts along with the index used to calculate them
+(and can be saved to/loaded from disk), and its `update` method only counts
+for those rows whose counts can have changed.
+
+The index is kept in two segments - a main `GridIndex` over most of the rows,
+and a recent `GridIndex` over the rows added since the main one was built.
+An update only rebuilds the (small) recent segment, and the recent segment is
+folded into the main one once it grows past a fraction of its size. Since
+the two segments hold disjoint sets of rows, the nearby obs. found in each
+are simply added together.
+
+When a saved table is loaded, the main segment is memory-mapped (copy on
+write), and it's only written back out when it was rebuilt (if any of its rows
+were relabeled, only its `fire_bool` is) - so loading, updating, and saving a
+table doesn't read or rewrite the bulk of the index. The capacity of the row arrays
+is saved too, so the first append after a load doesn't have to grow them.
+"""
+
+import os
+import shutil
+import pickle
+import numpy as np
+import pandas as pd
+from grid_index import GridIndex
+from window_counts import WindowCounter, to_seconds
+
+KEY_COLS = ['lat', 'long', 'date_fire']
+# The per-row arrays of a table (each saved as `<attr>.npy`).
+ROW_ATTRS = ['lat', 'lng', 'secs', 'fire_bool', 'all_nearby_counts',
+             'nearby_fires_counts']
+
+class NearbyFiresTable(object):
+    """Per-row nearby fires counts, along with the index used to calculate them.
+
+    Rows are identified by their row id, which is the order in which they were
+    added to the table. Each row is a unique lat/long/date_fire combination.
+
+    Args:
+    ----
+        dist_measure: float
+        time_measures: list of ints
+        merge_frac (optional): float
+            Holds how big (as a fraction of the main segment) the recent segment
+            of the index can grow before it is folded into the main segment.
+    """
+
+    def __init__(self, dist_measure, time_measures, merge_frac=0.1):
+
+        self.dist_measure = dist_measure
+        self.time_measures = list(time_measures)
+        self.merge_frac = merge_frac
+
+        self.n_rows = 0
+        self._lat = np.zeros(0, dtype=np.float64)
+        self._lng = np.zeros(0, dtype=np.float64)
+        self._secs = np.zeros(0, dtype=np.int64)
+        self._fire_bool = np.zeros(0, dtype=bool)
+        self._all_nearby_counts = np.zeros((0, len(time_measures)),
+                                           dtype=np.int64)
+        self._nearby_fires_counts = np.zeros((0, len(time_measures)),
+                                             dtype=np.int64)
+        # Holds (first row id, GridIndex) for the main and recent segments.
+        self.segments = []
+        # Holds the folder the main segment was loaded from (or last saved
+        # to), and whether it has been rebuilt or relabeled since.
+        self._main_segment_dir = None
+        self._main_rebuilt = True
+        self._main_relabeled = False
+
+    @classmethod
+    def build(cls, df, dist_measure, time_measures, n_jobs=1):
+        """Build a table from scratch, counting for every row.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+                Holds the `lat`, `long`, `date_fire`, and `fire_bool` columns,
+                with no duplicate lat/long/date_fire combinations.
+            dist_measure: float
+            time_measures: list of ints
+            n_jobs (optional): int
+
+        Return:
+        ------
+            table: NearbyFiresTable
+        """
+
+        table = cls(dist_measure, time_measures)
+        table._append_rows(df)
+        table._rebuild_segments(merge=True)
+
+        all_nearby_counts, nearby_fires_counts = \
+                table.segments[0][1].count_all_nearby_windows(time_measures,
+                                                              n_jobs)
+        table._all_nearby_counts[:table.n_rows] = all_nearby_counts
+        table._nearby_fires_counts[:table.n_rows] = nearby_fires_counts
+
+        return table
+
+    @classmethod
+    def from_counts(cls, df, dist_measure, time_measures, all_nearby_counts,
+                    nearby_fires_counts):
+        """Build a table from counts that were already calculated for every row
+        (e.g. tile by tile, see `spatial_tiles.py`), without recounting.
+
+        Args:
+        ----
+            df: Pandas DataFrame
+                Holds the `lat`, `long`, `date_fire`, and `fire_bool` columns,
+                with no duplicate lat/long/date_fire combinations.
+            dist_measure: float
+            time_measures: list of ints
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per row of `df` and one column per time measure.
+            nearby_fires_counts: 2d np.ndarray
+
+        Return:
+        ------
+            table: NearbyFiresTable
+        """
+
+        table = cls(dist_measure, time_measures)
+        table._append_rows(df)
+        table._rebuild_segments(merge=True)
+        table._all_nearby_counts[:table.n_rows] = all_nearby_counts
+        table._nearby_fires_counts[:table.n_rows] = nearby_fires_counts
+
+        return table
+
+    def update(self, new_rows):
+        """Add new rows to the table, and recount for any rows this affects.
+
+        Rows in `new_rows` whose lat/long/date_fire are already in the table
+        replace the `fire_bool` of that row (e.g. once fire perimeters for a
+        day have been posted). All other rows are added to the table. Counts
+        are then recalculated for the added rows, and for any rows that may
+        count an added or relabeled row as nearby. Afterwards, the table holds
+        the same counts a full rebuild over all rows would give.
+
+        Args:
+        ----
+            new_rows: Pandas DataFrame
+                Holds the `lat`, `long`, `date_fire`, and `fire_bool` columns.
+
+        Return:
+        ------
+            row_ids: 1d np.ndarray
+                Holds the row ids of every row whose counts were recalculated.
+        """
+
+        new_rows = new_rows[KEY_COLS + ['fire_bool']].drop_duplicates(KEY_COLS)
+        lat = new_rows['lat'].values.astype(np.float64)
+        lng = new_rows['long'].values.astype(np.float64)
+        dates = new_rows['date_fire'].values
+        fire_bool = new_rows['fire_bool'].values.astype(bool)
+
+        existing_ids = self._find_rows(lat, lng, dates)
+        is_existing = existing_ids >= 0
+        relabeled = is_existing.copy()
+        relabeled[is_existing] = \
+                self._fire_bool[existing_ids[is_existing]] != fire_bool[is_existing]
+        self._relabel(existing_ids[relabeled], fire_bool[relabeled])
+
+        first_new_id = self.n_rows
+        self._append_rows(new_rows[~is_existing])
+        added_ids = np.arange(first_new_id, self.n_rows)
+        main_size = self.segments[0][1].lat.shape[0] if self.segments else 0
+        self._rebuild_segments(merge=self.n_rows - main_size >
+                               self.merge_frac * main_size)
+
+        changed = ~is_existing | relabeled
+        affected_ids = self._find_affected_rows(lat[changed], lng[changed],
+                                                dates[changed])
+        row_ids = np.union1d(affected_ids, added_ids)
+        self._recount(row_ids)
+
+        return row_ids
+
+    def get_row_ids(self, df):
+        """Return the row id of each row of `df` (-1 if it isn't in the table).
+
+        Args:
+        ----
+            df: Pandas DataFrame
+                Holds the `lat`, `long`, and `date_fire` columns.
+
+        Return:
+        ------
+            row_ids: 1d np.ndarray
+        """
+
+        return self._find_rows(df['lat'].values.astype(np.float64),
+                               df['long'].values.astype(np.float64),
+                               df['date_fire'].values)
+
+    def get_counts(self, row_ids=None):
+        """Return the counts of each row, aligned with `row_ids`.
+
+        Args:
+        ----
+            row_ids (optional): 1d np.ndarray
+                Holds the rows to return. Defaults to all rows.
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per row id and one column per time measure.
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        if row_ids is None:
+            row_ids = np.arange(self.n_rows)
+
+        return self._all_nearby_counts[row_ids], \
+                self._nearby_fires_counts[row_ids]
+
+    def get_counts_df(self, row_ids=None):
+        """Return a DataFrame of the lat/long/date_fire and counts of each row.
+
+        Args:
+        ----
+            row_ids (optional): 1d np.ndarray
+                Holds the rows to return. Defaults to all rows.
+
+        Return:
+        ------
+            counts_df: Pandas DataFrame
+        """
+
+        if row_ids is None:
+            row_ids = np.arange(self.n_rows)
+
+        counts_df = pd.DataFrame({'lat': self._lat[row_ids],
+                'long': self._lng[row_ids],
+                'date_fire': self._secs[row_ids].astype('datetime64[s]')},
+                columns=KEY_COLS)
+        for col_idx, time_measure in enumerate(self.time_measures):
+            counts_df['all_nearby_count' + str(time_measure)] = \
+                    self._all_nearby_counts[row_ids, col_idx]
+            counts_df['all_nearby_fires' + str(time_measure)] = \
+                    self._nearby_fires_counts[row_ids, col_idx]
+
+        return counts_df
+
+    def save(self, dir_path):
+        """Save the table (rows, counts, and index segments) to `dir_path`.
+
+        The main segment of the index is only written if it has been rebuilt
+        since it was loaded from (or last saved to) `dir_path`, and only its
+        `fire_bool` if any of its rows have been relabeled.
+
+        Args:
+        ----
+            dir_path: str
+        """
+
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+
+        for attr in ROW_ATTRS:
+            np.save(os.path.join(dir_path, attr + '.npy'),
+                    getattr(self, '_' + attr)[:self.n_rows])
+        segment_bases = []
+        for segment_idx, (base, grid_index) in enumerate(self.segments):
+            segment_dir = os.path.join(dir_path, 'segment_{}'.format(segment_idx))
+            if segment_idx > 0 or self._main_rebuilt or \
+                    self._main_segment_dir != os.path.abspath(segment_dir):
+                _save_segment(grid_index, segment_dir)
+            elif self._main_relabeled:
+                _save_array(grid_index.fire_bool,
+                            os.path.join(segment_dir, 'fire_bool.npy'))
+            segment_bases.append(base)
+        # Remove the recent segment left over from before a merge.
+        segment_dir = os.path.join(dir_path, 'segment_{}'.format(
+            len(self.segments)))
+        if os.path.exists(segment_dir):
+            shutil.rmtree(segment_dir)
+        if self.segments:
+            self._main_segment_dir = os.path.abspath(os.path.join(dir_path,
+                                                                  'segment_0'))
+            self._main_rebuilt, self._main_relabeled = False, False
+
+        scalars = {'dist_measure': self.dist_measure,
+                   'time_measures': self.time_measures,
+                   'merge_frac': self.merge_frac,
+                   'segment_bases': segment_bases,
+                   'capacity': self._lat.shape[0]}
+        with open(os.path.join(dir_path, 'table.pkl'), 'w+') as f:
+            pickle.dump(scalars, f)
+
+    @classmethod
+    def load(cls, dir_path):
+        """Load a table saved with `save`.
+
+        The main segment of the index is memory-mapped (copy on write, so
+        relabeling its rows doesn't touch the saved files until it's saved).
+
+        Args:
+        ----
+            dir_path: str
+
+        Return:
+        ------
+            table: NearbyFiresTable
+        """
+
+        with open(os.path.join(dir_path, 'table.pkl')) as f:
+            scalars = pickle.load(f)
+
+        table = cls(scalars['dist_measure'], scalars['time_measures'],
+                    scalars['merge_frac'])
+        for attr in ROW_ATTRS:
+            saved = np.load(os.path.join(dir_path, attr + '.npy'),
+                            mmap_mode='r')
+            capacity = max(scalars.get('capacity', 0), saved.shape[0])
+            arr = np.zeros((capacity, ) + saved.shape[1:], dtype=saved.dtype)
+            arr[:saved.shape[0]] = saved
+            setattr(table, '_' + attr, arr)
+        table.n_rows = saved.shape[0]
+        for segment_idx, base in enumerate(scalars['segment_bases']):
+            segment_dir = os.path.join(dir_path, 'segment_{}'.format(segment_idx))
+            table.segments.append((base, GridIndex.load(segment_dir,
+                mmap_mode='c' if segment_idx == 0 else None)))
+        table._main_segment_dir = os.path.abspath(os.path.join(dir_path,
+                                                               'segment_0'))
+        table._main_rebuilt = False
+
+        return table
+
+    def _append_rows(self, df):
+        """Append the rows of `df` to the table (without counting for them).
+
+        The row arrays are grown by doubling their capacity, so that appending
+        a day's worth of rows doesn't copy every row each time.
+        """
+
+        n_new = df.shape[0]
+        n_rows = self.n_rows + n_new
+        if n_rows > self._lat.shape[0]:
+            capacity = max(n_rows, 2 * self._lat.shape[0])
+            for attr in ['_lat', '_lng', '_secs', '_fire_bool',
+                         '_all_nearby_counts', '_nearby_fires_counts']:
+                arr = getattr(self, attr)
+                grown = np.zeros((capacity, ) + arr.shape[1:], dtype=arr.dtype)
+                grown[:self.n_rows] = arr[:self.n_rows]
+                setattr(self, attr, grown)
+
+        self._lat[self.n_rows:n_rows] = df['lat'].values
+        self._lng[self.n_rows:n_rows] = df['long'].values
+        self._secs[self.n_rows:n_rows] = to_seconds(df['date_fire'].values)
+        self._fire_bool[self.n_rows:n_rows] = df['fire_bool'].values
+        self.n_rows = n_rows
+
+    def _rebuild_segments(self, merge):
+        """Rebuild the recent segment of the index (or all of it if `merge`)."""
+
+        if merge or not self.segments:
+            bases = [0]
+            self._main_rebuilt = True
+        else:
+            bases = [0, self.segments[0][1].lat.shape[0]]
+        ends = bases[1:] + [self.n_rows]
+
+        segments = self.segments[:1] if len(bases) == 2 else []
+        base, end = bases[-1], ends[-1]
+        grid_index = GridIndex(self._lat[base:end], self._lng[base:end],
+                               self._secs[base:end].astype('datetime64[s]'),
+                               self._fire_bool[base:end], self.dist_measure)
+        segments.append((base, grid_index))
+        self.segments = segments
+
+    def _find_rows(self, lat, lng, dates):
+        """Return the row id of each inputted ob. (-1 if it isn't in the table)."""
+
+        row_ids = np.zeros(lat.shape[0], dtype=np.int64) - 1
+        for base, grid_index in self.segments:
+            positions = grid_index.find_obs(lat, lng, dates)
+            found = positions >= 0
+            row_ids[found] = base + grid_index.order[positions[found]]
+
+        return row_ids
+
+    def _relabel(self, row_ids, fire_bool):
+        """Replace the `fire_bool` of the inputted rows, in the index as well."""
+
+        self._fire_bool[row_ids] = fire_bool
+        for base, grid_index in self.segments:
+            in_segment = (row_ids >= base) & \
+                    (row_ids < base + grid_index.lat.shape[0])
+            if not in_segment.any():
+                continue
+            if base == 0:
+                self._main_relabeled = True
+            positions = np.empty_like(grid_index.order)
+            positions[grid_index.order] = np.arange(grid_index.order.shape[0])
+            grid_index.fire_bool[positions[row_ids[in_segment] - base]] = \
+                    fire_bool[in_segment]
+
+    def _find_affected_rows(self, lat, lng, dates):
+        """Return the row ids of rows that may count any inputted ob. as nearby."""
+
+        max_days = max(max(self.time_measures), 1)
+        row_ids_lst = [np.zeros(0, dtype=np.int64)]
+        for base, grid_index in self.segments:
+            positions = grid_index.find_later_obs(lat, lng, dates, max_days)
+            row_ids_lst.append(base + grid_index.order[positions])
+
+        return np.unique(np.concatenate(row_ids_lst))
+
+    def _recount(self, row_ids):
+        """Recalculate the counts for the inputted rows across all segments."""
+
+        window_counter = WindowCounter(
+                self._secs[row_ids].astype('datetime64[s]'), self.time_measures)
+        for _, grid_index in self.segments:
+            grid_index.add_nearby_pairs(self._lat[row_ids], self._lng[row_ids],
+                                        window_counter)
+
+        all_nearby_counts, nearby_fires_counts = window_counter.get_counts()
+        self._all_nearby_counts[row_ids] = all_nearby_counts
+        self._nearby_fires_counts[row_ids] = nearby_fires_counts
+
+def _save_segment(grid_index, segment_dir):
+    """Save a segment of the index, replacing any saved in `segment_dir`.
+
+    The segment is written to a new folder that's then moved into place,
+    since the arrays being saved may be memory-mapped from the old files.
+    """
+
+    tmp_dir = '{}.tmp{}'.format(segment_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    grid_index.save(tmp_dir)
+    if os.path.exists(segment_dir):
+        shutil.rmtree(segment_dir)
+    os.rename(tmp_dir, segment_dir)
+
+def _save_array(arr, filepath):
+    """Save an array over `filepath`, which it may be memory-mapped from."""
+
+    tmp_filepath = '{}.tmp{}.npy'.format(filepath[:-len('.npy')], os.getpid())
+    np.save(tmp_filepath, arr)
+    os.rename(tmp_filepath, filepath)
@@ -0,0 +1,185 @@
+"""A module for one-hot encoding columns against a fixed vocabulary.
+
+`pd.get_dummies` creates a dummy for whatever values happen to be in the data
+it's given, so a dummy (e.g. `year_2015` or `src_uaf`) is missing from any
+slice of the data that lacks its value. Here, the categories of each column
+are fixed up front in a `OneHotVocab`, which is saved alongside the model
+inputs so that every run (and the modeling code, see
+`code/modeling/model_matrix.py`) agrees on the dummies. The vocabulary only
+ever grows - new values are added as they show up in the data, and old ones
+are kept - so a dummy never disappears from one run to the next.
+
+`encode_one_hot` encodes the values of a column against its categories, as
+either a dense uint8 block or a sparse (CSR) matrix holding a single one per
+row (none for values that aren't in the vocabulary).
+"""
+
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+class OneHotVocab(object):
+    """The categories to create dummies for, for each dummied column.
+
+    Args:
+    ----
+        categories (optional): dct
+            Holds the (sorted) list of categories of each column.
+    """
+
+    def __init__(self, categories=None):
+        self.categories = {} if categories is None else categories
+
+    @classmethod
+    def load(cls, filepath):
+        """Load a saved vocabulary (an empty one if none has been saved).
+
+        Args:
+        ----
+            filepath: str
+
+        Return:
+        ------
+            vocab: OneHotVocab
+        """
+
+        if not os.path.exists(filepath):
+            return cls()
+        with open(filepath) as f:
+            return cls(pickle.load(f))
+
+    def save(self, filepath):
+        """Save the vocabulary (as a plain dct of lists, so that it can be
+        read without this module).
+
+        Args:
+        ----
+            filepath: str
+        """
+
+        dirpath = os.path.dirname(filepath)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        with open(filepath, 'w+') as f:
+            pickle.dump(self.categories, f)
+
+    def update(self, col, categories):
+        """Add any new categories of a column to the vocabulary.
+
+        Args:
+        ----
+            col: str
+            categories: list
+                Holds the values of the column in the current data (see
+                `general_featurization.get_dummies_categories`).
+        """
+
+        self.categories[col] = sorted(set(self.categories.get(col, [])) |
+                                      set(categories))
+
+    def get_categories(self, col):
+        """Return the categories of a column.
+
+        Args:
+        ----
+            col: str
+
+        Return:
+        ------
+            categories: list
+        """
+
+        if col not in self.categories:
+            raise RuntimeError('The column {} is not in the one-hot '
+                               'vocabulary'.format(col))
+
+        return self.categories[col]
+
+    def get_feature_names(self, col):
+        """Return the names of the dummies of a column (e.g. `src_uaf`).
+
+        Args:
+        ----
+            col: str
+
+        Return:
+        ------
+            feature_names: list of strs
+        """
+
+        return get_feature_names(col, self.get_categories(col))
+
+def get_feature_names(col, categories):
+    """Return the names of the dummies of a column, as `pd.get_dummies` would.
+
+    Args:
+    ----
+        col: str
+        categories: list
+
+    Return:
+    ------
+        feature_names: list of strs
+    """
+
+    return ['{}_{}'.format(col, category) for category in categories]
+
+def encode_one_hot(values, categories, sparse_output=False):
+    """One-hot encode the values against the categories.
+
+    Args:
+    ----
+        values: 1d np.ndarray or Pandas Series
+        categories: list
+        sparse_output (optional): bool
+            Holds whether to return a CSR matrix rather than a dense block.
+
+    Return:
+    ------
+        one_hot: 2d np.ndarray (uint8) or scipy.sparse.csr_matrix (uint8)
+            Holds a row for each value, with a one in the column of its
+            category (and all zeros if it isn't one of the categories).
+    """
+
+    codes = pd.Categorical(values, categories=categories).codes
+
+    return encode_codes(codes, len(categories), sparse_output)
+
+def encode_codes(codes, n_categories, sparse_output=False, dtype=np.uint8,
+                 out=None):
+    """One-hot encode the category codes (-1 for no category).
+
+    Args:
+    ----
+        codes: 1d np.ndarray of ints
+        n_categories: int
+        sparse_output (optional): bool
+        dtype (optional): np.dtype
+        out (optional): 2d np.ndarray
+            Holds a (dense) block to write the dummies into (e.g. the columns
+            of a larger matrix), rather than allocating a new one.
+
+    Return:
+    ------
+        one_hot: 2d np.ndarray or scipy.sparse.csr_matrix (of `dtype`)
+    """
+
+    has_category = codes >= 0
+    if sparse_output:
+        indptr = np.zeros(codes.shape[0] + 1, dtype=np.int64)
+        np.cumsum(has_category, out=indptr[1:])
+        indices = codes[has_category].astype(np.int32)
+        data = np.ones(indices.shape[0], dtype=dtype)
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=(codes.shape[0], n_categories))
+
+    if out is None:
+        out = np.zeros((codes.shape[0], n_categories), dtype=dtype)
+    else:
+        out[:] = 0
+    rows = np.flatnonzero(has_category)
+    out[rows, codes[rows]] = 1
+
+    return out
@@ -0,0 +1,302 @@
+"""A module for approximating nearby obs. counts with a dense raster cube.
+
+The 365, 730, and 1095 day windows are by far the most expensive counts to
+calculate exactly, since every ob. has years' worth of nearby obs. to go
+through. This module instead bins every ob. into a dense (time bin x lat cell
+x long cell) cube - one for all obs. and one for fires - and turns each cube
+into a summed-volume table (cumulative sums along all three axes). The count
+within any box in lat/long/time space is then a constant number of lookups,
+no matter how many obs. are in it.
+
+Boxes don't line up with the cells, so counts are estimated by assuming obs.
+are spread evenly within each cell (i.e. the summed-volume table is linearly
+interpolated along each axis). That assumption is worst right around an ob.,
+where its own fire is burning, so the windows can be cut off some number of
+days before each ob. (`end_offset_days`) and the most recent days counted
+exactly instead. The counts are still approximate - the `cube_error_report`
+function measures how far off they are from the exact (grid index) counts, so
+that the cell size can be picked against accuracy.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from grid_index import GridIndex
+from window_counts import to_seconds, SECONDS_PER_DAY
+
+class RasterCube(object):
+    """Summed-volume tables of obs. and fires over time bins and lat/long cells.
+
+    Args:
+    ----
+        lat: 1d np.ndarray
+        lng: 1d np.ndarray
+        dates: 1d np.ndarray
+        fire_bool: 1d np.ndarray
+        dist_measure: float
+            Holds how far to look in lat/long space for "nearby" obs.
+        cell_size (optional): float
+            Holds the width of each lat/long cell. Defaults to `dist_measure`.
+        time_bin_days (optional): int
+            Holds the number of days in each time bin.
+        max_cells (optional): int
+            Holds the most cells the cube may have. The cube is dense, so its
+            size grows with the extent of the data rather than the number of
+            obs., and a cube that is too fine for the extent raises a
+            RuntimeError rather than running out of memory.
+    """
+
+    def __init__(self, lat, lng, dates, fire_bool, dist_measure,
+                 cell_size=None, time_bin_days=1, max_cells=2 ** 27):
+
+        self.dist_measure = dist_measure
+        self.cell_size = dist_measure if cell_size is None else cell_size
+        self.bin_secs = time_bin_days * SECONDS_PER_DAY
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        secs = to_seconds(dates)
+        fire_bool = np.asarray(fire_bool, dtype=bool)
+
+        # Leave room for boxes around the obs. on the edges of the data.
+        margin = dist_measure + self.cell_size
+        self.lat_origin = lat.min() - margin
+        self.long_origin = lng.min() - margin
+        self.secs_origin = secs.min() - secs.min() % SECONDS_PER_DAY
+        time_bins = (secs - self.secs_origin) // self.bin_secs
+        lat_cells = np.floor((lat - self.lat_origin) /
+                             self.cell_size).astype(np.int64)
+        long_cells = np.floor((lng - self.long_origin) /
+                              self.cell_size).astype(np.int64)
+        self.shape = (time_bins.max() + 1,
+                      int((lat.max() + margin - self.lat_origin) //
+                          self.cell_size) + 1,
+                      int((lng.max() + margin - self.long_origin) //
+                          self.cell_size) + 1)
+        n_cells = np.prod([dim + 1 for dim in self.shape], dtype=np.float64)
+        if n_cells > max_cells:
+            raise RuntimeError("A raster cube of shape {} is too large - use a "
+                               "larger cell size or more days per time bin."
+                               .format(self.shape))
+
+        # Index into a cube padded with a leading zero along every axis.
+        padded_idx = ((time_bins + 1) * (self.shape[1] + 1) + lat_cells + 1) * \
+                (self.shape[2] + 1) + long_cells + 1
+        self.all_table = self._build_summed_table(padded_idx)
+        self.fires_table = self._build_summed_table(padded_idx[fire_bool])
+
+    @property
+    def nbytes(self):
+        """Return the memory held by the summed-volume tables."""
+
+        return self.all_table.nbytes + self.fires_table.nbytes
+
+    def count_nearby_windows(self, lat, lng, dates, time_measures,
+                             end_offset_days=0):
+        """Estimate the nearby obs. and fires for each ob. over many windows.
+
+        Args:
+        ----
+            lat: 1d np.ndarray
+            lng: 1d np.ndarray
+            dates: 1d np.ndarray
+            time_measures: list of ints
+            end_offset_days (optional): int
+                Holds how many days before each ob. to end the windows at
+                (only obs. before then are counted).
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per inputted ob. and one column per time measure
+                (in the order they were passed in).
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        secs = to_seconds(dates)
+        day_secs = secs - secs % SECONDS_PER_DAY
+
+        lat_bounds = ((lat - self.dist_measure - self.lat_origin) / self.cell_size,
+                      (lat + self.dist_measure - self.lat_origin) / self.cell_size)
+        long_bounds = ((lng - self.dist_measure - self.long_origin) /
+                       self.cell_size,
+                       (lng + self.dist_measure - self.long_origin) /
+                       self.cell_size)
+        window_end = (secs - end_offset_days * SECONDS_PER_DAY -
+                      self.secs_origin) / float(self.bin_secs)
+        # In real time we won't know which obs. are fires on the day of.
+        fires_end = np.minimum(window_end, (day_secs - self.secs_origin) /
+                               float(self.bin_secs))
+
+        all_nearby_counts = np.zeros((lat.shape[0], len(time_measures)),
+                                     dtype=np.int64)
+        nearby_fires_counts = np.zeros((lat.shape[0], len(time_measures)),
+                                       dtype=np.int64)
+        for col_idx, time_measure in enumerate(time_measures):
+            if time_measure == 0:
+                window_beg = fires_end
+            else:
+                window_beg = (secs - time_measure * SECONDS_PER_DAY -
+                              self.secs_origin) / float(self.bin_secs)
+            all_nearby_counts[:, col_idx] = np.rint(self._box_sum(
+                    self.all_table, (window_beg, np.maximum(window_beg,
+                    window_end)), lat_bounds, long_bounds))
+            nearby_fires_counts[:, col_idx] = np.rint(self._box_sum(
+                    self.fires_table, (window_beg, np.maximum(window_beg,
+                    fires_end)), lat_bounds, long_bounds))
+
+        return np.maximum(all_nearby_counts, 0), \
+                np.maximum(nearby_fires_counts, 0)
+
+    def _build_summed_table(self, padded_idx):
+        """Bin obs. into a zero-padded cube and take cumulative sums over it.
+
+        Args:
+        ----
+            padded_idx: 1d np.ndarray
+                Holds the flat index of each ob. in the padded cube.
+
+        Return:
+        ------
+            summed_table: 3d np.ndarray
+        """
+
+        summed_table = np.zeros([dim + 1 for dim in self.shape], dtype=np.int32)
+        cell_idx, cell_counts = np.unique(padded_idx, return_counts=True)
+        summed_table.ravel()[cell_idx] = cell_counts
+        for axis in xrange(3):
+            np.cumsum(summed_table, axis=axis, out=summed_table)
+
+        return summed_table
+
+    def _box_sum(self, summed_table, time_bounds, lat_bounds, long_bounds):
+        """Estimate the number of obs. within boxes in (fractional) cube units.
+
+        Args:
+        ----
+            summed_table: 3d np.ndarray
+            time_bounds: tuple of 1d np.ndarrays
+                Holds the beginning and end of each box along the time axis.
+            lat_bounds: tuple of 1d np.ndarrays
+            long_bounds: tuple of 1d np.ndarrays
+
+        Return:
+        ------
+            box_sums: 1d np.ndarray
+        """
+
+        box_sums = np.zeros(time_bounds[0].shape[0], dtype=np.float64)
+        for time_side in (0, 1):
+            for lat_side in (0, 1):
+                for long_side in (0, 1):
+                    sign = (-1) ** (3 - time_side - lat_side - long_side)
+                    box_sums += sign * self._interp_prefix(summed_table,
+                            time_bounds[time_side], lat_bounds[lat_side],
+                            long_bounds[long_side])
+
+        return box_sums
+
+    def _interp_prefix(self, summed_table, time_pos, lat_pos, long_pos):
+        """Trilinearly interpolate the summed-volume table at the inputted points.
+
+        Interpolating the table (rather than reading it at whole cells) is what
+        assumes obs. are spread evenly within each cell.
+        """
+
+        idx_lst, frac_lst = [], []
+        for pos, dim in zip((time_pos, lat_pos, long_pos), self.shape):
+            pos = np.clip(pos, 0, dim)
+            idx = np.minimum(np.floor(pos).astype(np.int64), dim - 1)
+            idx_lst.append(idx)
+            frac_lst.append(pos - idx)
+
+        values = np.zeros(time_pos.shape[0], dtype=np.float64)
+        for time_side in (0, 1):
+            for lat_side in (0, 1):
+                for long_side in (0, 1):
+                    weight = np.ones(time_pos.shape[0], dtype=np.float64)
+                    for side, frac in zip((time_side, lat_side, long_side),
+                                          frac_lst):
+                        weight *= frac if side else 1 - frac
+                    values += weight * summed_table[idx_lst[0] + time_side,
+                            idx_lst[1] + lat_side, idx_lst[2] + long_side]
+
+        return values
+
+def cube_error_report(df, dist_measure, time_measures, cell_sizes,
+                      time_bin_days=7, exact_days=7, sample_size=10000, seed=24):
+    """Report how far the raster cube counts are from the exact counts.
+
+    For each inputted cell size, build a `RasterCube` over the obs. in `df`,
+    and compare its counts against the exact counts (from a `GridIndex`) for a
+    random sample of the obs. Just as with the 'cube' engine of
+    `gen_nearby_fires_count`, the last `exact_days` of each window are counted
+    exactly and only the rest is taken from the cube.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+            Holds the `lat`, `long`, `date_fire`, and `fire_bool` columns, with
+            no duplicate lat/long/date_fire combinations.
+        dist_measure: float
+        time_measures: list of ints
+        cell_sizes: list of floats
+        time_bin_days (optional): int
+        exact_days (optional): int
+        sample_size (optional): int
+        seed (optional): int
+
+    Return:
+    ------
+        report_df: Pandas DataFrame
+            Holds one row per cell size, count type (`all_nearby_count` or
+            `all_nearby_fires`), and time measure, with the mean, 99th
+            percentile, and max absolute error, the mean absolute error as a
+            fraction of the exact count, the memory held by the cube (MB), and
+            the time it took to build and query it.
+    """
+
+    lat, lng = df['lat'].values, df['long'].values
+    dates, fire_bool = df['date_fire'].values, df['fire_bool'].values
+
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(lat.shape[0], min(sample_size, lat.shape[0]),
+                        replace=False)
+    grid_index = GridIndex(lat, lng, dates, fire_bool, dist_measure)
+    exact_counts = grid_index.count_nearby_windows(lat[sample], lng[sample],
+                                                   dates[sample], time_measures)
+    recent_counts = grid_index.count_nearby_windows(lat[sample], lng[sample],
+                                                    dates[sample], [exact_days])
+
+    report_rows = []
+    for cell_size in cell_sizes:
+        start = time.time()
+        raster_cube = RasterCube(lat, lng, dates, fire_bool, dist_measure,
+                                 cell_size, time_bin_days)
+        approx_counts = raster_cube.count_nearby_windows(lat[sample],
+                lng[sample], dates[sample], time_measures, exact_days)
+        approx_counts = [approx + recent for approx, recent in
+                         zip(approx_counts, recent_counts)]
+        elapsed = time.time() - start
+
+        for label, exact, approx in zip(['all_nearby_count', 'all_nearby_fires'],
+                                        exact_counts, approx_counts):
+            for col_idx, time_measure in enumerate(time_measures):
+                abs_errors = np.abs(approx[:, col_idx] - exact[:, col_idx])
+                rel_errors = abs_errors / np.maximum(exact[:, col_idx], 1.)
+                report_rows.append({'cell_size': cell_size,
+                        'count_col': label + str(time_measure),
+                        'mean_abs_error': abs_errors.mean(),
+                        'p99_abs_error': np.percentile(abs_errors, 99),
+                        'max_abs_error': abs_errors.max(),
+                        'mean_rel_error': rel_errors.mean(),
+                        'cube_mb': raster_cube.nbytes / 1e6,
+                        'seconds': elapsed})
+
+    report_df = pd.DataFrame(report_rows, columns=['cell_size', 'count_col',
+            'mean_abs_error', 'p99_abs_error', 'max_abs_error',
+            'mean_rel_error', 'cube_mb', 'seconds'])
+
+    return report_df
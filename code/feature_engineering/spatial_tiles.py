@@ -0,0 +1,234 @@
+"""A module for calculating nearby fires counts tile by tile.
+
+The nearby fires counts of an ob. only depend on the obs. within `dist_measure`
+of it, so the work can be split up by area. This module splits the map into
+square tiles (`tile_size` degrees on a side). Each tile holds its own (core)
+obs., plus a halo of the obs. from neighboring tiles that are within
+`dist_measure` of its edges - every ob. that a core ob. could count as nearby
+is then in the tile. The counts for each tile are calculated independently
+(with a `GridIndex` over all of the tile's obs.) in separate processes, only
+for the core obs. of each tile, and stitched back together. Since the grid
+index is exact, this gives exactly the counts of an untiled run with the grid
+engine of `gen_nearby_fires_count`.
+
+Each process only ever holds a single tile (which is built and sent to it
+when it asks for more work), so the memory needed per process is bounded by
+the densest tile rather than by the whole map.
+
+If a `table_dir` is passed, the stitched counts are also saved there as a
+`NearbyFiresTable` (see `nearby_table.py`), along with an index over every
+unique ob., so that the counts can be kept up to date with
+`geo_featurization.update_nearby_fires_count` as new obs. come in. The table
+is built from the tiled counts rather than counting again.
+"""
+
+import multiprocessing
+import numpy as np
+import pandas as pd
+from grid_index import GridIndex
+from nearby_table import NearbyFiresTable
+from stage_report import report_stage
+from geo_featurization import _get_unique_obs_index, _get_count_suffixes, \
+        _broadcast_counts
+
+KEY_COLS = ['lat', 'long', 'date_fire', 'fire_bool']
+# Widen halos by a hair so float rounding can't leave a nearby ob. out.
+HALO_MARGIN = 1e-6
+
+def gen_nearby_fires_count_tiled(df, kwargs):
+    """Count nearby fires/non-fires tile by tile (see `gen_nearby_fires_count`).
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        kwargs: dct
+            Holds the same keywords as `gen_nearby_fires_count` (with the grid
+            engine, and optionally the 'table_dir' keyword), plus the
+            'tile_size' keyword (in degrees) and optionally the 'n_jobs'
+            keyword, which here holds how many tiles to count at once (-1 for
+            all cores).
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    time_measures = kwargs.pop('time_measures', None)
+    dist_measure = kwargs.pop('dist_measure', None)
+    tile_size = kwargs.pop('tile_size', None)
+    n_jobs = kwargs.pop('n_jobs', 1)
+    engine = kwargs.pop('engine', 'grid')
+    table_dir = kwargs.pop('table_dir', None)
+
+    if time_measures is None or dist_measure is None or tile_size is None:
+        raise RuntimeError('Inappropriate arguments passed to '
+                           'gen_nearby_fires_count_tiled')
+    # Only the grid engine is exact no matter what else is in the frame.
+    if engine != 'grid':
+        raise RuntimeError('Only the grid engine can be run tile by tile')
+    radii = list(dist_measure) if isinstance(dist_measure, (list, tuple)) \
+            else None
+    if radii is not None and table_dir is not None:
+        raise RuntimeError('A list of dist_measures can\'t be saved to a '
+                           'table_dir')
+    halo_size = np.max(dist_measure) + HALO_MARGIN
+    if halo_size >= tile_size:
+        raise RuntimeError('The tile_size needs to be bigger than the '
+                           'dist_measure')
+
+    with report_stage('assign_tiles', df.shape[0]) as stage_entry:
+        tile_rows, tile_bounds, is_core = assign_tiles(df['lat'].values,
+                df['long'].values, tile_size, halo_size)
+        stage_entry['n_rows_out'] = tile_rows.shape[0]
+        stage_entry['n_tiles'] = len(tile_bounds)
+    key_arrays = [df[col].values for col in KEY_COLS]
+    tile_args = (([arr[tile_rows[beg:end]] for arr in key_arrays],
+                  is_core[beg:end], np.max(dist_measure), time_measures, radii)
+                 for beg, end in tile_bounds)
+
+    n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+    n_count_cols = len(time_measures) * (1 if radii is None else len(radii))
+    all_nearby_counts = np.zeros((df.shape[0], n_count_cols), dtype=np.int64)
+    nearby_fires_counts = np.zeros_like(all_nearby_counts)
+    # Every tile counts all of the time measures in a single pass, so they're
+    # reported as a single stage.
+    with report_stage('count_tiles', tile_rows.shape[0]) as stage_entry:
+        stage_entry['time_measures'] = list(time_measures)
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            tile_results = pool.imap(_count_tile, tile_args)
+        else:
+            tile_results = (_count_tile(args) for args in tile_args)
+        try:
+            for (beg, end), (tile_all_counts, tile_fires_counts) in \
+                    zip(tile_bounds, tile_results):
+                core_rows = tile_rows[beg:end][is_core[beg:end]]
+                all_nearby_counts[core_rows] = tile_all_counts
+                nearby_fires_counts[core_rows] = tile_fires_counts
+        finally:
+            if n_jobs > 1:
+                pool.close()
+                pool.join()
+        stage_entry['n_rows_out'] = df.shape[0]
+
+    if table_dir is not None:
+        with report_stage('save_table', df.shape[0]) as stage_entry:
+            first_positions, _ = _get_unique_obs_index(df)
+            table = NearbyFiresTable.from_counts(
+                    df[KEY_COLS].iloc[first_positions], dist_measure,
+                    time_measures, all_nearby_counts[first_positions],
+                    nearby_fires_counts[first_positions])
+            table.save(table_dir)
+            stage_entry['n_rows_out'] = table.n_rows
+
+    with report_stage('broadcast_counts', df.shape[0]) as stage_entry:
+        df = _broadcast_counts(df, _get_count_suffixes(time_measures, radii),
+                               all_nearby_counts, nearby_fires_counts,
+                               np.arange(df.shape[0]))
+        stage_entry['n_rows_out'] = df.shape[0]
+
+    return df
+
+def assign_tiles(lat, lng, tile_size, halo_size):
+    """Assign each ob. to its own tile, and to the halo of any tile near it.
+
+    Args:
+    ----
+        lat: 1d np.ndarray
+        lng: 1d np.ndarray
+        tile_size: float
+        halo_size: float
+            Holds how far past its edges each tile reaches (less than
+            `tile_size`, so an ob. can only be in the halos of the 8 tiles
+            around its own).
+
+    Return:
+    ------
+        tile_rows: 1d np.ndarray
+            Holds the row positions of the obs. in each tile, tile after tile,
+            with the rows of each tile in their original order.
+        tile_bounds: list of tuples
+            Holds the beginning and end (exclusive) of each tile in `tile_rows`.
+        is_core: 1d np.ndarray
+            Holds whether each entry in `tile_rows` is in the tile itself
+            (rather than in its halo).
+    """
+
+    lat_tiles = np.floor(lat / tile_size).astype(np.int64)
+    long_tiles = np.floor(lng / tile_size).astype(np.int64)
+    rows = np.arange(lat.shape[0])
+    long_tile_span = long_tiles.max() - long_tiles.min() + 3 \
+            if lat.shape[0] else 1
+
+    tile_keys_lst, rows_lst, is_core_lst = [], [], []
+    for lat_offset in (-1, 0, 1):
+        for long_offset in (-1, 0, 1):
+            nbr_lat_tiles = lat_tiles + lat_offset
+            nbr_long_tiles = long_tiles + long_offset
+            in_nbr = (lat >= nbr_lat_tiles * tile_size - halo_size) & \
+                    (lat < (nbr_lat_tiles + 1) * tile_size + halo_size) & \
+                    (lng >= nbr_long_tiles * tile_size - halo_size) & \
+                    (lng < (nbr_long_tiles + 1) * tile_size + halo_size)
+            if lat_offset == 0 and long_offset == 0:
+                in_nbr[:] = True
+            tile_keys_lst.append(nbr_lat_tiles[in_nbr] * long_tile_span +
+                                 nbr_long_tiles[in_nbr])
+            rows_lst.append(rows[in_nbr])
+            is_core_lst.append(np.repeat(lat_offset == 0 and long_offset == 0,
+                                         in_nbr.sum()))
+
+    tile_keys = np.concatenate(tile_keys_lst)
+    tile_rows = np.concatenate(rows_lst)
+    is_core = np.concatenate(is_core_lst)
+    order = np.lexsort((tile_rows, tile_keys))
+    tile_keys, tile_rows, is_core = \
+            tile_keys[order], tile_rows[order], is_core[order]
+
+    _, tile_begs = np.unique(tile_keys, return_index=True)
+    tile_ends = np.append(tile_begs[1:], tile_keys.shape[0])
+    # A tile with nothing but halo has nothing to count.
+    tile_bounds = [(beg, end) for beg, end in zip(tile_begs, tile_ends)
+                   if is_core[beg:end].any()]
+
+    return tile_rows, tile_bounds, is_core
+
+def _count_tile(args):
+    """Count nearby fires/non-fires for the core obs. of a single tile.
+
+    Duplicate obs. are dropped just as in `gen_nearby_fires_count`, and since
+    duplicates share a lat/long, they're always in the same tile.
+
+    This is the function multiprocessed from `gen_nearby_fires_count_tiled`.
+
+    Args:
+    ----
+        args: tuple
+            Holds the lat, long, date_fire, and fire_bool arrays of the tile's
+            obs. (core and halo), whether each is a core ob., the
+            `dist_measure` (the largest, if there are `radii`), the time
+            measures, and the radii (or None).
+
+    Return:
+    ------
+        all_nearby_counts: 2d np.ndarray
+            Holds one row per core ob. and one column per count column.
+        nearby_fires_counts: 2d np.ndarray
+    """
+
+    (lat, lng, dates, fire_bool), is_core, dist_measure, time_measures, \
+            radii = args
+    first_positions, inverse_idx = _get_unique_obs_index(
+            pd.DataFrame({'lat': lat, 'long': lng, 'date_fire': dates}))
+    grid_index = GridIndex(lat[first_positions], lng[first_positions],
+                           dates[first_positions], fire_bool[first_positions],
+                           dist_measure)
+
+    core_obs, core_inverse_idx = np.unique(inverse_idx[is_core],
+                                           return_inverse=True)
+    core_positions = first_positions[core_obs]
+    all_nearby_counts, nearby_fires_counts = grid_index.count_nearby_windows(
+            lat[core_positions], lng[core_positions], dates[core_positions],
+            time_measures, radii)
+
+    return all_nearby_counts[core_inverse_idx].astype(np.int32), \
+            nearby_fires_counts[core_inverse_idx].astype(np.int32)
@@ -0,0 +1,217 @@
+"""A module for recording how long each stage of a run takes, and how much
+memory it uses.
+
+A `StageReport` records an entry for every stage run inside its `stage`
+context manager - the wall time, the CPU time (of this process, plus any
+child processes that finished during the stage, e.g. those of a
+`multiprocessing.Pool`), the number of rows going in and out (when given),
+and the peak RSS of this process during the stage. Stages can be nested, and
+each entry records the stage it was run inside of (its `parent`).
+
+While any stage is running, a background thread samples the RSS of the
+process (every `sample_interval` seconds) to find the peak of each stage. If
+`profile` is set, it also samples the stack of the main thread, which gives
+a sampling profile of each stage - the functions that the most samples were
+taken in (`self`) or under (`inclusive`).
+
+Code that's called from a run (e.g. `gen_nearby_fires_count`) can record its
+own sub-stages with `report_stage`, which records into the report that was
+passed to `set_active_report` (and does nothing if there isn't one).
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+from collections import Counter
+
+# Holds how many functions to keep in each stage's profile.
+PROFILE_TOP_N = 25
+
+_active_report = None
+
+class StageReport(object):
+    """A report of the time and memory taken by each stage of a run.
+
+    Args:
+    ----
+        profile (optional): bool
+            Holds whether to attach a sampling profile to each stage.
+        sample_interval (optional): float
+            Holds the seconds between samples of the RSS (and stack).
+    """
+
+    def __init__(self, profile=False, sample_interval=0.05):
+        self.profile = profile
+        self.sample_interval = sample_interval
+        self.entries = []
+        self._active = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._main_thread_id = threading.current_thread().ident
+
+    @contextmanager
+    def stage(self, name, n_rows_in=None):
+        """Record an entry for the code run inside the `with` block.
+
+        The entry (a dct) is yielded, so that the code inside the block can add
+        to it (e.g. the `n_rows_out`).
+
+        Args:
+        ----
+            name: str
+            n_rows_in (optional): int
+        """
+
+        entry = {'stage': name,
+                 'parent': self._active[-1]['stage'] if self._active else None,
+                 'n_rows_in': n_rows_in, 'n_rows_out': None}
+        entry['_peak_rss_mb'] = _get_rss_mb()
+        if self.profile:
+            entry['_self_counts'], entry['_inclusive_counts'] = \
+                    Counter(), Counter()
+            entry['_n_samples'] = 0
+
+        with self._lock:
+            self._active.append(entry)
+        self._start_sampler()
+        start_times = os.times()
+        start_wall = time.time()
+        try:
+            yield entry
+        finally:
+            end_times = os.times()
+            entry['wall_seconds'] = time.time() - start_wall
+            entry['cpu_seconds'] = sum(end_times[:4]) - sum(start_times[:4])
+            self._sample_rss()
+            with self._lock:
+                self._active.remove(entry)
+            self._finish_entry(entry)
+            self.entries.append(entry)
+
+    def to_dict(self):
+        """Return the report as a JSON serializable dct."""
+
+        return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'profile': self.profile,
+                'stages': self.entries}
+
+    def write(self, filepath):
+        """Write the report to a JSON file.
+
+        Args:
+        ----
+            filepath: str
+        """
+
+        dirpath = os.path.dirname(filepath)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        with open(filepath, 'w+') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def _start_sampler(self):
+        """Start the sampling thread (if it isn't already running)."""
+
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = threading.Thread(target=self._run_sampler)
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def _run_sampler(self):
+        """Sample until no stages are running."""
+
+        while True:
+            time.sleep(self.sample_interval)
+            with self._lock:
+                if not self._active:
+                    return
+            self._sample_rss()
+            if self.profile:
+                self._sample_stack()
+
+    def _sample_rss(self):
+        """Update the peak RSS of every running stage."""
+
+        rss_mb = _get_rss_mb()
+        with self._lock:
+            for entry in self._active:
+                entry['_peak_rss_mb'] = max(entry['_peak_rss_mb'], rss_mb)
+
+    def _sample_stack(self):
+        """Add the current stack of the main thread to every running stage."""
+
+        frame = sys._current_frames().get(self._main_thread_id)
+        funcs = []
+        while frame is not None:
+            code = frame.f_code
+            funcs.append('{}:{}'.format(os.path.basename(code.co_filename),
+                                        code.co_name))
+            frame = frame.f_back
+        if not funcs:
+            return
+
+        with self._lock:
+            for entry in self._active:
+                entry['_n_samples'] += 1
+                entry['_self_counts'][funcs[0]] += 1
+                entry['_inclusive_counts'].update(set(funcs))
+
+    def _finish_entry(self, entry):
+        """Replace the sampling state of an entry with what's reported."""
+
+        entry['peak_rss_mb'] = entry.pop('_peak_rss_mb')
+        if self.profile:
+            n_samples = entry.pop('_n_samples')
+            entry['profile'] = {
+                    'n_samples': n_samples,
+                    'sample_interval': self.sample_interval,
+                    'self': entry.pop('_self_counts').most_common(PROFILE_TOP_N),
+                    'inclusive': entry.pop('_inclusive_counts')
+                    .most_common(PROFILE_TOP_N)}
+
+def set_active_report(report):
+    """Set the report that `report_stage` records into (None for no report).
+
+    Args:
+    ----
+        report: StageReport or None
+    """
+
+    global _active_report
+    _active_report = report
+
+@contextmanager
+def report_stage(name, n_rows_in=None):
+    """Record a stage into the active report (if there is one).
+
+    Args:
+    ----
+        name: str
+        n_rows_in (optional): int
+    """
+
+    if _active_report is None:
+        yield {}
+    else:
+        with _active_report.stage(name, n_rows_in) as entry:
+            yield entry
+
+def _get_rss_mb():
+    """Return the current RSS of this process in MB.
+
+    This reads `/proc/self/statm` where it exists (Linux), and otherwise falls
+    back on the peak RSS so far.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * resource.getpagesize() / 2. ** 20
+    except IOError:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KB, and OS X reports bytes.
+        return peak_rss / (2. ** 20 if sys.platform == 'darwin' else 2. ** 10)
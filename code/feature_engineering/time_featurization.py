@@ -1,31 +1,130 @@
-"""A tiny module for adding a date column to a DataFrame. 
+"""A module for adding date/time columns to a DataFrame.
 
-This module just contains a quick one-off function for adding a date column to 
-a DataFrame in one speific use case.
+The detections data holds the daily date (e.g. 2015-08-03) in a `date` column
+and the time of day in an integer `gmt` column, which isn't zero padded (e.g.
+45 for 00:45, or 930 for 09:30). `add_date_column` combines the two into a
+`date_fire` timestamp, and can also pull the temporal features out of it in the
+same pass (see `get_temporal_features`). Everything is done with datetime64
+arithmetic on whole columns, rather than by parsing a string per row.
 """
 
-from itertools import izip
-from datetime import datetime
+import numpy as np
+import pandas as pd
 
-def add_date_column(df):
-    """Add a date column into the DataFrame. 
+# Holds every feature that `get_temporal_features` can create. The `_sin` and
+# `_cos` features are cyclic encodings, so that e.g. December is as close to
+# January as it is to November.
+TEMPORAL_FEATURES = ['year', 'month', 'hour', 'day_of_year', 'month_sin',
+                     'month_cos', 'hour_sin', 'hour_cos', 'day_of_year_sin',
+                     'day_of_year_cos']
+
+def add_date_column(df, temporal_features=None):
+    """Add a date column into the DataFrame.
 
     The inputted DataFrame contains the daily date (e.g. 2015-08-03) as well as
     gmt column, that when combined given a timestamp. This function combines those
-    two into one `date_fire` column. 
+    two into one `date_fire` column, and adds any of the `TEMPORAL_FEATURES`
+    asked for.
 
-    Args: 
+    Args:
     ----
         df: Pandas DataFrame
+        temporal_features (optional): list of strs
+            Holds the features to add alongside `date_fire` (see
+            `get_temporal_features`).
 
-    Return: 
+    Return:
     ------
-        df: Pandas DataFrame 
+        df: Pandas DataFrame
     """
-        
-    df['date_fire']=[datetime.strptime(date + "-" + str(gmt), "%Y-%m-%d-%H%M") for \
-                    date, gmt in izip(df['date'].values, df['gmt'].values)]
+
+    gmt = pd.to_numeric(df['gmt'])
+    if gmt.isnull().any():
+        raise RuntimeError('The gmt column has missing values')
+    gmt = gmt.values.astype(np.int64)
+    hours, minutes = gmt // 100, gmt % 100
+    if ((hours < 0) | (hours > 23) | (minutes > 59)).any():
+        raise RuntimeError('The gmt column has values that aren\'t times of '
+                           'day (HHMM)')
+
+    # There are only a few hundred dates a year, so each is only parsed once.
+    date_codes, dates = pd.factorize(df['date'])
+    if (date_codes == -1).any():
+        raise RuntimeError('The date column has missing values')
+    days = pd.to_datetime(dates, format='%Y-%m-%d').values[date_codes]
+    df['date_fire'] = days + (hours * 60 + minutes).astype('timedelta64[m]')
+
+    if temporal_features:
+        features = get_temporal_features(df['date_fire'].values,
+                                         temporal_features)
+        for feature in temporal_features:
+            df[feature] = features[feature]
 
     return df
 
+def get_temporal_features(date_fire, temporal_features=None):
+    """Pull temporal features out of an array of timestamps.
+
+    Args:
+    ----
+        date_fire: 1d np.ndarray of datetime64
+        temporal_features (optional): list of strs
+            Holds the features to create, out of `TEMPORAL_FEATURES` (all of
+            them if None).
+
+    Return:
+    ------
+        features: dct of 1d np.ndarrays
+            Holds the `year`, `month` (1-12), `hour` (0-23), and `day_of_year`
+            (1-366), and the cyclic encodings of the month, the time of day
+            (to the minute), and the day of the year (over the days in its
+            year).
+    """
+
+    temporal_features = TEMPORAL_FEATURES if temporal_features is None \
+            else temporal_features
+    unknown_features = set(temporal_features) - set(TEMPORAL_FEATURES)
+    if unknown_features:
+        raise RuntimeError('Unknown temporal features passed to '
+                           'get_temporal_features: {}'.format(
+                           sorted(unknown_features)))
+
+    minutes = date_fire.astype('datetime64[m]').astype(np.int64)
+    day_nums = minutes // 1440
+    minute_of_day = minutes - day_nums * 1440
+    if not minutes.shape[0]:
+        return {feature: np.zeros(0) for feature in temporal_features}
+
+    # The features that depend on the day are worked out once for each day in
+    # the range of the dates (a few thousand at most), and then looked up.
+    first_day_num = day_nums.min()
+    day_offsets = day_nums - first_day_num
+    days = np.arange(first_day_num, day_nums.max() + 1).astype('datetime64[D]')
+    year_starts = days.astype('datetime64[Y]')
+    month_idx = days.astype('datetime64[M]').astype(np.int64) % 12
+    day_of_year_idx = (days - year_starts.astype('datetime64[D]')) \
+            .astype(np.int64)
+    days_in_year = ((year_starts + 1).astype('datetime64[D]') -
+                    year_starts.astype('datetime64[D]')).astype(np.int64)
+    day_of_year_angles = 2 * np.pi * day_of_year_idx / days_in_year.astype(float)
+    month_angles = 2 * np.pi * month_idx / 12.
+    minute_angles = 2 * np.pi * np.arange(1440) / 1440.
+
+    day_tables = {'year': lambda: year_starts.astype(np.int64) + 1970,
+                  'month': lambda: month_idx + 1,
+                  'day_of_year': lambda: day_of_year_idx + 1,
+                  'month_sin': lambda: np.sin(month_angles),
+                  'month_cos': lambda: np.cos(month_angles),
+                  'day_of_year_sin': lambda: np.sin(day_of_year_angles),
+                  'day_of_year_cos': lambda: np.cos(day_of_year_angles)}
+    minute_tables = {'hour': lambda: np.arange(1440) // 60,
+                     'hour_sin': lambda: np.sin(minute_angles),
+                     'hour_cos': lambda: np.cos(minute_angles)}
+    features = {}
+    for feature in temporal_features:
+        if feature in day_tables:
+            features[feature] = day_tables[feature]().take(day_offsets)
+        else:
+            features[feature] = minute_tables[feature]().take(minute_of_day)
 
+    return features
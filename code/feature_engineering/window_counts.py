@@ -0,0 +1,144 @@
+"""A module for counting nearby obs. over a set of nested time windows.
+
+Every nearby obs./fires count is made over a time window that ends at the
+ob. (or at the start of its day for fires) and starts some number of days
+before it. Since all of the windows share the same end, each window is
+contained in every wider one. The `WindowCounter` class takes advantage of this
+- given (ob., nearby ob.) pairs found by any spatial search, it only has to
+find the narrowest window each nearby ob. falls into, and the count for each
+window is a cumulative count across the windows.
+
+The same goes for space when counting over several radii at once - each radius
+contains every smaller one, so the spatial search only has to say which is the
+smallest radius each nearby ob. falls within, and the counts are cumulative
+across the radii as well.
+"""
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+
+class WindowCounter(object):
+    """Accumulate counts of nearby obs./fires for a set of obs. and windows.
+
+    Args:
+    ----
+        dates: 1d np.ndarray
+            Holds the dates of the obs. to count for, as `datetime64` values
+            (or anything castable to them).
+        time_measures: list of ints
+            Holds how many days to go back in time for each window. A
+            `time_measure` of 0 means going back to the start of the day.
+        radii (optional): list of floats
+            Holds the radii to count over. Defaults to a single radius (that
+            of whatever spatial search adds the pairs).
+    """
+
+    def __init__(self, dates, time_measures, radii=None):
+
+        self.time_measures = list(time_measures)
+        self.input_radii = None if radii is None else list(radii)
+        self.radii = None if radii is None else np.unique(radii)
+        self.n_radii = 1 if radii is None else self.radii.shape[0]
+        self.secs = to_seconds(dates)
+        self.day_secs = self.secs - self.secs % SECONDS_PER_DAY
+
+        self.windows = np.unique(np.asarray(time_measures, dtype=np.int64))
+        self.n_windows = self.windows.shape[0]
+        self.has_day_window = self.windows[0] == 0
+        # Only the days-back windows have the same reach for every ob.
+        self.window_reaches = self.windows[self.windows > 0] * SECONDS_PER_DAY
+        if self.window_reaches.shape[0]:
+            self.min_secs = self.secs - self.window_reaches[-1]
+        else:
+            self.min_secs = self.day_secs
+
+        # One extra column catches any nearby obs. that fall in no window.
+        n_counts = self.secs.shape[0] * self.n_radii * (self.n_windows + 1)
+        self.all_nearby_counts = np.zeros(n_counts, dtype=np.int64)
+        self.nearby_fires_counts = np.zeros(n_counts, dtype=np.int64)
+
+    def add_pairs(self, pair_query_idx, cand_secs, cand_fire_bool,
+                  pair_radius_idx=None):
+        """Add (ob., nearby ob.) pairs into the counts.
+
+        Pairs may hold nearby obs. from any point in time - those after the ob.
+        or before the start of the widest window are simply not counted.
+
+        Args:
+        ----
+            pair_query_idx: 1d np.ndarray
+                Holds the index of the ob. (in `dates`) each pair belongs to.
+            cand_secs: 1d np.ndarray
+                Holds the date of the nearby ob. in each pair, as integer
+                seconds since the epoch.
+            cand_fire_bool: 1d np.ndarray
+                Holds whether the nearby ob. in each pair is a fire.
+            pair_radius_idx (optional): 1d np.ndarray
+                Holds the smallest radius (as an index into the sorted, unique
+                `radii`) that the nearby ob. in each pair falls within. Only
+                needed when counting over `radii`.
+        """
+
+        query_secs = self.secs[pair_query_idx]
+        query_day_secs = self.day_secs[pair_query_idx]
+
+        first_window = np.searchsorted(self.window_reaches,
+                query_secs - cand_secs, side='left')
+        if self.has_day_window:
+            same_day = cand_secs >= query_day_secs
+            first_window = np.where(same_day, 0, first_window + 1)
+        first_window[cand_secs > query_secs] = self.n_windows
+        if pair_radius_idx is not None:
+            pair_query_idx = pair_query_idx * self.n_radii + pair_radius_idx
+        flat_idx = pair_query_idx * (self.n_windows + 1) + first_window
+        # In real time we won't know which obs. are fires on the day of.
+        nearby_fires = cand_fire_bool & (cand_secs < query_day_secs)
+
+        self.all_nearby_counts += np.bincount(flat_idx,
+                minlength=self.all_nearby_counts.shape[0])
+        self.nearby_fires_counts += np.bincount(flat_idx[nearby_fires],
+                minlength=self.nearby_fires_counts.shape[0])
+
+    def get_counts(self):
+        """Return the counts for each ob. and window.
+
+        Return:
+        ------
+            all_nearby_counts: 2d np.ndarray
+                Holds one row per ob. and one column per time measure (in the
+                order they were passed in). When counting over `radii`, holds
+                one column per radius and time measure, with the time measures
+                of the first radius (in the order they were passed in) first.
+            nearby_fires_counts: 2d np.ndarray
+        """
+
+        window_cols = np.searchsorted(self.windows, self.time_measures)
+        if self.radii is None:
+            radius_rows = np.zeros(1, dtype=np.int64)
+        else:
+            radius_rows = np.searchsorted(self.radii, self.input_radii)
+
+        counts = []
+        for flat_counts in (self.all_nearby_counts, self.nearby_fires_counts):
+            shape = (self.secs.shape[0], self.n_radii, self.n_windows + 1)
+            cum_counts = np.cumsum(np.cumsum(
+                    flat_counts.reshape(shape)[:, :, :-1], axis=2), axis=1)
+            counts.append(cum_counts[:, radius_rows][:, :, window_cols]
+                          .reshape(self.secs.shape[0], -1))
+
+        return counts[0], counts[1]
+
+def to_seconds(dates):
+    """Return the inputted dates as integer seconds since the epoch.
+
+    Args:
+    ----
+        dates: 1d np.ndarray
+
+    Return:
+    ------
+        secs: 1d np.ndarray
+    """
+
+    return np.asarray(dates).astype('datetime64[s]').astype(np.int64)
@@ -24,7 +24,14 @@ geo_transforms_dict = {'land_water_ratio': {'transformation': 'create_new_col',
                         'add_nearby_fires': {'dist_measure': 0.1, 
                                 'time_measures' : [0, 1, 2, 3, 4, 5, 6, 7, 
                                     365, 730, 1095], 
-                                'transformation' : 'add_nearby_fires'}
+                                'engine': 'grid', 
+                                'tile_size': 5.0, 
+                                'n_jobs': -1, 
+                                # The counts (and the index over the obs.) are 
+                                # saved here, so that `create_inputs.py update` 
+                                # can add a new day of obs. to them. 
+                                'table_dir': 'code/modeling/model_input/nearby_table', 
+                                'transformation' : 'add_nearby_fires_tiled'}
                       }
 
 with open('code/makefiles/time_transforms_dict.pkl', 'w+') as f: 
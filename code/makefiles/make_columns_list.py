@@ -1,4 +1,9 @@
-"""A tiny script to pickle the list of columns to include in the models being run."""
+"""A tiny script to pickle the list of columns to include in the models being run.
+
+Dummied columns (e.g. `src`) are listed by their own name, and are expanded into 
+their dummies (using the vocabulary saved by `create_inputs.py`) when the model 
+matrix is built.
+"""
 import pickle
 
 columns_list = [u'lat', u'long', u'gmt', u'temp', u'spix', u'tpix',
@@ -20,12 +25,8 @@ columns_list = [u'lat', u'long', u'gmt', u'temp', u'spix', u'tpix',
                 u'perc_fires0', u'perc_fires1', u'perc_fires2',
                 u'perc_fires3', u'perc_fires4', u'perc_fires5', 
                 u'perc_fires6', u'perc_fires7', u'perc_fires365', 
-                u'perc_fires730', u'perc_fires1095', u'sat_src_A', u'sat_src_T',
-                u'src_gsfc', u'src_gsfc_drl', u'src_rsac', u'src_ssec', u'src_uaf',
-                u'year_2012', u'year_2013', u'year_2014', u'year_2015', u'month_1',
-                u'month_2', u'month_3', u'month_4', u'month_5', u'month_6',
-                u'month_7', u'month_8', u'month_9', u'month_10', u'month_11',
-                u'month_12']
+                u'perc_fires730', u'perc_fires1095', u'sat_src', u'src',
+                u'year', u'month']
 
 with open('code/makefiles/columns_list.pkl', 'w+') as f: 
 	pickle.dump(columns_list, f)
@@ -0,0 +1,288 @@
+"""A module for running the daily backtest, optionally over a pool of processes.
+
+Each day of the backtest fits a model on the obs. before it and scores the obs.
+on it, so the days don't depend on each other (except through incremental
+training, see `incremental_training.py`). The days are split into contiguous
+blocks, and the blocks are run in parallel processes, each of which trains its
+own model (with `n_jobs` of its own) - so the cores can be split between the
+days (outer) and each fit (inner).
+
+The model matrix is saved to a temporary directory once, and each process
+memory-maps it (see `ModelMatrix.load`) rather than getting its own copy. Each
+process logs the results of its days itself, and the shared `metrics.csv` is
+only ever appended to under a lock (see `model_logging.append_line`).
+
+With a `model_cache_dir`, the model fit on each day is cached (see
+`model_cache.py`), and any day whose model is already cached is skipped.
+
+For logit, the numeric features are scaled by their means and standard
+deviations (see `preprocessing.ColumnScaler`), whose statistics are updated
+with only the rows added since they last were (`partial_fit_array`). With a
+refit every day (`refit_days=1`), that's every day, as each day's rows join the
+train set. With `refit_days` of more than 1, the statistics are deliberately
+frozen for each refit period - at those of the rows before it starts - so the
+scaled train set only has to be rescaled in full once per period (in between,
+just the new rows are scaled). That's a change from updating them every day,
+which would rescale the whole train set every day.
+"""
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from preprocessing import ColumnScaler, FILL_VALUE
+from model_matrix import ModelMatrix
+from incremental_training import IncrementalTrainer
+from model_cache import ModelCache
+from scoring import return_score
+from model_logging import log_test_results, log_feat_importances
+
+# Holds how many blocks of days to split the backtest into per process, so
+# that processes that get the (cheaper) earlier days aren't left idle.
+BLOCKS_PER_JOB = 4
+
+# Holds the matrix/geo. columns loaded by this (worker) process, by directory.
+_worker_inputs = {}
+
+def run_backtest(model, model_name, model_matrix, geo_cols_df, dt_range,
+                 refit_days=1, n_day_jobs=1, n_jobs=-1, model_cache_dir=None,
+                 recompute=False):
+    """Fit/score a model on each day of the range, and log the results.
+
+    Args:
+    ----
+        model: varied
+            Holds the (unfit) model, expected to implement the sklearn model
+            interface.
+        model_name: str
+        model_matrix: model_matrix.ModelMatrix
+        geo_cols_df: Pandas DataFrame
+            Holds the geographical info. to log with the predicted probs.
+        dt_range: list of datetime.datetimes
+        refit_days (optional): int
+            Holds the days between full refits (see `IncrementalTrainer`).
+        n_day_jobs (optional): int
+            Holds how many processes to run days in (1 runs them all in this
+            process, one after another).
+        n_jobs (optional): int
+            Holds how many cores to use in all (-1 for all of them), which are
+            split between the `n_day_jobs` processes, and set as the `n_jobs`
+            of each process's model. Only used if `n_day_jobs` is more than 1.
+        model_cache_dir (optional): str
+            Holds the folder to cache the fit models in (None to not cache
+            them).
+        recompute (optional): bool
+            Holds whether to refit the days whose models are already cached.
+    """
+
+    dt_range = list(dt_range)
+    if not dt_range:
+        return
+    model_cache = None
+    if model_cache_dir is not None:
+        model_cache = ModelCache(model_cache_dir, model_name,
+                                 model.get_params(), model_matrix, refit_days,
+                                 dt_range[0], recompute)
+
+    if n_day_jobs <= 1 or len(dt_range) <= 1:
+        _run_block(model, model_name, model_matrix, geo_cols_df, dt_range,
+                   refit_days, dt_range[0], model_cache)
+        return
+
+    n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+    model = set_n_jobs(model, max(1, n_jobs // n_day_jobs))
+    dt_blocks = get_dt_blocks(dt_range, refit_days,
+                              n_day_jobs * BLOCKS_PER_JOB)
+
+    inputs_dir = tempfile.mkdtemp(prefix='backtest_')
+    try:
+        model_matrix.save(inputs_dir)
+        geo_cols_df.to_pickle(os.path.join(inputs_dir, 'geo_cols_df.pkl'))
+        pool = multiprocessing.Pool(min(n_day_jobs, len(dt_blocks)))
+        try:
+            # Any error in a worker is raised here.
+            for _ in pool.imap_unordered(_run_block_worker,
+                    [(inputs_dir, model, model_name, dt_block, refit_days,
+                      dt_range[0], model_cache) for dt_block in dt_blocks]):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(inputs_dir)
+
+def get_dt_blocks(dt_range, refit_days, n_blocks):
+    """Split the days into (about) `n_blocks` blocks of consecutive days.
+
+    Each block starts with a full refit, so the blocks are whole multiples of
+    `refit_days` long (counted from the first day, as are the refit periods of
+    an `IncrementalTrainer`) - which keeps the refits on the same days as when
+    the whole range is run as one block.
+
+    Args:
+    ----
+        dt_range: list of datetime.datetimes
+        refit_days: int
+        n_blocks: int
+
+    Return:
+    ------
+        dt_blocks: list of lists of datetime.datetimes
+    """
+
+    n_days = (dt_range[-1] - dt_range[0]).days + 1
+    n_refits = int(np.ceil(n_days / float(refit_days)))
+    block_days = refit_days * max(1, int(np.ceil(n_refits / float(n_blocks))))
+
+    dt_blocks = []
+    for dt in dt_range:
+        block_num = (dt - dt_range[0]).days // block_days
+        if block_num >= len(dt_blocks):
+            dt_blocks.append([])
+        dt_blocks[-1].append(dt)
+
+    return dt_blocks
+
+def set_n_jobs(model, n_jobs):
+    """Return a copy of the model that fits with the number of cores (if it
+    has such a param).
+
+    Args:
+    ----
+        model: varied
+        n_jobs: int
+
+    Return:
+    ------
+        model: varied
+    """
+
+    model = clone(model)
+    params = model.get_params()
+    for param in ['n_jobs', 'nthread']:
+        if param in params:
+            model.set_params(**{param: n_jobs})
+
+    return model
+
+def _run_block(model, model_name, model_matrix, geo_cols_df, dt_block,
+               refit_days, beg_date, model_cache=None):
+    """Fit/score a model on each day of a block (in order), and log the results.
+
+    Args:
+    ----
+        model: varied
+        model_name: str
+        model_matrix: model_matrix.ModelMatrix
+        geo_cols_df: Pandas DataFrame
+        dt_block: list of datetime.datetimes
+        refit_days: int
+        beg_date: datetime.datetime
+            Holds the first day of the backtest (which may be before the
+            block), which the refits are counted from.
+        model_cache (optional): model_cache.ModelCache
+    """
+
+    # For logit, the train set is scaled into a buffer (big enough for the
+    # last day of the block) that's reused every day, rather than into a fresh
+    # copy of it. The statistics to scale by are those of the rows before the
+    # start of the refit period (see the module docstring), so the buffer is
+    # only rescaled in full when a new period starts - in between, just the
+    # rows added to the train set are scaled. The scaler itself is only ever
+    # updated with the rows added since it last was (the train set is always
+    # the first rows of the matrix).
+    scaler, X_scaled, scaled_period = None, None, None
+    n_stat_rows, n_scaled_rows = 0, 0
+    trainer = IncrementalTrainer(model, model_name, model_matrix.temporal_index,
+                                 refit_days, beg_date)
+    # Holds the key of the last day that was skipped because its model was
+    # cached, which an incremental trainer picks up from on the next day.
+    skipped_key = None
+    for dt in dt_block:
+        X_train, Y_train, X_test, Y_test = model_matrix.get_train_test(dt)
+        # Don't run models if there are no obs for a day.
+        if X_train.shape[0] and X_test.shape[0]:
+            if model_cache is not None:
+                cache_key = model_cache.get_key(dt, X_train.shape[0])
+                if model_cache.is_cached(cache_key):
+                    skipped_key = cache_key
+                    continue
+                if skipped_key is not None and trainer.incremental:
+                    trainer.set_state(*model_cache.load(skipped_key,
+                                                        mmap_mode=None))
+                skipped_key = None
+            if model_name == 'logit':
+                if scaler is None:
+                    scaler = ColumnScaler()
+                    X_scaled = np.empty((model_matrix.temporal_index.search(
+                        dt_block[-1]), model_matrix.X.shape[1]),
+                        dtype=np.float32)
+                n_rows = X_train.shape[0]
+                refit_period = trainer.get_refit_period(dt)
+                if refit_period != scaled_period:
+                    period_beg = beg_date + \
+                            timedelta(days=refit_period * refit_days)
+                    period_rows = model_matrix.temporal_index.search(
+                            period_beg)
+                    if period_rows == 0:
+                        # The period starts before the first row, so it's
+                        # scaled by the statistics of the first day of rows
+                        # (the train set of the first day that can be fit).
+                        period_rows = model_matrix.temporal_index.day_offsets[1]
+                    scaler.partial_fit_array(
+                            model_matrix.X[n_stat_rows:period_rows],
+                            model_matrix.numeric_idx, FILL_VALUE)
+                    n_stat_rows = period_rows
+                    scaled_period, n_scaled_rows = refit_period, 0
+                scaler.transform_array(X_train[n_scaled_rows:], FILL_VALUE,
+                                       out=X_scaled[n_scaled_rows:n_rows])
+                n_scaled_rows = n_rows
+                X_train = X_scaled[:n_rows]
+                X_test = scaler.transform_array(X_test, FILL_VALUE)
+            trainer.fit(dt, X_train, Y_train)
+            model = trainer.model
+            pred_probs = model.predict_proba(X_test)[:, 1]
+            roc_auc, pr_auc = None, None
+            # We can't get area under the curve if there are no fires :( (or
+            # nothing but fires).
+            if 0 < Y_test.sum() < Y_test.shape[0]:
+                roc_auc = return_score('auc_roc', pred_probs, Y_test)
+                pr_auc = return_score('auc_precision_recall', pred_probs, Y_test)
+            log_feat_importances(model, X_train, dt, model_matrix.feature_names)
+            log_test_results(dt, geo_cols_df, Y_test, pred_probs, roc_auc, pr_auc)
+            # The model is only cached once its results are logged, so a day
+            # is never skipped without them.
+            if model_cache is not None:
+                model_cache.save(cache_key, model, trainer.get_state())
+
+def _run_block_worker(args):
+    """Run a block of days in a worker process.
+
+    This is the function multiprocessed from `run_backtest`. Only the inputs
+    directory, the (unfit) model, and the days are sent to the worker, which
+    memory-maps the matrix the first time it's given the directory.
+
+    Args:
+    ----
+        args: tuple
+            Holds the inputs directory, the model, the model name, the block of
+            days, the days between full refits, the first day of the backtest,
+            and the model cache (or None).
+    """
+
+    inputs_dir, model, model_name, dt_block, refit_days, beg_date, \
+            model_cache = args
+    if inputs_dir not in _worker_inputs:
+        _worker_inputs.clear()
+        geo_cols_df = pd.read_pickle(os.path.join(inputs_dir,
+                                                  'geo_cols_df.pkl'))
+        _worker_inputs[inputs_dir] = (ModelMatrix.load(inputs_dir),
+                                      geo_cols_df)
+    model_matrix, geo_cols_df = _worker_inputs[inputs_dir]
+
+    _run_block(model, model_name, model_matrix, geo_cols_df, dt_block,
+               refit_days, beg_date, model_cache)
@@ -0,0 +1,216 @@
+"""A module for training a model day by day without refitting it every day.
+
+The daily backtest (see `run_model.py`) trains a model on every ob. before a day
+and then scores that day. Rather than refit the model from scratch on the
+(ever growing) training set each day, an `IncrementalTrainer` updates the model
+with just the newest obs. in between periodic full refits:
+
+* xgboost keeps boosting - new rounds are added on the obs. since the last
+  update, starting from the existing trees.
+* random forests/extra trees are warm started - new trees are grown on the most
+  recent obs. and added to the existing ones.
+
+Any other model is refit from scratch every day. Every day's model is still
+trained on (only) the obs. before that day, and scored on the same test set as
+a full refit would be, so the logged metrics can be compared directly with
+those of a full refit backtest (which is what `refit_days=1` gives).
+"""
+
+import numpy as np
+from datetime import timedelta
+from sklearn.base import clone
+
+# Holds the models that can be updated incrementally, and how.
+BOOSTED_MODELS = ['xgboost']
+FOREST_MODELS = ['random_forest', 'extra_trees']
+
+class IncrementalTrainer(object):
+    """Keep a model trained on the obs. before each day of a backtest.
+
+    Args:
+    ----
+        model: varied
+            Holds the (unfit) model, expected to implement the sklearn model
+            interface. It's cloned, so its params are left as they are (the
+            trainer changes those of its own copy as it goes).
+        model_name: str
+        temporal_index: time_val.TemporalIndex
+            Holds the index of the rows of the matrix being trained on (see
+            `model_matrix.ModelMatrix`), whose train sets are always the first
+            rows of the matrix.
+        refit_days (optional): int
+            Holds how many days to go between full refits (1 refits every day).
+        beg_date (optional): datetime.datetime
+            Holds the first day of the backtest, which the refits are counted
+            from (every `refit_days` days from it start a new period, whose
+            first trained day is a full refit). If None, it's the first day the
+            trainer is fit on. Anchoring the refits to a fixed day keeps them on
+            the same days no matter which days are skipped (e.g. ones with no
+            obs.) or how the backtest is split up (see `backtest.get_dt_blocks`).
+        recent_days (optional): int
+            Holds how many days of the most recent obs. to grow new trees on
+            (for forests).
+        n_new_estimators (optional): int
+            Holds the number of trees/rounds to add with each update. If None,
+            it's the number the model was created with, spread over the days
+            between full refits (so by the next refit, it's been doubled).
+    """
+
+    def __init__(self, model, model_name, temporal_index, refit_days=30,
+                 beg_date=None, recent_days=30, n_new_estimators=None):
+        if refit_days < 1:
+            raise RuntimeError('refit_days must be at least 1')
+
+        self.model = clone(model)
+        self.model_name = model_name
+        self.temporal_index = temporal_index
+        self.refit_days = refit_days
+        self.beg_date = beg_date
+        self.recent_days = recent_days
+
+        self.incremental = refit_days > 1 and \
+                model_name in BOOSTED_MODELS + FOREST_MODELS
+        if self.incremental:
+            self.base_n_estimators = model.get_params()['n_estimators']
+            self.n_new_estimators = n_new_estimators or \
+                    max(1, int(np.ceil(self.base_n_estimators /
+                                       float(refit_days))))
+
+        # Holds the number of (first) rows that the model has learned from, and
+        # the refit period (see `get_refit_period`) it was last fully refit in.
+        self.n_fit_rows = 0
+        self.refit_period = None
+        self.last_fit_kind = None
+
+    def fit(self, dt, X_train, y_train):
+        """Train the model on the obs. before the day.
+
+        The model is fully refit if it hasn't been yet, if the day is in a
+        later refit period than the one it last was (see `get_refit_period`),
+        or if it can't be updated incrementally.
+        Otherwise, it's updated with the rows added since it was last trained.
+        The update is put off (so the rows are included in the next one) if
+        those rows hold only one label.
+
+        Args:
+        ----
+            dt: datetime.datetime
+                Holds the day being scored (all of `X_train` is before it).
+            X_train: 2d np.ndarray
+                Holds the first rows of the matrix (see `ModelMatrix`).
+            y_train: 1d np.ndarray or Pandas Series
+
+        Return:
+        ------
+            self: IncrementalTrainer
+        """
+
+        if self.beg_date is None:
+            self.beg_date = dt
+        n_rows = X_train.shape[0]
+        if not self.incremental or \
+                self.refit_period != self.get_refit_period(dt):
+            self._refit(dt, X_train, y_train)
+        elif n_rows == self.n_fit_rows:
+            self.last_fit_kind = 'unchanged'
+        elif self.model_name in BOOSTED_MODELS:
+            self._boost(X_train, y_train)
+        else:
+            self._grow_trees(dt, X_train, y_train)
+
+        return self
+
+    def get_refit_period(self, dt):
+        """Return the number of the refit period that the day falls in.
+
+        Args:
+        ----
+            dt: datetime.datetime
+
+        Return:
+        ------
+            refit_period: int
+        """
+
+        return (dt - self.beg_date).days // self.refit_days
+
+    def get_state(self):
+        """Return what's needed (along with the model) to pick up training
+        where it left off (e.g. after loading the model from a `ModelCache`).
+
+        Return:
+        ------
+            state: dct
+        """
+
+        return {'n_fit_rows': self.n_fit_rows,
+                'refit_period': self.refit_period}
+
+    def set_state(self, model, state):
+        """Pick up training from a model (and the state returned by
+        `get_state` when it was fit).
+
+        Args:
+        ----
+            model: varied
+            state: dct
+        """
+
+        self.model = model
+        self.n_fit_rows = state['n_fit_rows']
+        self.refit_period = state['refit_period']
+
+    def _refit(self, dt, X_train, y_train):
+        """Fit the model from scratch on every row."""
+
+        if self.incremental:
+            self.model.set_params(n_estimators=self.base_n_estimators)
+            if self.model_name in FOREST_MODELS:
+                self.model.set_params(warm_start=False)
+        self.model.fit(X_train, y_train)
+        self.n_fit_rows = X_train.shape[0]
+        self.refit_period = self.get_refit_period(dt)
+        self.last_fit_kind = 'full'
+
+    def _boost(self, X_train, y_train):
+        """Add boosting rounds fit on the rows since the last update."""
+
+        new_rows = slice(self.n_fit_rows, X_train.shape[0])
+        if not self._has_both_labels(new_rows):
+            self.last_fit_kind = 'deferred'
+            return
+
+        booster = self.model.get_booster() if hasattr(self.model,
+                'get_booster') else self.model.booster()
+        self.model.set_params(n_estimators=self.n_new_estimators)
+        self.model.fit(X_train[new_rows], np.asarray(y_train)[new_rows],
+                       xgb_model=booster)
+        self.n_fit_rows = X_train.shape[0]
+        self.last_fit_kind = 'incremental'
+
+    def _grow_trees(self, dt, X_train, y_train):
+        """Add trees grown on the most recent rows to the forest."""
+
+        recent_beg = min(self.n_fit_rows, self.temporal_index.search(
+            dt - timedelta(days=self.recent_days)))
+        recent_rows = slice(recent_beg, X_train.shape[0])
+        if not self._has_both_labels(recent_rows):
+            self.last_fit_kind = 'deferred'
+            return
+
+        n_estimators = self.model.get_params()['n_estimators']
+        self.model.set_params(warm_start=True,
+                              n_estimators=n_estimators + self.n_new_estimators)
+        self.model.fit(X_train[recent_rows], np.asarray(y_train)[recent_rows])
+        self.n_fit_rows = X_train.shape[0]
+        self.last_fit_kind = 'incremental'
+
+    def _has_both_labels(self, rows):
+        """Return whether the rows hold both positive and negative labels.
+
+        A model updated on a single label would lose track of the other class
+        (sklearn and xgboost both take the classes from the labels they're
+        given).
+        """
+
+        return 0 not in self.temporal_index.count_labels(rows)
@@ -0,0 +1,201 @@
+"""A module for caching the models fit during a backtest on disk.
+
+Every model fit on a day of the backtest (see `backtest.py`) is saved under a
+hash of everything that went into it:
+
+* the model name and its params (other than those that only change how it's
+  fit, e.g. `n_jobs`),
+* the names of the features, and a fingerprint of the training data - the
+  features and labels of every row before the day,
+* the day, and how it was trained (the days between full refits, and - when
+  training incrementally - the first day of the run, which the refits are
+  counted from).
+
+When a backtest is rerun (e.g. after it died partway through, or over a range
+with one more day), any day whose model is already cached is skipped, along
+with its scoring and logging (a model is only cached once its results have
+been logged). Passing `recompute=True` refits (and re-caches) every day.
+
+The fingerprints of the training data are chained day by day (the fingerprint
+before a day hashes the one before the day before it, along with that day's
+rows), so they're found for every day with a single pass over the matrix.
+
+The models are saved with joblib, uncompressed, so their arrays (e.g. the
+nodes of each tree in a forest) can be memory-mapped when they're loaded.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+MODEL_CACHE_DIR = 'code/modeling/model_output/model_cache'
+# Hold the params that only change how a model is fit, and not the fit model
+# (so they're left out of its hash).
+RUN_ONLY_PARAMS = ('n_jobs', 'nthread', 'verbose', 'silent')
+
+class ModelCache(object):
+    """A cache of the models fit on each day of a backtest.
+
+    Args:
+    ----
+        cache_dir: str
+        model_name: str
+        params: dct
+            Holds the params of the model (before it's fit).
+        model_matrix: model_matrix.ModelMatrix
+        refit_days (optional): int
+            Holds the days between full refits (see `IncrementalTrainer`).
+        beg_date (optional): datetime.datetime
+            Holds the first day of the backtest (only used if `refit_days` is
+            more than 1).
+        recompute (optional): bool
+            Holds whether to ignore the models already cached (and overwrite
+            them).
+    """
+
+    def __init__(self, cache_dir, model_name, params, model_matrix,
+                 refit_days=1, beg_date=None, recompute=False):
+        self.cache_dir = os.path.join(cache_dir, model_name)
+        self.recompute = recompute
+
+        params = {param: value for param, value in params.iteritems() if
+                  param not in RUN_ONLY_PARAMS}
+        training = {'refit_days': refit_days}
+        if refit_days > 1:
+            training['beg_date'] = str(beg_date)
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps([model_name, params, training,
+                                  list(model_matrix.feature_names)],
+                                 sort_keys=True, default=repr))
+        self.base_key = hasher.hexdigest()
+
+        self.day_offsets = model_matrix.temporal_index.day_offsets
+        self.fingerprints = get_fingerprints(model_matrix)
+
+    def get_key(self, dt, n_train_rows):
+        """Return the hash that the model fit for the day is cached under.
+
+        Args:
+        ----
+            dt: datetime.datetime
+            n_train_rows: int
+                Holds the number of rows before the day (which always end on
+                a day boundary of the matrix).
+
+        Return:
+        ------
+            key: str
+        """
+
+        day_num = np.searchsorted(self.day_offsets, n_train_rows)
+        if self.day_offsets[day_num] != n_train_rows:
+            raise RuntimeError('The training rows of {} don\'t end on a day of '
+                               'the model matrix'.format(dt))
+
+        hasher = hashlib.sha1()
+        hasher.update(self.base_key)
+        hasher.update(self.fingerprints[day_num])
+        hasher.update(str(dt))
+
+        return hasher.hexdigest()
+
+    def is_cached(self, key):
+        """Return whether there's a model cached under the key (always False
+        if `self.recompute` is set).
+
+        Args:
+        ----
+            key: str
+
+        Return:
+        ------
+            is_cached: bool
+        """
+
+        return not self.recompute and os.path.exists(self._get_filepath(key))
+
+    def save(self, key, model, trainer_state=None):
+        """Save a fit model (and the state of its trainer) under the key.
+
+        The model is written to a temporary file first and then renamed, so a
+        run that dies partway through a save never leaves a broken model in
+        the cache.
+
+        Args:
+        ----
+            key: str
+            model: varied
+            trainer_state (optional): dct
+                Holds the state of the `IncrementalTrainer` that fit the model.
+        """
+
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another process may have made it first.
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        filepath = self._get_filepath(key)
+        tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+        joblib.dump({'model': model, 'trainer_state': trainer_state},
+                    tmp_filepath)
+        os.rename(tmp_filepath, filepath)
+
+    def load(self, key, mmap_mode='r'):
+        """Load the model (and the state of its trainer) cached under the key.
+
+        Args:
+        ----
+            key: str
+            mmap_mode (optional): str or None
+                Passed to `joblib.load`. None reads the model fully into
+                memory.
+
+        Return:
+        ------
+            model: varied
+            trainer_state: dct or None
+        """
+
+        cached = joblib.load(self._get_filepath(key), mmap_mode=mmap_mode)
+
+        return cached['model'], cached['trainer_state']
+
+    def _get_filepath(self, key):
+        """Return the filepath of the model cached under the key."""
+
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+def get_fingerprints(model_matrix):
+    """Return a fingerprint of the rows before each day of the matrix.
+
+    Args:
+    ----
+        model_matrix: model_matrix.ModelMatrix
+
+    Return:
+    ------
+        fingerprints: list of strs
+            Holds the fingerprint of the rows before each day in
+            `model_matrix.temporal_index.days` (and of every row, last).
+    """
+
+    day_offsets = model_matrix.temporal_index.day_offsets
+    fingerprint = hashlib.sha1(str(model_matrix.X.shape[1])).hexdigest()
+    fingerprints = [fingerprint]
+    for beg_row, end_row in zip(day_offsets[:-1], day_offsets[1:]):
+        hasher = hashlib.sha1(fingerprint)
+        hasher.update(np.ascontiguousarray(model_matrix.X[beg_row:end_row])
+                      .tobytes())
+        hasher.update(np.ascontiguousarray(model_matrix.y[beg_row:end_row])
+                      .tobytes())
+        fingerprint = hasher.hexdigest()
+        fingerprints.append(fingerprint)
+
+    return fingerprints
@@ -1,6 +1,12 @@
-"""A module for logging different results during training and testing."""
+"""A module for logging different results during training and testing.
+
+The days of a backtest can be run in parallel processes (see `backtest.py`), 
+so every line appended to a shared log (e.g. `metrics.csv`) is written while 
+holding an exclusive lock on the file (see `append_line`). 
+"""
 
 from datetime import datetime
+import fcntl
 import time
 import numpy as np
 import pandas as pd
@@ -62,30 +68,65 @@ def log_test_results(dt, geo_cols_df, y_true, preds_probs, roc_auc, pr_auc):
     num_fires = y_true.sum()
 
     metrics_fp = base_fp + 'metrics.csv'
-    with open(metrics_fp, 'a+') as f: 
-        out_str = ','.join([str(save_dt), str(num_obs), str(num_fires), 
-            str(roc_auc), str(pr_auc)]) + '\n'
-        f.write(out_str)
+    out_str = ','.join([str(save_dt), str(num_obs), str(num_fires), 
+        str(roc_auc), str(pr_auc)]) + '\n'
+    append_line(metrics_fp, out_str)
+
+def append_line(filepath, line): 
+    """Append a line to a file that other processes may be appending to. 
+
+    The file is locked (with `fcntl.flock`) for the write, so lines written at 
+    the same time by different processes never interleave. 
 
-def log_feat_importances(model, X_train, dt): 
+    Args: 
+    ----
+        filepath: str
+        line: str
+            Holds the line to write (ending in a newline). 
+    """
+
+    with open(filepath, 'a+') as f: 
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try: 
+            f.write(line)
+            f.flush()
+        finally: 
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def log_feat_importances(model, X_train, dt, feature_names=None): 
     """Log the feature importances for a model fit on a given date. 
 
+    For a linear model (without a `feature_importances_` attribute), the 
+    importance of a feature is the absolute value of its coefficient, which 
+    is only comparable across features if they were scaled before fitting 
+    (see `preprocessing.ColumnScaler`). 
+
     Args: 
     ----
-        model: varied tree-based model
-            Fit tree-based model that has a `feature_importances_` attribute`.
+        model: varied
+            Fit tree-based model that has a `feature_importances_` attribute, 
+            or linear model that has a `coef_` attribute. 
         X_train: 2d np.ndarray
             Used to obtain the names of the columns corresponding to the features. 
         dt: datetime.datetime
+        feature_names (optional): list of strs
+            Holds the names of the columns of `X_train`, if it isn't a 
+            DataFrame (see `model_matrix.get_model_matrix`). 
     """
 
     save_dt = '-'.join([str(dt.year), str(dt.month), str(dt.day)])
-    feat_importances = model.feature_importances_
+    if hasattr(model, 'feature_importances_'): 
+        feat_importances = model.feature_importances_
+    else: 
+        feat_importances = np.abs(model.coef_).ravel()
     feats_sorted = np.argsort(feat_importances)
 
-    feat_names = X_train.columns[feats_sorted]
+    feature_names = X_train.columns if feature_names is None else feature_names
+    feat_names = np.asarray(feature_names)[feats_sorted]
     feats_vals_ordered = feat_importances[feats_sorted]
-    feats_vals_ordered = feats_vals_ordered / feats_vals_ordered.max() * 100
+    # A heavily regularized linear model can have every coefficient at zero. 
+    feats_vals_ordered = feats_vals_ordered / \
+            (feats_vals_ordered.max() or 1.) * 100
 
     feats_df = pd.DataFrame()
     feats_df['feat_names'] = feat_names
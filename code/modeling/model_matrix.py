@@ -0,0 +1,362 @@
+"""A module for building the matrix that models are fit on.
+
+The model inputs CSV holds a uint8 dummy column for every category of each
+dummied column (e.g. `src_gsfc`, `src_uaf`, ...), with the categories given by
+the vocabulary saved during feature engineering (see
+`code/feature_engineering/one_hot.py`). Rather than hold every one of those
+columns in memory (and cast them to floats along with everything else), each
+group of dummies is collapsed into a single column of category codes as the
+CSV is read (`read_model_input`), and only expanded back into dummies when the
+matrix is built (`get_model_matrix`) - into a sparse (CSR) block that holds a
+single entry per row. This way, the memory the inputs (and the matrix the
+param. search is fit on) take doesn't grow with the number of categories. The
+dummies are named and encoded
+by the same functions that created them (in `one_hot.py`), so the two sides
+can't disagree.
+
+In the DataFrame, each collapsed column keeps the name of the dummied column
+(e.g. `src`), so `columns_list.pkl` lists `src` rather than each of its dummies.
+
+For the daily backtest, a `ModelMatrix` builds a single contiguous float32
+matrix of the features (and a vector of the labels) in one pass, with the rows
+sorted by date (see `time_val.TemporalIndex`), the unobserved nearby fires
+columns masked out (see `preprocessing.alter_nearby_fires_cols`), and the
+N/A's and inf. values filled in (see `preprocessing.prep_data`). The
+train/test sets of each day are then just slices (views) of it, rather than
+fresh copies of a DataFrame. It can be saved as a set of `.npy` files and
+loaded back memory-mapped, so that the processes of a parallel backtest (see
+`backtest.py`) share a single copy.
+
+The dummies of a `ModelMatrix` are dense (4 bytes per row for each category),
+which is a deliberate trade-off: sklearn models are fit on a single matrix, so
+holding the dummies in a separate sparse block would mean stacking them with
+the numeric columns into a fresh matrix for every day's fit - rather than
+fitting on a view - and the peak memory of each day would be higher than that
+of the dense matrix. On the model inputs built by `create_inputs.py` (43
+numeric columns, and 24 categories in 4 dummied columns), the dummies take 96
+of the 268 bytes per row (a CSR block of them would take 36). If the number of
+categories grows to where the dummies dominate the matrix, it's the
+`get_model_matrix` (sparse) path that should be used.
+"""
+
+import os
+import sys
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from preprocessing import FILL_VALUE, get_unobserved_until
+from time_val import TemporalIndex
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'feature_engineering'))
+import one_hot
+
+DUMMIES_VOCAB_FP = 'code/modeling/model_input/dummies_vocab.pkl'
+CSV_CHUNK_ROWS = 100000
+# The attributes of a `ModelMatrix` that are saved as `.npy` files (the rest are
+# pickled).
+ARRAY_ATTRS = ['X', 'y', 'dates', 'index']
+LIST_ATTRS = ['feature_names', 'numeric_idx']
+
+class ModelMatrix(object):
+    """A float32 matrix of the features, with its rows sorted by date.
+
+    Args:
+    ----
+        input_df: Pandas DataFrame
+            Holds the features, the label, and the date of each ob. (with each
+            group of dummies collapsed into codes - see `read_model_input`).
+        dummies_vocab: dct
+        date_col (optional): str
+        y_col (optional): str
+    """
+
+    def __init__(self, input_df, dummies_vocab, date_col='date_fire',
+                 y_col='fire_bool'):
+        self.temporal_index = TemporalIndex(input_df[date_col], input_df[y_col])
+        order = self.temporal_index.order
+        self.dates = self.temporal_index.dates
+        self.index = input_df.index.values[order]
+        self.y = input_df[y_col].values[order]
+
+        feature_cols = [col for col in input_df.columns if col not in
+                        (date_col, y_col)]
+        self.feature_names = get_feature_names(feature_cols, dummies_vocab)
+        # Holds the columns that aren't dummies (e.g. to scale).
+        self.numeric_idx = []
+        self.X = np.empty((order.shape[0], len(self.feature_names)),
+                          dtype=np.float32)
+
+        unobserved_until = get_unobserved_until()
+        col_beg = 0
+        for col in feature_cols:
+            values = input_df[col].values[order]
+            if col in dummies_vocab:
+                n_categories = len(dummies_vocab[col])
+                one_hot.encode_codes(values, n_categories,
+                        out=self.X[:, col_beg:col_beg + n_categories])
+                col_beg += n_categories
+                continue
+
+            column = self.X[:, col_beg]
+            column[:] = values
+            if col in unobserved_until:
+                column[:self.temporal_index.search(unobserved_until[col])] = \
+                        FILL_VALUE
+            column[~np.isfinite(column)] = FILL_VALUE
+            self.numeric_idx.append(col_beg)
+            col_beg += 1
+
+    def get_day_rows(self, dt):
+        """Return the rows before a day, and the rows on it.
+
+        Args:
+        ----
+            dt: datetime.datetime
+
+        Return:
+        ------
+            train_rows: slice
+            test_rows: slice
+        """
+
+        return self.temporal_index.get_day_rows(dt)
+
+    def get_train_test(self, dt):
+        """Return the train (before the day) and test (on the day) sets.
+
+        Args:
+        ----
+            dt: datetime.datetime
+
+        Return:
+        ------
+            X_train: 2d np.ndarray
+            y_train: Pandas Series
+            X_test: 2d np.ndarray
+            y_test: Pandas Series
+                The matrices are views into `self.X`, and the labels are
+                indexed by the index of the rows in the inputted df.
+        """
+
+        train_rows, test_rows = self.get_day_rows(dt)
+        X_train, X_test = self.X[train_rows], self.X[test_rows]
+        y_train = pd.Series(self.y[train_rows], index=self.index[train_rows],
+                            name='fire_bool')
+        y_test = pd.Series(self.y[test_rows], index=self.index[test_rows],
+                           name='fire_bool')
+
+        return X_train, y_train, X_test, y_test
+
+    def save(self, dir_path):
+        """Save the matrix to `dir_path` as `.npy` files (plus a small pickle).
+
+        Args:
+        ----
+            dir_path: str
+        """
+
+        for attr in ARRAY_ATTRS:
+            np.save(os.path.join(dir_path, attr + '.npy'), getattr(self, attr))
+        lists = dict((attr, getattr(self, attr)) for attr in LIST_ATTRS)
+        with open(os.path.join(dir_path, 'lists.pkl'), 'w+') as f:
+            pickle.dump(lists, f)
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        """Load a matrix saved with `save`, memory-mapping its arrays.
+
+        Args:
+        ----
+            dir_path: str
+            mmap_mode (optional): str or None
+                Passed to `np.load`. None reads the arrays fully into memory.
+
+        Return:
+        ------
+            model_matrix: ModelMatrix
+        """
+
+        model_matrix = cls.__new__(cls)
+        for attr in ARRAY_ATTRS:
+            setattr(model_matrix, attr, np.load(os.path.join(dir_path,
+                attr + '.npy'), mmap_mode=mmap_mode))
+        with open(os.path.join(dir_path, 'lists.pkl')) as f:
+            lists = pickle.load(f)
+        for attr, val in lists.iteritems():
+            setattr(model_matrix, attr, val)
+        # The rows are already sorted, so this only counts the labels.
+        model_matrix.temporal_index = TemporalIndex(model_matrix.dates,
+                                                    model_matrix.y)
+
+        return model_matrix
+
+def load_dummies_vocab(filepath=DUMMIES_VOCAB_FP):
+    """Load the categories of each dummied column.
+
+    Args:
+    ----
+        filepath (optional): str
+
+    Return:
+    ------
+        dummies_vocab: dct
+            Holds the (sorted) list of categories of each dummied column.
+    """
+
+    if not os.path.exists(filepath):
+        raise RuntimeError('No dummies vocabulary at {} - make sure that you '
+                           'have run create_inputs.py'.format(filepath))
+    with open(filepath) as f:
+        dummies_vocab = pickle.load(f)
+
+    return dummies_vocab
+
+def read_model_input(filepath, dummies_vocab, chunksize=CSV_CHUNK_ROWS):
+    """Read the model inputs CSV, collapsing each group of dummies into codes.
+
+    Args:
+    ----
+        filepath: str
+        dummies_vocab: dct
+        chunksize (optional): int
+            Holds how many rows of the CSV to read at once.
+
+    Return:
+    ------
+        input_df: Pandas DataFrame
+            Holds a column of codes (the position of the category in
+            `dummies_vocab`, or -1 for none) in place of each group of dummies.
+    """
+
+    dummies_dtypes = {name: np.uint8 for col in dummies_vocab for name in
+                      one_hot.get_feature_names(col, dummies_vocab[col])}
+    chunks = []
+    for chunk in pd.read_csv(filepath, parse_dates=['date_fire'],
+                             dtype=dummies_dtypes, chunksize=chunksize):
+        for col in sorted(dummies_vocab):
+            chunk = _collapse_dummies(chunk, col, dummies_vocab)
+        chunks.append(chunk)
+    input_df = pd.concat(chunks, ignore_index=True)
+
+    return input_df
+
+def get_model_matrix(features_df, dummies_vocab, sparse_output=True,
+                     dtype=np.float64):
+    """Build the matrix to fit/predict with out of the features.
+
+    Args:
+    ----
+        features_df: Pandas DataFrame
+            Holds the features, with each group of dummies collapsed into codes
+            (see `read_model_input`).
+        dummies_vocab: dct
+        sparse_output (optional): bool
+            Holds whether to return a CSR matrix (where the dummies take a
+            single entry per row, and each run of numeric columns is built as
+            a single block), or a dense array (where every category takes a
+            column).
+        dtype (optional): np.dtype
+
+    Return:
+    ------
+        X: 2d np.ndarray or scipy.sparse.csr_matrix
+        feature_names: list of strs
+            Holds the name of each column of `X` (with each collapsed column
+            expanded back into the names of its dummies).
+    """
+
+    feature_names = get_feature_names(features_df.columns, dummies_vocab)
+    n_rows = features_df.shape[0]
+    if not sparse_output:
+        X = np.empty((n_rows, len(feature_names)), dtype=dtype)
+        col_beg = 0
+        for col in features_df.columns:
+            values = features_df[col].values
+            if col in dummies_vocab:
+                n_categories = len(dummies_vocab[col])
+                one_hot.encode_codes(values, n_categories,
+                                     out=X[:, col_beg:col_beg + n_categories])
+                col_beg += n_categories
+            else:
+                X[:, col_beg] = values
+                col_beg += 1
+        return X, feature_names
+
+    # Each run of numeric columns goes into a single block (rather than a
+    # block per column), in between the blocks of dummies.
+    blocks, numeric_cols = [], []
+    for col in list(features_df.columns) + [None]:
+        if col is not None and col not in dummies_vocab:
+            numeric_cols.append(col)
+            continue
+        if numeric_cols:
+            blocks.append(sparse.csr_matrix(
+                features_df[numeric_cols].values.astype(dtype)))
+            numeric_cols = []
+        if col is not None:
+            blocks.append(one_hot.encode_codes(features_df[col].values,
+                    len(dummies_vocab[col]), sparse_output=True, dtype=dtype))
+    X = sparse.hstack(blocks, format='csr', dtype=dtype) if blocks \
+            else sparse.csr_matrix((n_rows, 0), dtype=dtype)
+
+    return X, feature_names
+
+def get_feature_names(columns, dummies_vocab):
+    """Return the names of the columns of the model matrix.
+
+    Args:
+    ----
+        columns: list of strs
+            Holds the columns of the features DataFrame.
+        dummies_vocab: dct
+
+    Return:
+    ------
+        feature_names: list of strs
+    """
+
+    feature_names = []
+    for col in columns:
+        if col in dummies_vocab:
+            feature_names.extend(one_hot.get_feature_names(
+                col, dummies_vocab[col]))
+        else:
+            feature_names.append(col)
+
+    return feature_names
+
+def _collapse_dummies(df, col, dummies_vocab):
+    """Replace the dummies of a column with a single column of codes.
+
+    Dummies that are in the vocabulary but not in the df (e.g. a CSV written
+    before a category was added) are taken to be all zeros.
+
+    This is a helper function called from `read_model_input`.
+
+    Args:
+    ----
+        df: Pandas DataFrame
+        col: str
+        dummies_vocab: dct
+
+    Return:
+    ------
+        df: Pandas DataFrame
+    """
+
+    dummies_names = one_hot.get_feature_names(col, dummies_vocab[col])
+    present_names = [name for name in dummies_names if name in df.columns]
+    if not present_names:
+        return df
+
+    code_dtype = np.int16 if len(dummies_names) < 2 ** 15 else np.int32
+    codes = np.full(df.shape[0], -1, dtype=code_dtype)
+    for code, name in enumerate(dummies_names):
+        if name in df.columns:
+            codes[df[name].values == 1] = code
+    df = df.drop(present_names, axis=1)
+    df[col] = codes
+
+    return df
@@ -2,16 +2,26 @@
 
 This module provides a number of helper functions for parameter searching. This 
 holds a function for using the `sklearn.grid_search.GridSearchCV` and 
-`sklearn.grid_search.RandomizedSearchCV` (a wrapper around the two). 
+`sklearn.grid_search.RandomizedSearchCV` (a wrapper around the two). They're 
+imported from `sklearn.model_selection` where it exists (and `sklearn.grid_search` 
+was removed). 
 """
 
-from sklearn.grid_search import GridSearchCV, RandomizedSearchCV
+try: 
+    from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
+    # Holds whether the searchers take a splitter (with a `split` method) as 
+    # their `cv` - the old `sklearn.grid_search` ones only take a list of folds. 
+    SPLITTER_CV = True
+except ImportError: 
+    from sklearn.grid_search import GridSearchCV, RandomizedSearchCV
+    SPLITTER_CV = False
 import scipy.stats as scs
 from preprocessing import get_target_features 
+from model_matrix import get_model_matrix
 from scoring import return_scorer
 
 def run_sklearn_param_search(model, train, cv_fold_generator, model_name, 
-        random=False, num_iterations=10): 
+        random=False, num_iterations=10, dummies_vocab=None): 
     """Perform a model search over possible parameter values.
     
     Args: 
@@ -21,12 +31,16 @@ def run_sklearn_param_search(model, train, cv_fold_generator, model_name,
             the sklearn model interface. 
         train: np.ndarray
         cv_fold_generator: SequentialTimeFold object 
-            An object that generates folds to perform cross-validation over. 
+            An object that generates folds to perform cross-validation over 
+            (anything with a `split` method, or an iterable of folds). 
         model_name: str
         random (optional): bool
             Holds whether or not to use RandomizedSearchCV or GridSearchCV. 
         num_iterations (optional): int
             Number of iterations to use for random searching (if used). 
+        dummies_vocab (optional): dct
+            Holds the categories of any columns of category codes in `train`, 
+            which are expanded into sparse dummies (see `model_matrix.py`). 
 
     Returns: 
     -------
@@ -37,17 +51,21 @@ def run_sklearn_param_search(model, train, cv_fold_generator, model_name,
     train_target, train_features = get_target_features(train)
     eval_metric = return_scorer('auc_precision_recall')
 
-    fit_params={}
+    if not SPLITTER_CV and hasattr(cv_fold_generator, 'split'): 
+        cv_fold_generator = list(cv_fold_generator.split())
     if random: 
         params = _get_random_params(model_name)
         grid_search = RandomizedSearchCV(estimator=model, param_distributions=params, 
-                scoring=eval_metric, cv=cv_fold_generator, fit_params=fit_params, 
-                n_iter=num_iterations)
+                scoring=eval_metric, cv=cv_fold_generator, n_iter=num_iterations)
     else: 
         params = _get_grid_params(model_name)
         grid_search = GridSearchCV(estimator=model, param_grid=params, 
-                scoring=eval_metric, cv=cv_fold_generator, fit_params=fit_params)
-    grid_search.fit(train_features.values, train_target.values)
+                scoring=eval_metric, cv=cv_fold_generator)
+    # sklearn's trees and logit both take a CSR matrix, so the dummies are 
+    # never expanded into dense columns. 
+    train_matrix, _ = get_model_matrix(train_features, dummies_vocab or {}, 
+                                       sparse_output=True)
+    grid_search.fit(train_matrix, train_target.values)
 
     best_model = grid_search.best_estimator_
     best_mean_score = grid_search.best_score_
@@ -142,12 +160,18 @@ def get_best_params(model_name):
         best_params: dct
     """
 
-    if model_name == 'random_forest': 
+    if model_name == 'logit': 
+        best_params = {'penalty': 'l2', 
+                'C': 0.0001}
+    elif model_name == 'random_forest': 
         best_params = {'n_estimators': 2, 
                 'max_depth': 4}
     elif model_name == 'extra_trees': 
         best_params = {'n_estimators': 2, 
                 'max_depth': 4}
+    else: 
+        raise RuntimeError('There are no best params for {} - add them to '
+                           'get_best_params'.format(model_name))
 
     return best_params
 
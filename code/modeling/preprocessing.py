@@ -4,18 +4,37 @@ This is a module containing functions for preprocessing the data before inputtin
 it into models, but after any/all feature engineering is complete. 
 """
 
+import os
+import pickle
 import numpy as np
 from datetime import datetime, timedelta
 
-def normalize_df(input_df): 
+# Holds the value that N/A's and inf. values are filled in with. 
+FILL_VALUE = -999
+# Holds the nearby fires columns that can't be calculated for the obs. within 
+# the given number of days after `UNOBSERVED_START_DATE` (since the data starts 
+# in 2012 - see `alter_nearby_fires_cols`). 
+UNOBSERVED_START_DATE = datetime(2013, 1, 1, 0, 0, 0)
+UNOBSERVED_COLS = {0: ['all_nearby_count365', 'all_nearby_fires365'], 
+                   365: ['all_nearby_count365', 'all_nearby_fires365', 
+                        'all_nearby_count730', 'all_nearby_fires730'], 
+                   730: ['all_nearby_count365', 'all_nearby_fires365', 
+                        'all_nearby_count730', 'all_nearby_fires730', 
+                        'all_nearby_count1095', 'all_nearby_fires1095']}
+
+def normalize_df(input_df, skip_cols=()): 
     """Perform a normalization on all numerical columns that aren't Y.
 
     Specfically, perform a normalization on each column by subtracting off its 
-    mean and dividing by its standard deviation. 
+    mean and dividing by its standard deviation (see `ColumnScaler`). 
 
     Args: 
     ----
         input_df: Pandas DataFrame
+        skip_cols (optional): iterable of strs
+            Holds any other columns not to normalize (e.g. the columns of 
+            category codes that are expanded into dummies by 
+            `model_matrix.get_model_matrix`). 
 
     Return: 
     ------
@@ -24,13 +43,263 @@ def normalize_df(input_df):
     """
     
     output_df = input_df.copy()
-    for col in input_df.columns: 
-        if col not in ('fire_bool', 'date_fire'): 
-            output_df[col] = (input_df[col] - input_df[col].mean()) \
-                / input_df[col].std() 
+    ColumnScaler(skip_cols).fit(input_df).transform(output_df)
 
     return output_df
 
+class ColumnScaler(object): 
+    """Scale numerical columns by their mean and standard deviation. 
+
+    The statistics of each column are calculated in a single vectorized pass 
+    over a float32 block of the columns (accumulated in float64), and can be 
+    updated as new rows come in (`partial_fit`) by merging the statistics of 
+    the new rows into the old ones (Welford's method, as generalized by Chan 
+    et al.), rather than recalculated over every row. Only finite values are 
+    counted, and any others (NaN or inf) are left as they are when scaling 
+    (they're filled in later by `prep_data`). 
+
+    Args: 
+    ----
+        skip_cols (optional): iterable of strs
+            Holds any columns not to scale, besides `fire_bool` and `date_fire`. 
+    """
+
+    def __init__(self, skip_cols=()): 
+        self.skip_cols = set(skip_cols) | set(['fire_bool', 'date_fire'])
+        self.columns = None
+        self.counts, self.means, self.m2s = None, None, None
+
+    def fit(self, input_df): 
+        """Calculate the statistics of the columns from scratch. 
+
+        Args: 
+        ----
+            input_df: Pandas DataFrame
+
+        Return: 
+        ------
+            self: ColumnScaler
+        """
+
+        self.columns = None
+
+        return self.partial_fit(input_df)
+
+    def partial_fit(self, input_df): 
+        """Update the statistics of the columns with new rows. 
+
+        Args: 
+        ----
+            input_df: Pandas DataFrame
+                Holds only the new rows. 
+
+        Return: 
+        ------
+            self: ColumnScaler
+        """
+
+        if self.columns is None: 
+            self.columns = [col for col in input_df.columns if col not in 
+                    self.skip_cols and input_df[col].dtype.kind in 'biuf']
+            self.counts = np.zeros(len(self.columns), dtype=np.int64)
+            self.means = np.zeros(len(self.columns), dtype=np.float64)
+            self.m2s = np.zeros(len(self.columns), dtype=np.float64)
+        if not input_df.shape[0] or not self.columns: 
+            return self
+
+        block = np.empty((input_df.shape[0], len(self.columns)), 
+                dtype=np.float32)
+        for col_idx, col in enumerate(self.columns): 
+            block[:, col_idx] = input_df[col].values
+
+        return self._update_stats(block)
+
+    def partial_fit_array(self, X, col_idx, missing_value=None): 
+        """Update the statistics of the columns of a matrix with new rows. 
+
+        This is the same as `partial_fit`, but for a matrix whose N/A's and 
+        inf. values have already been filled in (e.g. a `ModelMatrix`), in 
+        which case the `missing_value` they were filled with isn't counted. 
+
+        Args: 
+        ----
+            X: 2d np.ndarray
+                Holds only the new rows. 
+            col_idx: list of ints
+                Holds the columns of `X` to scale. 
+            missing_value (optional): float
+
+        Return: 
+        ------
+            self: ColumnScaler
+        """
+
+        if self.columns is None: 
+            self.columns = list(col_idx)
+            self.counts = np.zeros(len(self.columns), dtype=np.int64)
+            self.means = np.zeros(len(self.columns), dtype=np.float64)
+            self.m2s = np.zeros(len(self.columns), dtype=np.float64)
+        if not X.shape[0] or not self.columns: 
+            return self
+
+        block = X[:, self.columns].astype(np.float32)
+        if missing_value is not None: 
+            block[block == missing_value] = np.nan
+
+        return self._update_stats(block)
+
+    def _update_stats(self, block): 
+        """Merge the statistics of a block of new rows into the current ones. 
+
+        Args: 
+        ----
+            block: 2d np.ndarray (float32)
+                Holds a column for each of `self.columns` (which is modified). 
+
+        Return: 
+        ------
+            self: ColumnScaler
+        """
+
+        is_finite = np.isfinite(block)
+        block[~is_finite] = 0.
+
+        new_counts = is_finite.sum(axis=0)
+        new_means = block.sum(axis=0, dtype=np.float64) / \
+                np.maximum(new_counts, 1)
+        block -= new_means.astype(np.float32)
+        block[~is_finite] = 0.
+        new_m2s = np.einsum('ij,ij->j', block, block, dtype=np.float64)
+
+        counts = self.counts + new_counts
+        deltas = new_means - self.means
+        new_shares = new_counts / np.maximum(counts, 1).astype(np.float64)
+        self.means = self.means + deltas * new_shares
+        self.m2s = self.m2s + new_m2s + deltas ** 2 * self.counts * new_shares
+        self.counts = counts
+
+        return self
+
+    def get_stds(self): 
+        """Return the (sample) standard deviation of each column. 
+
+        Columns with no spread (or fewer than two values) get a standard 
+        deviation of one, so that they're only centered. 
+
+        Return: 
+        ------
+            stds: 1d np.ndarray
+        """
+
+        stds = np.sqrt(self.m2s / np.maximum(self.counts - 1, 1))
+        stds[(self.counts < 2) | (stds == 0)] = 1.
+
+        return stds
+
+    def transform(self, input_df): 
+        """Scale the columns of the df in place. 
+
+        Args: 
+        ----
+            input_df: Pandas DataFrame
+
+        Return: 
+        ------
+            input_df: Pandas DataFrame
+                Holds the scaled columns as float32. 
+        """
+
+        if self.columns is None: 
+            raise RuntimeError('The ColumnScaler needs to be fit before it can '
+                               'transform')
+
+        means, stds = self.means.astype(np.float32), \
+                self.get_stds().astype(np.float32)
+        for col_idx, col in enumerate(self.columns): 
+            values = input_df[col].values.astype(np.float32)
+            values -= means[col_idx]
+            values /= stds[col_idx]
+            input_df[col] = values
+
+        return input_df
+
+    def transform_array(self, X, missing_value=None, out=None): 
+        """Return a scaled copy of a matrix (see `partial_fit_array`). 
+
+        Args: 
+        ----
+            X: 2d np.ndarray
+            missing_value (optional): float
+                Holds the value that's left as is, rather than scaled. 
+            out (optional): 2d np.ndarray (float32)
+                Holds an array of the same shape as `X` to write the scaled 
+                matrix into (e.g. a buffer reused from day to day), rather 
+                than allocating a new one. It can be `X` itself. 
+
+        Return: 
+        ------
+            X: 2d np.ndarray (float32)
+        """
+
+        if self.columns is None: 
+            raise RuntimeError('The ColumnScaler needs to be fit before it can '
+                               'transform')
+
+        if out is None: 
+            out = X.astype(np.float32)
+        elif out is not X: 
+            out[:] = X
+        means, stds = self.means.astype(np.float32), \
+                self.get_stds().astype(np.float32)
+        for col_idx, col in enumerate(self.columns): 
+            values = out[:, col]
+            if missing_value is not None: 
+                is_missing = values == missing_value
+            values -= means[col_idx]
+            values /= stds[col_idx]
+            if missing_value is not None: 
+                values[is_missing] = missing_value
+
+        return out
+
+    def save(self, filepath): 
+        """Save the fitted statistics. 
+
+        Args: 
+        ----
+            filepath: str
+        """
+
+        dirpath = os.path.dirname(filepath)
+        if dirpath and not os.path.exists(dirpath): 
+            os.makedirs(dirpath)
+        with open(filepath, 'w+') as f: 
+            pickle.dump({'skip_cols': sorted(self.skip_cols), 
+                         'columns': self.columns, 'counts': self.counts, 
+                         'means': self.means, 'm2s': self.m2s}, f)
+
+    @classmethod
+    def load(cls, filepath): 
+        """Load a saved scaler. 
+
+        Args: 
+        ----
+            filepath: str
+
+        Return: 
+        ------
+            scaler: ColumnScaler
+        """
+
+        with open(filepath) as f: 
+            state = pickle.load(f)
+        scaler = cls(state['skip_cols'])
+        scaler.columns = state['columns']
+        scaler.counts, scaler.means, scaler.m2s = state['counts'], \
+                state['means'], state['m2s']
+
+        return scaler
+
 def prep_data(input_df): 
     """Fill in N/A's and inf. values, and drop the `date_fire` column. 
 
@@ -43,8 +312,8 @@ def prep_data(input_df):
         output_df: Pandas DataFrame 
     """
 
-    output_df = input_df.fillna(-999)
-    output_df.replace(np.inf, -999, inplace=True)
+    output_df = input_df.fillna(FILL_VALUE)
+    output_df.replace(np.inf, FILL_VALUE, inplace=True)
     output_df.drop('date_fire', inplace=True, axis=1)
 
     return output_df
@@ -100,25 +369,34 @@ def alter_nearby_fires_cols(input_df):
         output_df: pandas DataFrame
     """
 
-    start_date = datetime(2013, 1, 1, 0, 0, 0)
+    # Every column is replaced for the obs. before the latest date it's 
+    # unobserved until (see `UNOBSERVED_COLS`). 
+    output_df = input_df.copy()
+    dates = input_df['date_fire'].values
+    for col_name, break_date in get_unobserved_until().iteritems(): 
+        if col_name in output_df.columns: 
+            values = output_df[col_name].values.astype(np.float64)
+            values[dates < np.datetime64(break_date)] = np.inf
+            output_df[col_name] = values
 
-    # Go forward the key number of days (0, 365, or 730), and replace
-    # all the columns in the value list with 'Nans'. I could have compacted
-    # the lists here, but it probably would have been at the cost of a 
-    # little bit of clarity and readability. 
-    replace_dct = {0: ['all_nearby_count365', 'all_nearby_fires365'], 
-                   365: ['all_nearby_count365', 'all_nearby_fires365', 
-                        'all_nearby_count730', 'all_nearby_fires730'], 
-                   730: ['all_nearby_count365', 'all_nearby_fires365', 
-                        'all_nearby_count730', 'all_nearby_fires730', 
-                        'all_nearby_count1095', 'all_nearby_fires1095']}
+    return output_df 
 
-    output_df = input_df.copy()
-    for days_forward, col_names in replace_dct.iteritems(): 
-        break_date = start_date + timedelta(days=days_forward)
+def get_unobserved_until(): 
+    """Return the date that each of the `UNOBSERVED_COLS` is unobserved until. 
+
+    Return: 
+    ------
+        unobserved_until: dct
+            Holds the date (a datetime.datetime) that each column can first be 
+            calculated on. 
+    """
+
+    unobserved_until = {}
+    for days_forward, col_names in UNOBSERVED_COLS.iteritems(): 
+        break_date = UNOBSERVED_START_DATE + timedelta(days=days_forward)
         for col_name in col_names: 
-            output_df.loc[input_df['date_fire'] < break_date, col_name] \
-                    = np.float('inf')
+            unobserved_until[col_name] = max(break_date, 
+                    unobserved_until.get(col_name, break_date))
 
-    return output_df 
+    return unobserved_until
 
@@ -21,13 +21,20 @@ import pickle
 import pandas as pd
 import numpy as np
 from datetime import timedelta, datetime
-from scoring import return_scorer, return_score
-from time_val import SequentialTimeFold
-from preprocessing import normalize_df, prep_data, \
-        alter_nearby_fires_cols, get_target_features
+from scoring import return_scorer
+from time_val import SequentialTimeFold, TemporalIndex
+from preprocessing import ColumnScaler, prep_data, alter_nearby_fires_cols
 from supervised_models import get_model 
 from param_searching import run_sklearn_param_search, get_best_params
-from model_logging import log_train_results, log_test_results, log_feat_importances
+from model_logging import log_train_results
+from model_matrix import load_dummies_vocab, read_model_input, ModelMatrix
+from backtest import run_backtest
+from model_cache import MODEL_CACHE_DIR
+
+SCALER_FP = 'code/modeling/model_output/scalers/{}.pkl'
+# Holds the days between full refits when training incrementally in the 
+# backtest (see `incremental_training.py`). 
+INCREMENTAL_REFIT_DAYS = 30
 
 def format_date(dt): 
     """Return a datetime object from the inputted string. 
@@ -47,18 +54,46 @@ def format_date(dt):
     
     return formatted_date
 
-def get_train_test(df, date_col, test_date): 
+def get_argv_int(name, default): 
+    """Return the int passed in as a `<name>=<int>` command line argument. 
+
+    Args: 
+    ----
+        name: str
+        default: int
+            Holds the value to return if the argument wasn't passed in. 
+
+    Return: 
+    ------
+        value: int
+    """
+
+    prefix = name + '='
+    for arg in sys.argv: 
+        if arg.startswith(prefix): 
+            try: 
+                return int(arg[len(prefix):])
+            except ValueError: 
+                raise RuntimeError('{} needs to be an integer, e.g. {}4'
+                        .format(name, prefix))
+
+    return default
+
+def get_train_test(df, date_col, test_date, temporal_index=None): 
     """Return a train/test split based off the inputted test_date
 
     For the inputted DataFrame, break it into a train/test split, where the 
     train is all those rows prior to the test_date, and the test is all the 
-    rows that fall on that day. 
+    rows that fall on that day. Both are returned in date order. 
 
     Args: 
     ----
         df: Pandas DataFrame
         date_col: str
         test_date: datime.datime
+        temporal_index (optional): time_val.TemporalIndex
+            Holds an index of `df[date_col]` to split with, so that splitting 
+            the same df on many days doesn't sort it each time. 
 
     Return: 
     ------
@@ -66,14 +101,11 @@ def get_train_test(df, date_col, test_date):
         test: Pandas DataFrame
     """
 
-    min_test_date = test_date
-    max_test_date = min_test_date + timedelta(days=1)
-    
-    test_mask = np.where(np.logical_and(df[date_col] >= min_test_date, 
-        df[date_col] < max_test_date))[0]
-    train_mask = np.where(df[date_col] < min_test_date)[0]
-    train = df.ix[train_mask, :] 
-    test = df.ix[test_mask, :]
+    if temporal_index is None: 
+        temporal_index = TemporalIndex(df[date_col])
+    train_rows, test_rows = temporal_index.get_day_rows(test_date)
+    train = df.iloc[temporal_index.get_positions(train_rows)]
+    test = df.iloc[temporal_index.get_positions(test_rows)]
 
     return train, test
 
@@ -81,15 +113,18 @@ if __name__ == '__main__':
     model_name = sys.argv[1]
     input_df_fp = sys.argv[2]
 
-    base_input_df = pd.read_csv(input_df_fp, parse_dates=['date_fire'])
+    # Each group of dummies is read in as a single column of category codes, 
+    # which are only expanded (sparsely) when building the model matrix. 
+    dummies_vocab = load_dummies_vocab()
+    base_input_df = read_model_input(input_df_fp, dummies_vocab)
     with open('code/makefiles/columns_list.pkl') as f: 
         keep_columns = pickle.load(f)
 
-    input_df = alter_nearby_fires_cols(base_input_df)
     # Create separate df of columns we want associated with predicted probs.
     geo_keep_cols = ['state_name', 'state_fips', 'county_name', 'county_fips', 'lat', 'long', 'date']
-    geo_cols_df = input_df[geo_keep_cols]
-    input_df = input_df[keep_columns]
+    geo_cols_df = base_input_df[geo_keep_cols]
+    input_df = base_input_df[keep_columns]
+    del base_input_df
     if 'train' in sys.argv: 
         if len(sys.argv) == 4: 
             # If this is 4, use the passed in day as the date for the test set.  
@@ -99,14 +134,18 @@ if __name__ == '__main__':
             test_set_timestamp = input_df['date_fire'].max()
             test_set_date = datetime(test_set_timestamp.year, 
                     test_set_timestamp.month, test_set_timestamp.day, 0, 0, 0)
-        validation, hold_out = get_train_test(input_df, 'date_fire', test_set_date)
+        input_df = alter_nearby_fires_cols(input_df)
+        validation, _ = get_train_test(input_df, 'date_fire', test_set_date)
 
         # We need to reset the index so cross-validation happens appropriately. 
         validation.reset_index(drop=True, inplace=True)
 
-        # sklearn logit uses regularization by default. 
+        # sklearn logit uses regularization by default. The scaler is saved, so 
+        # the same statistics can be applied to any data scored later on. 
         if model_name == 'logit': 
-            validation = normalize_df(validation)
+            scaler = ColumnScaler(skip_cols=dummies_vocab).fit(validation)
+            scaler.transform(validation)
+            scaler.save(SCALER_FP.format(model_name))
         
         # If 'random' was passed in, then perform a random param search and else 
         # just do a grid search. 
@@ -124,8 +163,9 @@ if __name__ == '__main__':
 
         validation = prep_data(validation)
         best_fit_model, best_score = \
-                run_sklearn_param_search(model, validation, list(cv_fold_generator),
-                                         model_name, rand_search)
+                run_sklearn_param_search(model, validation, cv_fold_generator,
+                                         model_name, rand_search, 
+                                         dummies_vocab=dummies_vocab)
         score_type = 'AUC PR'              
         log_train_results(model_name, validation, best_fit_model, best_score,       
                           score_type)
@@ -138,20 +178,23 @@ if __name__ == '__main__':
         best_params = get_best_params(model_name)
         model.set_params(**best_params)
 
+        # The features are built into a single float32 matrix (with its rows 
+        # sorted by date, and the unobserved and missing values filled in) up 
+        # front, so that each day's train/test sets are just slices of it. 
+        model_matrix = ModelMatrix(input_df, dummies_vocab)
+        del input_df
+
+        # If 'incremental' was passed in, then the model is only refit from 
+        # scratch every so often, and updated with the newest obs. in between 
+        # (otherwise, it's refit every day). If 'day_jobs=<n>' was passed in, 
+        # the days are run in n processes, which split the cores between them. 
+        # The model fit on each day is cached, and days whose models are 
+        # already cached (from an earlier run) are skipped, unless 'recompute' 
+        # was passed in. 
+        refit_days = INCREMENTAL_REFIT_DAYS if 'incremental' in sys.argv else 1
+        n_day_jobs = get_argv_int('day_jobs', 1)
+        recompute = True if 'recompute' in sys.argv else False
         dt_range = pd.date_range(beg_date, end_date)
-        for dt in dt_range: 
-            validation, hold_out = get_train_test(input_df, 'date_fire', dt)
-            validation, hold_out = prep_data(validation), prep_data(hold_out)
-            Y_train, X_train = get_target_features(validation)
-            Y_test, X_test = get_target_features(hold_out)
-            # Don't run models if there are no obs for a day. 
-            if X_train.shape[0] and X_test.shape[0]: 
-                model.fit(X_train, Y_train)
-                pred_probs = model.predict_proba(X_test)[:, 1]
-                roc_auc, pr_auc = None, None
-                # We can't get area under the curve if there are no fires :(. 
-                if Y_test.sum() != 0: 
-                    roc_auc = return_score('auc_roc', pred_probs, Y_test)
-                    pr_auc = return_score('auc_precision_recall', pred_probs, Y_test)
-                log_feat_importances(model, X_train, dt)
-                log_test_results(dt, geo_cols_df, Y_test, pred_probs, roc_auc, pr_auc)
+        run_backtest(model, model_name, model_matrix, geo_cols_df, dt_range, 
+                refit_days, n_day_jobs, model_cache_dir=MODEL_CACHE_DIR, 
+                recompute=recompute)
@@ -0,0 +1,183 @@
+"""Tests for running the daily backtest end to end (see `backtest.py`).
+
+They run short backtests on a small synthetic model matrix, in a temporary
+working directory (so the logged results don't touch `model_output`). Run them
+from this folder, as `python -m unittest test_backtest`.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from sklearn.linear_model import LogisticRegression
+from preprocessing import ColumnScaler, FILL_VALUE
+from model_matrix import ModelMatrix
+from param_searching import get_best_params
+from backtest import run_backtest
+
+DUMMIES_VOCAB = {'src': ['gsfc', 'ssec', 'uaf']}
+BEG_DATE = datetime(2015, 4, 1)
+
+def make_input_df(n_days=12, rows_per_day=40, skip_days=(), seed=24):
+    """Return a synthetic input df (with the `src` dummies collapsed into
+    codes), and the geographical columns to log with it.
+
+    Args:
+    ----
+        n_days (optional): int
+        rows_per_day (optional): int
+        skip_days (optional): tuple of ints
+            Holds the days (counted from `BEG_DATE`) to leave without rows.
+        seed (optional): int
+
+    Return:
+    ------
+        input_df: Pandas DataFrame
+        geo_cols_df: Pandas DataFrame
+    """
+
+    rand = np.random.RandomState(seed)
+    days = [day for day in range(n_days) if day not in skip_days]
+    n_rows = len(days) * rows_per_day
+    dates = pd.to_datetime(BEG_DATE) + pd.to_timedelta(
+        np.repeat(days, rows_per_day), unit='D')
+    frp = rand.gamma(2., 20., n_rows)
+    conf = rand.randint(0, 101, n_rows).astype(float)
+    fire_prob = 1. / (1. + np.exp(-(frp - 40.) / 10.))
+    input_df = pd.DataFrame({'date_fire': dates,
+                             'lat': rand.uniform(30., 48., n_rows),
+                             'frp': frp,
+                             'conf': conf,
+                             'src': rand.randint(-1, 3, n_rows),
+                             'fire_bool': rand.uniform(size=n_rows) < fire_prob})
+    input_df['fire_bool'] = input_df['fire_bool'].astype(int)
+    input_df.loc[rand.uniform(size=n_rows) < 0.05, 'conf'] = np.nan
+    # Shuffle the rows, so the matrix has to sort them by date.
+    input_df = input_df.iloc[rand.permutation(n_rows)].reset_index(drop=True)
+    geo_cols_df = input_df[['lat']].copy()
+    geo_cols_df['date'] = input_df['date_fire']
+
+    return input_df, geo_cols_df
+
+def read_metrics():
+    """Return the lines of the logged `metrics.csv`, sorted by day."""
+
+    with open('code/modeling/model_output/metrics.csv') as f:
+        return sorted(f.read().splitlines())
+
+class TestLogitBacktest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_dir = os.getcwd()
+        self.work_dir = tempfile.mkdtemp(prefix='test_backtest_')
+        os.chdir(self.work_dir)
+        self._make_output_dirs()
+
+    def tearDown(self):
+        os.chdir(self.orig_dir)
+        shutil.rmtree(self.work_dir)
+
+    def _make_output_dirs(self):
+        for dir_name in ['pred_probs', 'feat_importances']:
+            os.makedirs(os.path.join('code/modeling/model_output', dir_name))
+
+    def _reset_output_dirs(self):
+        shutil.rmtree('code/modeling/model_output')
+        self._make_output_dirs()
+
+    def _get_model(self):
+        model = LogisticRegression(random_state=24, solver='liblinear')
+        return model.set_params(**get_best_params('logit'))
+
+    def test_logs_every_day(self):
+        input_df, geo_cols_df = make_input_df(skip_days=(4,))
+        model_matrix = ModelMatrix(input_df, DUMMIES_VOCAB)
+        dt_range = pd.date_range(BEG_DATE, periods=12)
+        run_backtest(self._get_model(), 'logit', model_matrix, geo_cols_df,
+                     dt_range)
+
+        # The first day has nothing to train on, and the skipped day nothing
+        # to score.
+        logged_days = [line.split(',')[0] for line in read_metrics()]
+        expected_days = ['2015-4-{}'.format(day) for day in range(2, 13) if
+                         day != 5]
+        self.assertEqual(logged_days, sorted(expected_days))
+        for day in expected_days:
+            feats_df = pd.read_csv('code/modeling/model_output/'
+                                   'feat_importances/feats_{}.csv'.format(day))
+            self.assertEqual(sorted(feats_df['feat_names']),
+                             sorted(model_matrix.feature_names))
+            self.assertTrue(np.isfinite(feats_df['importance']).all())
+
+    def test_matches_a_full_fit(self):
+        input_df, geo_cols_df = make_input_df()
+        model_matrix = ModelMatrix(input_df, DUMMIES_VOCAB)
+        dt_range = pd.date_range(BEG_DATE, periods=12)
+        run_backtest(self._get_model(), 'logit', model_matrix, geo_cols_df,
+                     dt_range)
+
+        # With a refit every day, each day's model is the one fit on its train
+        # set scaled by the statistics of the whole of it.
+        for dt in dt_range[1:]:
+            X_train, y_train, X_test, _ = model_matrix.get_train_test(dt)
+            scaler = ColumnScaler().partial_fit_array(X_train,
+                    model_matrix.numeric_idx, FILL_VALUE)
+            model = self._get_model().fit(
+                scaler.transform_array(X_train, FILL_VALUE), y_train)
+            expected = model.predict_proba(
+                scaler.transform_array(X_test, FILL_VALUE))[:, 1]
+
+            save_dt = '{}-{}-{}'.format(dt.year, dt.month, dt.day)
+            preds_df = pd.read_csv('code/modeling/model_output/pred_probs/'
+                                   'preds_probs_{}.csv'.format(save_dt))
+            np.testing.assert_allclose(preds_df['preds_probs'].values,
+                                       expected, rtol=1e-5)
+
+    def test_scales_by_the_refit_period(self):
+        input_df, geo_cols_df = make_input_df()
+        model_matrix = ModelMatrix(input_df, DUMMIES_VOCAB)
+        dt_range = pd.date_range(BEG_DATE, periods=12)
+        run_backtest(self._get_model(), 'logit', model_matrix, geo_cols_df,
+                     dt_range, refit_days=4)
+
+        # Each day is scaled by the statistics of the rows before the start of
+        # its refit period (or of the first day, for the first period).
+        for day_num, dt in enumerate(dt_range[1:], 1):
+            X_train, y_train, X_test, _ = model_matrix.get_train_test(dt)
+            period_beg = dt_range[max(1, day_num // 4 * 4)]
+            n_stat_rows = model_matrix.temporal_index.search(period_beg)
+            scaler = ColumnScaler().partial_fit_array(X_train[:n_stat_rows],
+                    model_matrix.numeric_idx, FILL_VALUE)
+            model = self._get_model().fit(
+                scaler.transform_array(X_train, FILL_VALUE), y_train)
+            expected = model.predict_proba(
+                scaler.transform_array(X_test, FILL_VALUE))[:, 1]
+
+            save_dt = '{}-{}-{}'.format(dt.year, dt.month, dt.day)
+            preds_df = pd.read_csv('code/modeling/model_output/pred_probs/'
+                                   'preds_probs_{}.csv'.format(save_dt))
+            np.testing.assert_allclose(preds_df['preds_probs'].values,
+                                       expected, rtol=1e-5)
+
+    def test_blocks_match_a_single_block(self):
+        # A day without rows at the start of a refit period used to push the
+        # later refits (and so the statistics scaled by) off by a day.
+        input_df, geo_cols_df = make_input_df(n_days=15, skip_days=(3,))
+        model_matrix = ModelMatrix(input_df, DUMMIES_VOCAB)
+        dt_range = pd.date_range(BEG_DATE, periods=15)
+
+        run_backtest(self._get_model(), 'logit', model_matrix, geo_cols_df,
+                     dt_range, refit_days=3)
+        serial_metrics = read_metrics()
+        self._reset_output_dirs()
+        run_backtest(self._get_model(), 'logit', model_matrix, geo_cols_df,
+                     dt_range, refit_days=3, n_day_jobs=2, n_jobs=2)
+
+        self.assertEqual(len(serial_metrics), 13)
+        self.assertEqual(read_metrics(), serial_metrics)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""Tests for scaling the features (see `preprocessing.ColumnScaler`).
+
+Run them from this folder, as `python -m unittest test_preprocessing`.
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+from preprocessing import ColumnScaler, FILL_VALUE
+
+def make_features(n_days=20, seed=24):
+    """Return a df of features, with a day number for each row.
+
+    Args:
+    ----
+        n_days (optional): int
+        seed (optional): int
+
+    Return:
+    ------
+        features_df: Pandas DataFrame
+        day_nums: 1d np.ndarray
+    """
+
+    rand = np.random.RandomState(seed)
+    day_sizes = rand.randint(0, 300, n_days)
+    day_nums = np.repeat(np.arange(n_days), day_sizes)
+    n_rows = day_nums.shape[0]
+    # Shift the columns over time, so later days change the statistics.
+    features_df = pd.DataFrame({
+        'frp': rand.gamma(2., 20., n_rows) + day_nums,
+        'conf': rand.normal(50., 10., n_rows) * (1. + day_nums / 10.),
+        'constant': np.full(n_rows, 3.),
+        'lat': rand.uniform(30., 48., n_rows)})
+    features_df.loc[rand.uniform(size=n_rows) < 0.1, 'conf'] = np.nan
+    features_df.loc[day_nums < 5, 'lat'] = np.nan
+
+    return features_df, day_nums
+
+class TestColumnScaler(unittest.TestCase):
+
+    def setUp(self):
+        self.features_df, self.day_nums = make_features()
+        # As in a `ModelMatrix`, the missing values are filled in.
+        self.X = self.features_df.fillna(FILL_VALUE).values.astype(np.float32)
+        self.col_idx = range(self.X.shape[1])
+
+    def test_daily_partial_fit_matches_full_fit(self):
+        # As in the backtest, the statistics are updated with each day's rows
+        # as they join the train set, and compared with a fit from scratch
+        # on the rows before each day.
+        daily_scaler = ColumnScaler()
+        n_rows = 0
+        for day_num in range(self.day_nums.max() + 1):
+            day_end = np.searchsorted(self.day_nums, day_num, side='right')
+            daily_scaler.partial_fit_array(self.X[n_rows:day_end],
+                                           self.col_idx, FILL_VALUE)
+            n_rows = day_end
+
+            full_scaler = ColumnScaler().fit(self.features_df.iloc[:n_rows])
+            np.testing.assert_array_equal(daily_scaler.counts,
+                                          full_scaler.counts)
+            np.testing.assert_allclose(daily_scaler.means, full_scaler.means,
+                                       rtol=1e-6, atol=1e-9)
+            np.testing.assert_allclose(daily_scaler.get_stds(),
+                                       full_scaler.get_stds(), rtol=1e-5)
+
+    def test_transform_array_scales_around_missing(self):
+        scaler = ColumnScaler().partial_fit_array(self.X, self.col_idx,
+                                                  FILL_VALUE)
+        # The missing values are left as they are.
+        means = scaler.means.astype(np.float32)
+        stds = scaler.get_stds().astype(np.float32)
+        expected = np.where(self.X == FILL_VALUE, self.X,
+                            (self.X - means) / stds)
+
+        scaled = scaler.transform_array(self.X, FILL_VALUE)
+        np.testing.assert_allclose(scaled, expected, rtol=1e-6)
+        self.assertTrue((scaled[self.X == FILL_VALUE] == FILL_VALUE).all())
+        # Scaling into a buffer (or in place) gives the same values.
+        out = np.empty_like(self.X)
+        scaler.transform_array(self.X, FILL_VALUE, out=out)
+        np.testing.assert_array_equal(out, scaled)
+        X = self.X.copy()
+        scaler.transform_array(X, FILL_VALUE, out=X)
+        np.testing.assert_array_equal(X, scaled)
+
+if __name__ == '__main__':
+    unittest.main()
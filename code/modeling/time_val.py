@@ -6,12 +6,166 @@ lack of easy (or really any) to use generators that could be passed into
 GridSearchCV in sklearn.grid_search in the case of working with time-series
 data (at the time of writing - it's apparently currently in the works with 
 sklearn). 
+
+Splits are found with a `TemporalIndex`, which sorts the rows by date once and 
+keeps the label counts of every day, so each split is a binary search (and a 
+view of the sorted order) rather than a comparison over every row. 
 """
 
 import numpy as np
 import pandas as pd
 from datetime import timedelta, datetime
 
+class TemporalIndex(object):
+    """An index of the rows of a dataset, sorted by date. 
+
+    The rows are sorted (stably) by date once, up front. The rows between any 
+    two datetimes are then a range (slice) of the sorted rows, found with a 
+    binary search, and the number of positive/negative labels in any range is 
+    read from running counts. 
+
+    Args: 
+    ----
+        dates: 1d np.ndarray or Pandas Series of datetime64s
+        y (optional): 1d np.ndarray or Pandas Series of bools/ints
+            Holds the labels, to count the positives/negatives of each range. 
+
+    Attributes: 
+    ----------
+        order: 1d np.ndarray of ints
+            Holds the position (in the inputted `dates`) of each sorted row. 
+        dates: 1d np.ndarray of datetime64s
+            Holds the sorted dates. 
+        days: 1d np.ndarray of datetime64[D]s
+            Holds each day that there are rows on. 
+        day_offsets: 1d np.ndarray of ints
+            Holds the first sorted row of each day (and the number of rows 
+            last), so the rows of `days[i]` are `day_offsets[i]:day_offsets[i + 1]`. 
+        day_n_pos: 1d np.ndarray of ints
+        day_n_neg: 1d np.ndarray of ints
+            Hold the number of positive/negative labels on each day (if `y` 
+            was given). 
+    """
+
+    def __init__(self, dates, y=None): 
+        dates = np.asarray(dates, dtype='datetime64[ns]')
+        # Most inputs are already in date order, in which case there's no need 
+        # to sort (or copy) them. 
+        if (dates[1:] >= dates[:-1]).all(): 
+            self.order = np.arange(dates.shape[0])
+            self.dates = dates
+        else: 
+            self.order = np.argsort(dates, kind='mergesort')
+            self.dates = dates[self.order]
+
+        self.days, day_offsets = np.unique(self.dates.astype('datetime64[D]'), 
+                return_index=True)
+        self.day_offsets = np.append(day_offsets, self.dates.shape[0])
+
+        self._n_pos_before = None
+        self.day_n_pos, self.day_n_neg = None, None
+        if y is not None: 
+            y = np.asarray(y)[self.order]
+            # Holds the number of positives before each sorted row (and in all 
+            # of them, last). 
+            self._n_pos_before = np.zeros(y.shape[0] + 1, dtype=np.int64)
+            np.cumsum(y != 0, out=self._n_pos_before[1:])
+            self.day_n_pos = np.diff(self._n_pos_before[self.day_offsets])
+            self.day_n_neg = np.diff(self.day_offsets) - self.day_n_pos
+
+    def __len__(self): 
+        return self.dates.shape[0]
+
+    def search(self, dt): 
+        """Return the first sorted row on or after the datetime. 
+
+        Args: 
+        ----
+            dt: datetime.datetime
+
+        Return: 
+        ------
+            row: int
+        """
+
+        return int(np.searchsorted(self.dates, np.datetime64(dt, 'ns'), 
+            side='left'))
+
+    def get_rows(self, beg_dt=None, end_dt=None): 
+        """Return the sorted rows on or after `beg_dt`, and before `end_dt`. 
+
+        Args: 
+        ----
+            beg_dt (optional): datetime.datetime
+                Holds the first datetime (the first row if None). 
+            end_dt (optional): datetime.datetime
+                Holds the datetime after the last (the last row if None). 
+
+        Return: 
+        ------
+            rows: slice
+        """
+
+        beg_row = 0 if beg_dt is None else self.search(beg_dt)
+        end_row = len(self) if end_dt is None else self.search(end_dt)
+
+        return slice(beg_row, max(beg_row, end_row))
+
+    def get_day_rows(self, dt, days_forward=1): 
+        """Return the sorted rows before a day, and those on it (and the days 
+        after it, up to `days_forward` days in all). 
+
+        Args: 
+        ----
+            dt: datetime.datetime
+            days_forward (optional): int
+
+        Return: 
+        ------
+            train_rows: slice
+            test_rows: slice
+        """
+
+        test_rows = self.get_rows(dt, dt + timedelta(days=days_forward))
+
+        return slice(0, test_rows.start), test_rows
+
+    def get_positions(self, rows): 
+        """Return the position (in the inputted `dates`) of each of the rows. 
+
+        Args: 
+        ----
+            rows: slice
+
+        Return: 
+        ------
+            positions: 1d np.ndarray of ints
+                Holds a view into `self.order`. 
+        """
+
+        return self.order[rows]
+
+    def count_labels(self, rows): 
+        """Return the number of positive and negative labels in the rows. 
+
+        Args: 
+        ----
+            rows: slice
+
+        Return: 
+        ------
+            n_pos: int
+            n_neg: int
+        """
+
+        if self._n_pos_before is None: 
+            raise RuntimeError('The TemporalIndex was built without labels, so '
+                    'it can\'t count them')
+        n_pos = int(self._n_pos_before[rows.stop] - 
+                self._n_pos_before[rows.start])
+
+        return n_pos, (rows.stop - rows.start) - n_pos
+
 class SequentialTimeFold():
     """Sequential time fold cross-validation iterator. 
 
@@ -83,16 +237,19 @@ class SequentialTimeFold():
         self.y_col = y_col
 
         self.n_folds = 0
-        self.all_dates = df['date_fire'] 
+        # The dates are sorted (and the labels counted) once, so that each fold 
+        # is a binary search rather than a pass over every row. 
+        self.temporal_index = TemporalIndex(df['date_fire'], df[y_col])
         # Set the first test_date to be the most recent set of day(s). 
-        self.test_date = test_set_date - timedelta(days=days_forward)
+        self.first_test_date = test_set_date - timedelta(days=days_forward)
+        self._folds = None
         
     def __len__(self): 
-        return self.n_folds
+        return self.get_n_splits()
 
     def __iter__(self): 
-        """Allows the class to be called as an iterator."""
-        return self
+        """Allows the class to be called as an iterator (over all the folds)."""
+        return self.split()
 
     def next(self):
         """Generate integer indices corresponding to train/test sets. 
@@ -107,28 +264,73 @@ class SequentialTimeFold():
             train_indices: np.ndarray
             test_indices: np.ndarray
         """
-        
-        # Initialize array to initially get into while loop. 
-        test_indices = np.zeros((0))
 
-        while test_indices.shape[0] == 0: 
+        if self._folds is None: 
+            self._folds = self.split()
+        train_indices, test_indices = next(self._folds)
+        self.n_folds += 1
+
+        return train_indices, test_indices
+
+    def split(self, X=None, y=None, groups=None): 
+        """Generate the integer indices of the train/test sets of each fold. 
+
+        This is the splitter interface of `sklearn.model_selection`, so the 
+        object itself can be passed as the `cv` of a search. The folds come 
+        from `self.df`, so `X` (and `y` and `groups`) are ignored. 
+
+        Args: 
+        ----
+            X (optional): ignored
+            y (optional): ignored
+            groups (optional): ignored
+
+        Yields: 
+        ------
+            train_indices: np.ndarray
+            test_indices: np.ndarray
+                Hold views into the sorted order of the rows (so the indices 
+                are in date order). 
+        """
+
+        index = self.temporal_index
+        first_date = index.dates[0] if len(index) else None
+        test_date = self.first_test_date
+        n_folds = 0
+
+        while n_folds <= self.max_folds: 
             # Define a min and max for the test set to query against. 
-            test_date_min = self.test_date
+            test_date_min = test_date
             test_date_max = test_date_min + timedelta(days=self.days_forward)
+            test_date -= self.step_size
+            # There are no more folds once the test set is before every ob. 
+            if first_date is None or np.datetime64(test_date_max, 'ns') <= \
+                    first_date: 
+                return
 
-            test_indices = np.where(np.logical_and(self.all_dates >= test_date_min, 
-                self.all_dates < test_date_max))[0]
-            train_indices = np.where(self.all_dates < test_date_min)[0]
-            self.test_date -= self.step_size
-            
-            # If it's all one label in the test indices, then we can't calculate the 
-            # metrics I'm looking at, and should just resample.
-            if len(np.unique(self.df.ix[test_indices, self.y_col])) != 2: 
-                test_indices = np.zeros((0))
-        
-        if self.n_folds <= self.max_folds: 
-            self.n_folds += 1
-            return train_indices, test_indices
-        else: 
-            raise StopIteration()
+            train_rows, test_rows = index.get_day_rows(test_date_min, 
+                    self.days_forward)
+            # If it's all one label in the test indices (or it's empty), then 
+            # we can't calculate the metrics I'm looking at, and should just 
+            # resample. 
+            if 0 in index.count_labels(test_rows): 
+                continue
+
+            n_folds += 1
+            yield index.get_positions(train_rows), index.get_positions(test_rows)
+
+    def get_n_splits(self, X=None, y=None, groups=None): 
+        """Return the number of folds. 
+
+        Args: 
+        ----
+            X (optional): ignored
+            y (optional): ignored
+            groups (optional): ignored
+
+        Return: 
+        ------
+            n_splits: int
+        """
 
+        return sum(1 for _ in self.split())